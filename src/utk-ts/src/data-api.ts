@@ -50,6 +50,10 @@ export abstract class DataApi {
 
     const base_feature = <ILayerData> await DataLoader.getJsonData(url_base);
 
+    if(base_feature.offsets != undefined){
+      return DataApi.getLayerWithOffsets(layerId, base_feature);
+    }
+
     let coordinates;
     let indices;
     let normals;
@@ -59,22 +63,22 @@ export abstract class DataApi {
 
       if(base_feature.data[0].geometry.coordinates != undefined){
         console.log(url_coordinates);
-        coordinates = <Float64Array> await DataLoader.getBinaryData(url_coordinates, 'd');
+        coordinates = <Float64Array> await DataApi.getChannel(url_coordinates, 'coordinates', base_feature);
       }
 
       if(base_feature.data[0].geometry.indices != undefined){
         console.log(url_indices);
-        indices = <Uint32Array> await DataLoader.getBinaryData(url_indices, 'I');
+        indices = <Uint32Array | Uint16Array> await DataApi.getChannel(url_indices, 'indices', base_feature);
       }
 
       if(base_feature.data[0].geometry.normals != undefined){
         console.log(url_normals);
-        normals = <Float32Array> await DataLoader.getBinaryData(url_normals, 'f');
+        normals = <Float32Array> await DataApi.getChannel(url_normals, 'normals', base_feature);
       }
 
       if(base_feature.data[0].geometry.ids != undefined){
         console.log(url_ids);
-        ids = <Uint32Array> await DataLoader.getBinaryData(url_ids, 'I');
+        ids = <Uint32Array> await DataApi.getChannel(url_ids, 'ids', base_feature);
       }
 
       for(let i = 0; i < base_feature.data.length; i++){
@@ -103,9 +107,130 @@ export abstract class DataApi {
     
     }
 
+    return DataApi.removeTombstones(base_feature);
+  }
+
+  /**
+   * Gets the layer data when the offsets are stored in the <id>_offsets.data sidecar
+   * @param {string} layerId the layer data
+   * @param {ILayerData} base_feature the layer header
+   */
+  static async getLayerWithOffsets(layerId: string, base_feature: ILayerData): Promise<ILayerData> {
+    const url_offsets = `${Environment.backend}/files/${layerId}_offsets.data`;
+
+    const channels = base_feature.offsets!.channels;
+    const count = base_feature.offsets!.count;
+
+    const offsets = <BigUint64Array> await DataLoader.getBinaryData(url_offsets, 'Q');
+
+    if(base_feature.data == undefined){
+      base_feature.data = [];
+      for(let i = 0; i < count; i++){
+        base_feature.data.push(<any>{geometry: {}});
+      }
+    }
+
+    for(let c = 0; c < channels.length; c++){
+      const channel = channels[c];
+
+      console.log(`${Environment.backend}/files/${layerId}_${channel}.data`);
+      const values = await DataApi.getChannel(`${Environment.backend}/files/${layerId}_${channel}.data`, channel, base_feature);
+
+      const row = c*(count+1);
+
+      for(let i = 0; i < count; i++){
+        (<any>base_feature.data[i].geometry)[channel] = Array.from(values.slice(Number(offsets[row+i]), Number(offsets[row+i+1])));
+      }
+    }
+
+    delete base_feature.offsets;
+
+    return DataApi.removeTombstones(base_feature);
+  }
+
+  /**
+   * Removes the features deleted with tombstones (they stay in the binary files until the layer is compacted)
+   * @param {ILayerData} base_feature the layer data
+   */
+  static removeTombstones(base_feature: ILayerData): ILayerData {
+    if(base_feature.tombstones == undefined || base_feature.data == undefined){
+      return base_feature;
+    }
+
+    const deleted = new Set(base_feature.tombstones);
+
+    base_feature.data = base_feature.data.filter((feature, index) => !deleted.has(index));
+
+    delete base_feature.tombstones;
+
     return base_feature;
   }
 
+  /**
+   * Loads a binary channel of a layer, decoding it if the layer header describes an encoding
+   * @param {string} url the channel file url
+   * @param {string} channel the channel name
+   * @param {ILayerData} base_feature the layer header
+   */
+  static async getChannel(url: string, channel: string, base_feature: ILayerData): Promise<Float64Array | Float32Array | Uint32Array | Uint16Array> {
+    const channelTypes: {[channel: string]: string} = {coordinates: 'd', normals: 'f', indices: 'I', ids: 'I'};
+
+    const encoding = base_feature.encodings != undefined ? base_feature.encodings[channel] : undefined;
+    const type = encoding != undefined && encoding.dtype != undefined ? encoding.dtype : channelTypes[channel];
+
+    if(channel == 'indices'){
+      DataLoader.checkIndexType(base_feature.indexType, type);
+    }
+
+    const values = <any> await DataLoader.getBinaryData(url, type);
+
+    if(encoding == undefined){
+      return values;
+    }
+
+    if(encoding.type == 'uint16'){ // narrow indices are used as loaded
+      return values;
+    }
+
+    if(encoding.type == 'rtc'){ // float32 offsets relative to a float64 origin
+      const origin = <number[]> encoding.origin;
+      const decoded = new Float64Array(values.length);
+
+      for(let i = 0; i < values.length; i++){
+        decoded[i] = values[i] + origin[i%3];
+      }
+
+      return decoded;
+    }
+
+    if(encoding.type == 'oct16' || encoding.type == 'oct8'){ // octahedral normals (two signed normalized values per normal)
+      const maxValue = encoding.type == 'oct16' ? 32767 : 127;
+      const decoded = new Float32Array(values.length/2*3);
+
+      for(let i = 0; i < values.length/2; i++){
+        let x = values[i*2]/maxValue;
+        let y = values[i*2+1]/maxValue;
+        const z = 1 - Math.abs(x) - Math.abs(y);
+
+        if(z < 0){ // lower hemisphere
+          const folded_x = (1 - Math.abs(y)) * (x >= 0 ? 1 : -1);
+          y = (1 - Math.abs(x)) * (y >= 0 ? 1 : -1);
+          x = folded_x;
+        }
+
+        const length = Math.sqrt(x*x + y*y + z*z);
+
+        decoded[i*3] = x/length;
+        decoded[i*3+1] = y/length;
+        decoded[i*3+2] = z/length;
+      }
+
+      return decoded;
+    }
+
+    throw Error(`Unknown encoding ${encoding.type}`);
+  }
+
 
   /**
    * Gets the layer data
@@ -121,7 +121,44 @@ export abstract class DataLoader {
       return new Uint32Array(<ArrayBuffer>arrayResult);
     }
 
-    return null;
+    if(type == 'Q'){
+      return new BigUint64Array(<ArrayBuffer>arrayResult);
+    }
+
+    if(type == 'H'){
+      return new Uint16Array(<ArrayBuffer>arrayResult);
+    }
+
+    if(type == 'h'){
+      return new Int16Array(<ArrayBuffer>arrayResult);
+    }
+
+    if(type == 'b'){
+      return new Int8Array(<ArrayBuffer>arrayResult);
+    }
+
+    throw Error(`Unknown binary type ${type}`);
+  }
+
+  /**
+   * Checks the indexType entry of a layer header against the type the indices channel is read with
+   * @param {string | undefined} indexType the indexType entry of the layer (undefined in layers written before it existed)
+   * @param {string} type the binary type given by the encodings of the layer
+   */
+  static checkIndexType(indexType: string | undefined, type: string): void {
+    const indexTypes: {[indexType: string]: string} = {uint16: 'H', uint32: 'I'};
+
+    if(indexType == undefined){
+      return;
+    }
+
+    if(indexTypes[indexType] == undefined){
+      throw Error(`Unknown index type ${indexType}`);
+    }
+
+    if(indexTypes[indexType] != type){
+      throw Error(`Index type ${indexType} does not match the encoding of the indices channel`);
+    }
   }
 
   /**
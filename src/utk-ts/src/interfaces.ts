@@ -111,6 +111,27 @@ export interface ILayerData {
     styleKey: keyof IMapStyle;   // layer style key
     data?: ILayerFeature[];      // list of features of the layer 
     renderStyle?: RenderStyle[]; // list of render styles
+    offsets?: ILayerOffsets;     // channels stored in the offsets sidecar (<id>_offsets.data)
+    encodings?: {[channel: string]: IChannelEncoding}; // channels stored encoded
+    indexType?: string;          // type of the stored indices (uint16 or uint32)
+    tombstones?: number[];       // deleted features (still stored in the binary files)
+}
+
+/**
+ * Interface with the encoding of a binary channel
+ */
+export interface IChannelEncoding {
+    type: string;      // encoding name (e.g. rtc)
+    dtype?: string;    // type of the stored values
+    origin?: number[]; // origin of the rtc encoding
+}
+
+/**
+ * Interface with the header of the offsets sidecar
+ */
+export interface ILayerOffsets {
+    channels: string[]; // one row of offsets per channel (in this order)
+    count: number;      // number of features (each row has count+1 offsets)
 }
 
 export interface IJoinedJson {
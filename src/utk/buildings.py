@@ -707,6 +707,28 @@ class Buildings:
 
         return {"df": df, "gdf": {"objects": gdf, "coordinates": gdf_coordinates, "coordinates3d": df_3d_coordinates}}
 
+    def concat_layer_gdfs(layer_gdfs):
+        '''
+            Concatenates the gdf tables of building layers generated in batches. The ids of each batch are shifted by
+            the rows of the previous ones, as if the layer had been generated at once.
+        '''
+
+        concatenated = {}
+
+        for key in ['objects', 'coordinates', 'coordinates3d']:
+            frames = []
+            offset = 0
+
+            for layer_gdf in layer_gdfs:
+                frame = layer_gdf[key].copy()
+                frame['id'] = frame['id'] + offset
+                offset += len(frame)
+                frames.append(frame)
+
+            concatenated[key] = pd.concat(frames, ignore_index=True)
+
+        return concatenated
+
     def get_coordinates(gdf, compute_normals=False):
         coordinates = gdf['coordinates'].values
         indices = gdf['indices'].values
@@ -731,7 +753,11 @@ class Buildings:
         
         return coords_all, indices_all, ids_all, colors_all
     
-    def df_to_json(df, layer_id = "buildings", layer_type = 'BUILDINGS_LAYER', renderStyle = ["SMOOTH_COLOR"], styleKey = "building"):
+    def df_to_json(df, layer_id = "buildings", layer_type = 'BUILDINGS_LAYER', renderStyle = ["SMOOTH_COLOR"], styleKey = "building", writer = None):
+        '''
+            Converts the building meshes into the json layer format. If a LayerWriter is provided, each building is streamed
+            to it as soon as it is flattened and the returned json has no data.
+        '''
 
         json_new = {}
 
@@ -771,16 +797,19 @@ class Buildings:
             #     }
             # })
 
-            json_new["data"].append({
-                "geometry": {
-                    "coordinates": flattened_coordinates,
-                    "indices": flattened_indices,
-                    "normals": flattened_normals,
-                    "ids": [int(elem) for elem in ids_all],
-                    "orientedEnvelope": [[round(elem,4) for elem in item] for item in df.iloc[[index]]["orientedEnvelope"].tolist()[0]],
-                    "sectionFootprint": [[round(elem,4) for elem in item] for item in df.iloc[[index]]["sectionFootprint"].tolist()[0]]
-                }
-            })
+            geometry = {
+                "coordinates": flattened_coordinates,
+                "indices": flattened_indices,
+                "normals": flattened_normals,
+                "ids": [int(elem) for elem in ids_all],
+                "orientedEnvelope": [[round(elem,4) for elem in item] for item in df.iloc[[index]]["orientedEnvelope"].tolist()[0]],
+                "sectionFootprint": [[round(elem,4) for elem in item] for item in df.iloc[[index]]["sectionFootprint"].tolist()[0]]
+            }
+
+            if(writer != None):
+                writer.append_features([{"geometry": geometry}])
+            else:
+                json_new["data"].append({"geometry": geometry})
 
         return json_new
 
@@ -1,6 +1,10 @@
 import os
 import hashlib
 import json
+import threading
+import numpy as np
+
+from collections import OrderedDict
 
 def _hash_query(query):
     return hashlib.md5(query.encode("utf-8")).hexdigest()
@@ -26,3 +30,91 @@ def _load_osm_from_cache(query):
         return None
 
 
+
+# decoded channels of layers shared by every loader of the process (load_utk, FilesInterface, ShadowAccumulator)
+# entries are evicted in least recently used order when the byte budget is exceeded. Memory mapped arrays are paged
+# by the OS and do not count against the budget
+_channel_cache = OrderedDict() # (path, fmt, mmap, encoding) -> (mtime, size, array, resident bytes)
+_channel_cache_lock = threading.Lock()
+_channel_cache_bytes = 0
+_channel_cache_budget = 1024*1024*1024
+
+def set_channel_cache_budget(budget):
+    '''
+        Sets the maximum number of bytes held in memory by the decoded channels cache. 0 disables the cache (except for
+        memory mapped channels, which hold no memory).
+    '''
+    global _channel_cache_budget
+
+    with _channel_cache_lock:
+        _channel_cache_budget = budget
+        _evict_channels()
+
+def clear_channel_cache():
+    global _channel_cache_bytes
+
+    with _channel_cache_lock:
+        _channel_cache.clear()
+        _channel_cache_bytes = 0
+
+def _evict_channels():
+    global _channel_cache_bytes
+
+    while(_channel_cache_bytes > _channel_cache_budget and len(_channel_cache) > 0):
+        _, entry = _channel_cache.popitem(last=False)
+        _channel_cache_bytes -= entry[3]
+
+def _invalidate_channel(path):
+    '''
+        Drops all cached decodings of a file (called before the file is rewritten)
+    '''
+    global _channel_cache_bytes
+
+    path = os.path.abspath(path)
+
+    with _channel_cache_lock:
+        for key in [key for key in _channel_cache if key[0] == path]:
+            _channel_cache_bytes -= _channel_cache.pop(key)[3]
+
+def _resident_bytes(array):
+    '''
+        Bytes of memory held by a cached array (none for memory maps of the file, e.g. channels stored as is)
+    '''
+
+    return 0 if isinstance(array, np.memmap) else array.nbytes
+
+def _load_channel_from_cache(path, fmt, mmap, decode, encoding=None):
+    '''
+        Returns the decoded channel stored in path. decode(path) is only called if the file is not cached
+        or if its mtime or size changed since it was cached.
+
+        * @param {string} encoding Key of the decoding applied by decode (None if the values are returned as stored)
+    '''
+    global _channel_cache_bytes
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, fmt, mmap, encoding)
+
+    with _channel_cache_lock:
+        if key in _channel_cache:
+            mtime, size, array, _ = _channel_cache[key]
+            if mtime == stat.st_mtime_ns and size == stat.st_size:
+                _channel_cache.move_to_end(key)
+                return array
+            _channel_cache_bytes -= _channel_cache.pop(key)[3]
+
+    array = decode(path)
+    array.flags.writeable = False # the same array is shared by all loaders
+
+    resident = _resident_bytes(array)
+
+    if resident <= _channel_cache_budget:
+        with _channel_cache_lock:
+            if key in _channel_cache:
+                _channel_cache_bytes -= _channel_cache.pop(key)[3]
+            _channel_cache[key] = (stat.st_mtime_ns, stat.st_size, array, resident)
+            _channel_cache_bytes += resident
+            _evict_channels()
+
+    return array
@@ -0,0 +1,533 @@
+import os
+import json
+import numpy as np
+
+from . import cache
+from . import compression
+from . import manifest
+
+'''
+    Binary layout of physical layers
+
+    A layer is described by <id>.json. Each geometry channel (coordinates, normals, indices, ids) is stored
+    in <id>_<channel>.data as a flat array, and every feature keeps a [start, size] pair per channel pointing into it.
+
+    Alternatively the pairs can be stored in <id>_offsets.data: a uint64 matrix with one row of CSR offsets (feature
+    count + 1 values) per channel, so feature i of a channel is values[offsets[c][i]:offsets[c][i+1]]. The .json then has
+    an "offsets" entry ({"channels": [...], "count": number of features}) and only keeps "data" if the features have
+    other fields (e.g. sectionFootprint).
+
+    A channel can also be stored encoded. The .json then has an "encodings" entry describing it, e.g.
+    {"coordinates": {"type": "rtc", "dtype": "f", "origin": [x, y, z]}} (float32 offsets relative to a float64 origin).
+    Offsets (pairs and sidecar) always count decoded values.
+
+    Layers with an indices channel record the type it is stored with in "indexType" ("uint16" or "uint32", see
+    INDEX_TYPES). Readers check it against the encodings and refuse types they do not know. Layers written before the
+    entry existed are read with the type given by their encodings.
+
+    Channel files can be compressed in chunks (see compression). They keep their name and are read transparently.
+
+    Thematic (abstract) layers use the same layout: <id>_coordinates.data (float64) and <id>_values.data (float32), with
+    a .json that only has {"id": ..., "channels": ["coordinates", "values"], "count": number of points}. Layers with
+    "coordinates" and "values" lists in the .json are still read.
+'''
+
+# struct format of each channel
+CHANNEL_TYPES = {
+    'coordinates': 'd',
+    'normals': 'f',
+    'indices': 'I',
+    'ids': 'I'
+}
+
+OFFSETS_TYPE = 'Q'
+
+# encodings supported by encode_channel/decode_channel per channel
+CHANNEL_ENCODINGS = {
+    'coordinates': ['rtc'],
+    'normals': ['oct16', 'oct8'],
+    'indices': ['uint16']
+}
+
+# struct format of each "indexType" of the header
+INDEX_TYPES = {
+    'uint16': 'H',
+    'uint32': 'I'
+}
+
+# struct format of each channel of thematic layers
+THEMATIC_CHANNEL_TYPES = {
+    'coordinates': 'd',
+    'values': 'f'
+}
+
+# stored type of the octahedral encodings (two signed normalized values per normal)
+OCTAHEDRAL_TYPES = {
+    'oct16': 'h',
+    'oct8': 'b'
+}
+
+def channel_filepath(filepath, channel):
+    '''
+        Path of the .data file of a channel given the path of the layer .json
+    '''
+
+    directory = os.path.dirname(filepath)
+    # file name without extension
+    file_name_wo_extension = os.path.splitext(os.path.basename(filepath))[0]
+
+    return os.path.join(directory, file_name_wo_extension+'_'+channel+'.data')
+
+def layer_channels(layer_json):
+    '''
+        Returns the binary channels of a layer header and their struct format
+    '''
+
+    if('offsets' in layer_json):
+        names = layer_json['offsets']['channels']
+    elif('data' not in layer_json or len(layer_json['data']) == 0):
+        return {}
+    else:
+        geometry = layer_json['data'][0]['geometry']
+        names = [channel for channel in CHANNEL_TYPES if channel in geometry]
+
+    return {channel: channel_storage_type(layer_json, channel) for channel in names}
+
+def channel_encoding(layer_json, channel):
+    '''
+        Encoding of a channel described in the header (None if the channel is stored as is)
+    '''
+
+    if('encodings' not in layer_json):
+        return None
+
+    return layer_json['encodings'].get(channel)
+
+def channel_storage_type(layer_json, channel):
+    '''
+        struct format of the values stored in the .data file of a channel
+    '''
+
+    encoding = channel_encoding(layer_json, channel)
+
+    fmt = CHANNEL_TYPES[channel]
+
+    if(encoding != None and 'dtype' in encoding):
+        fmt = encoding['dtype']
+
+    if(channel == 'indices' and 'indexType' in layer_json):
+        index_type = layer_json['indexType']
+
+        if(index_type not in INDEX_TYPES):
+            raise Exception("Unknown index type "+str(index_type)+" (supported: "+", ".join(INDEX_TYPES)+")")
+
+        if(INDEX_TYPES[index_type] != fmt):
+            raise Exception("Index type "+index_type+" does not match the encoding of the indices channel")
+
+    return fmt
+
+def set_index_type(layer_json, channel_names):
+    '''
+        Records the type the indices channel is stored with in the "indexType" entry of a layer header
+
+        * @param {object} layer_json Header of the layer (its "encodings" entry must be final)
+        * @param {List[string]} channel_names Channels of the layer
+    '''
+
+    layer_json.pop('indexType', None)
+
+    if('indices' not in channel_names):
+        return
+
+    fmt = channel_storage_type(layer_json, 'indices')
+
+    layer_json['indexType'] = next(name for name in INDEX_TYPES if INDEX_TYPES[name] == fmt)
+
+def new_encoding(channel, name, values, origin=None):
+    '''
+        Creates the header entry of an encoding. The first values written to the channel can be used to define its parameters.
+
+        * @param {string} channel Name of the channel
+        * @param {string} name Name of the encoding (see CHANNEL_ENCODINGS)
+        * @param {np.ndarray} values First values of the channel
+        * @param {List[float]} origin Origin of the rtc encoding. If None the first vertex (rounded to meters) is used
+    '''
+
+    if(channel not in CHANNEL_ENCODINGS or name not in CHANNEL_ENCODINGS[channel]):
+        raise Exception("Encoding "+str(name)+" not supported for channel "+channel)
+
+    if(name == 'rtc'):
+        if(origin is None):
+            origin = np.round(values[:3]).tolist() if len(values) >= 3 else [0.0, 0.0, 0.0]
+
+        return {'type': 'rtc', 'dtype': 'f', 'origin': [float(value) for value in origin]}
+
+    if(name in OCTAHEDRAL_TYPES):
+        return {'type': name, 'dtype': OCTAHEDRAL_TYPES[name]}
+
+    if(name == 'uint16'):
+        return {'type': 'uint16', 'dtype': 'H'}
+
+def index_encoding(max_index):
+    '''
+        Narrowest encoding of an indices channel given its largest value (None if uint32 is needed)
+    '''
+
+    if(max_index < np.iinfo(np.uint16).max+1):
+        return new_encoding('indices', 'uint16', None)
+
+    return None
+
+def widen_channel_file(path, fmt, wide_fmt, chunk_size=1<<24):
+    '''
+        Rewrites a channel file stored with fmt using the wider type wide_fmt (e.g. uint16 indices that do not fit anymore)
+    '''
+
+    narrow_channel_file(path, fmt, {'type': 'widen', 'dtype': wide_fmt}, chunk_size)
+
+def narrow_channel_file(path, fmt, encoding, chunk_size=1<<24):
+    '''
+        Rewrites a channel file stored with fmt using a narrower encoding. Done in chunks so the whole channel is never in memory.
+    '''
+
+    cache._invalidate_channel(path)
+
+    tmp_path = path+'.tmp'
+
+    if(os.path.getsize(path) == 0):
+        open(tmp_path, 'wb').close()
+    else:
+        values = np.memmap(path, dtype=np.dtype(fmt), mode='r')
+
+        with open(tmp_path, 'wb') as fout:
+            for start in range(0, len(values), chunk_size):
+                encode_channel(np.asarray(values[start:start+chunk_size]), encoding).tofile(fout)
+
+        del values
+
+    os.replace(tmp_path, path)
+
+def _sign_not_zero(values):
+    return np.where(values >= 0, 1.0, -1.0)
+
+def _octahedral_encode(normals, dtype):
+    '''
+        Maps unit vectors to the octahedron unfolded on the [-1,1] square, quantized as signed normalized integers
+    '''
+
+    normals = normals.reshape(-1, 3).astype(np.float64)
+
+    l1 = np.abs(normals).sum(axis=1)
+    l1[l1 == 0] = 1 # degenerate normals are encoded as (0, 0, 1)
+
+    p = normals[:,:2] / l1[:,None]
+
+    lower = normals[:,2] < 0 # fold the lower hemisphere over the diagonals
+    p[lower] = (1 - np.abs(p[lower][:,::-1])) * _sign_not_zero(p[lower])
+
+    max_value = np.iinfo(dtype).max
+
+    return np.round(np.clip(p, -1, 1) * max_value).astype(dtype).ravel()
+
+def _octahedral_decode(values, dtype):
+
+    max_value = np.iinfo(values.dtype).max
+
+    p = values.reshape(-1, 2).astype(np.float32) / max_value
+
+    normals = np.empty((len(p), 3), dtype=np.float32)
+    normals[:,:2] = p
+    normals[:,2] = 1 - np.abs(p).sum(axis=1)
+
+    lower = normals[:,2] < 0
+    normals[lower,:2] = (1 - np.abs(p[lower][:,::-1])) * _sign_not_zero(p[lower])
+
+    normals /= np.linalg.norm(normals, axis=1)[:,None]
+
+    return normals.astype(dtype).ravel()
+
+def encode_channel(values, encoding):
+    '''
+        Encodes the (flat) values of a channel as they are stored in the .data file
+    '''
+
+    if(encoding == None):
+        return values
+
+    if(encoding['type'] == 'rtc'):
+        if(len(values) % 3 != 0):
+            raise Exception("rtc encoding requires 3D coordinates")
+
+        return (values.reshape(-1, 3) - np.array(encoding['origin'])).astype(np.dtype(encoding['dtype'])).ravel()
+
+    if(encoding['type'] in OCTAHEDRAL_TYPES):
+        if(len(values) % 3 != 0):
+            raise Exception("octahedral encoding requires 3D normals")
+
+        return _octahedral_encode(values, np.dtype(encoding['dtype']))
+
+    if(encoding['type'] == 'widen'): # only used to rewrite files
+        return values.astype(np.dtype(encoding['dtype']))
+
+    if(encoding['type'] == 'uint16'):
+        if(len(values) > 0 and values.max() > np.iinfo(np.uint16).max):
+            raise Exception("Indices do not fit in uint16")
+
+        return values.astype(np.dtype(encoding['dtype']))
+
+    raise Exception("Unknown encoding "+str(encoding['type']))
+
+def decode_channel(values, channel, encoding):
+    '''
+        Decodes the values read from a .data file into the type of the channel (see CHANNEL_TYPES)
+    '''
+
+    if(encoding == None):
+        return values
+
+    if(encoding['type'] == 'rtc'):
+        decoded = values.reshape(-1, 3).astype(np.dtype(CHANNEL_TYPES[channel])) + np.array(encoding['origin'])
+        return decoded.ravel()
+
+    if(encoding['type'] in OCTAHEDRAL_TYPES):
+        return _octahedral_decode(values, np.dtype(CHANNEL_TYPES[channel]))
+
+    if(encoding['type'] == 'uint16'): # narrow integers are kept as stored (no copy)
+        return values
+
+    raise Exception("Unknown encoding "+str(encoding['type']))
+
+def read_channel(path, fmt, mmap=True, channel=None, encoding=None):
+    '''
+        Reads a channel file into a flat numpy array without creating one python object per element.
+        The arrays are read-only and shared through the process-wide channel cache (invalidated when the file changes).
+        Encoded channels are cached decoded, so the decoding is done once per file and encoding.
+
+        * @param {string} path Location of the .data file
+        * @param {string} fmt struct format of the values ('d', 'f', 'I')
+        * @param {bool} mmap If True the file is memory mapped instead of read into memory (ignored for compressed files)
+        * @param {string} channel Name of the channel (see CHANNEL_TYPES), required if encoding is provided
+        * @param {object} encoding Encoding of the channel in the header (see channel_encoding). The values are returned as stored if None
+    '''
+
+    def decode(path):
+        dtype = np.dtype(fmt)
+
+        if(compression.is_compressed(path)):
+            values = compression.CompressedChannel(path).read_all().astype(dtype, copy=False)
+        elif(os.path.getsize(path) == 0): # np.memmap does not accept empty files
+            values = np.empty(0, dtype=dtype)
+        elif(mmap):
+            values = np.memmap(path, dtype=dtype, mode='r')
+        else:
+            values = np.fromfile(path, dtype=dtype)
+
+        return decode_channel(values, channel, encoding)
+
+    return cache._load_channel_from_cache(path, fmt, mmap, decode, None if encoding == None else json.dumps(encoding, sort_keys=True))
+
+def stored_range(encoding, start, size):
+    '''
+        Range of stored values of the decoded values [start, start+size) of a channel
+    '''
+
+    if(encoding != None and encoding['type'] in OCTAHEDRAL_TYPES): # 3 decoded values per 2 stored
+        return start//3*2, size//3*2
+
+    return start, size
+
+def decoded_length(encoding, stored_length):
+    '''
+        Number of decoded values of stored_length stored values of a channel
+    '''
+
+    if(encoding != None and encoding['type'] in OCTAHEDRAL_TYPES):
+        return stored_length//2*3
+
+    return stored_length
+
+def compress_layer(filepath, layer_json=None, codec='zlib', level=None):
+    '''
+        Compresses the channel files (and the offsets sidecar) of a layer in place
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {object} layer_json Header of the layer (read from filepath if None)
+        * @param {string} codec 'zlib' or 'zstd' (see compression.available_codecs)
+        * @param {int} level Compression level (codec default if None)
+    '''
+
+    if(layer_json == None):
+        with open(filepath, "r", encoding="utf-8") as f:
+            layer_json = json.load(f)
+
+    for channel, fmt in layer_channels(layer_json).items():
+        compression.compress_file(channel_filepath(filepath, channel), fmt, codec, level)
+
+    if('offsets' in layer_json):
+        compression.compress_file(offsets_filepath(filepath), OFFSETS_TYPE, codec, level)
+
+    manifest.update_layer(filepath)
+
+def offsets_filepath(filepath):
+    '''
+        Path of the offsets sidecar given the path of the layer .json
+    '''
+
+    return channel_filepath(filepath, 'offsets')
+
+def read_offsets(filepath, layer_json, mmap=True):
+    '''
+        Reads the offsets sidecar of a layer as a (channels, count+1) uint64 matrix with a single np.fromfile
+    '''
+
+    header = layer_json['offsets']
+
+    offsets = read_channel(offsets_filepath(filepath), OFFSETS_TYPE, mmap=mmap)
+
+    if(len(offsets) != len(header['channels'])*(header['count']+1)):
+        raise Exception("Offsets file does not match the header of "+str(filepath))
+
+    return offsets.reshape(len(header['channels']), header['count']+1)
+
+def write_offsets(filepath, channel_sizes):
+    '''
+        Writes the offsets sidecar of a layer.
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {List[List[int]]} channel_sizes Size of every feature, one list per channel (in the order of the header)
+    '''
+
+    path = offsets_filepath(filepath)
+
+    cache._invalidate_channel(path)
+
+    count = len(channel_sizes[0]) if len(channel_sizes) > 0 else 0
+
+    offsets = np.zeros((len(channel_sizes), count+1), dtype=np.dtype(OFFSETS_TYPE))
+
+    for index, sizes in enumerate(channel_sizes):
+        offsets[index,1:] = np.cumsum(sizes)
+
+    offsets.tofile(path)
+
+def channel_offsets(layer_json, channel):
+    '''
+        Returns two arrays with the start and the size of every feature in a channel (json [start, size] layout)
+    '''
+
+    pairs = np.array([feature['geometry'][channel] for feature in layer_json['data']], dtype=np.int64).reshape(-1, 2)
+
+    return pairs[:,0], pairs[:,1]
+
+def write_channels(filepath, filename, features, types, dataTypes):
+    '''
+        Writes one channel file per type with the values of all features (in order) and replaces the values of each
+        feature by its [start, size] pair. Each feature is written as one numpy array, so the extra memory does not
+        depend on the size of the layer.
+
+        * @param {string} filepath Directory where the .data files are written
+        * @param {string} filename Id of the layer
+        * @param {List[object]} features Features of the layer ({'geometry': {...}})
+        * @param {List[string]} types Channels to write
+        * @param {List[string]} dataTypes struct format of each channel
+
+        Returns the encodings of the channels written narrower than dataTypes (indices as uint16 when they fit), to be
+        stored in the "encodings" entry of the layer.
+    '''
+
+    encodings = {}
+
+    for index, channel in enumerate(types):
+
+        dtype = np.dtype(dataTypes[index])
+        encoding = None
+
+        if(channel == 'indices'):
+            max_index = max((np.max(feature['geometry'][channel]) for feature in features if len(feature['geometry'][channel]) > 0), default=0)
+            encoding = index_encoding(max_index)
+
+        if(encoding != None):
+            encodings[channel] = encoding
+            dtype = np.dtype(encoding['dtype'])
+
+        sizes = np.fromiter((len(feature['geometry'][channel]) for feature in features), dtype=np.int64, count=len(features))
+        starts = np.cumsum(sizes) - sizes # where each vector starts
+
+        path = os.path.join(filepath, filename+'_'+channel+'.data')
+
+        cache._invalidate_channel(path)
+
+        with open(path, 'wb') as fout:
+            for i, feature in enumerate(features):
+                np.asarray(feature['geometry'][channel], dtype=dtype).tofile(fout)
+
+                feature['geometry'][channel] = [int(starts[i]), int(sizes[i])]
+
+    return encodings
+
+def is_thematic(layer_json):
+    '''
+        True if the .json describes a thematic layer (binary or with the values in the .json)
+    '''
+
+    return 'values' in layer_json or layer_json.get('channels', None) == list(THEMATIC_CHANNEL_TYPES)
+
+def write_thematic(filepath, coordinates, values, layer_id=None):
+    '''
+        Writes a thematic layer in the binary layout
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {np.ndarray} coordinates Flat x, y, z coordinates of the points
+        * @param {np.ndarray} values Value of each point
+        * @param {string} layer_id Id of the layer (file name without extension if None)
+    '''
+
+    if(layer_id == None):
+        layer_id = os.path.splitext(os.path.basename(filepath))[0]
+
+    coordinates = np.asarray(coordinates, dtype=np.dtype(THEMATIC_CHANNEL_TYPES['coordinates'])).ravel()
+    values = np.asarray(values, dtype=np.dtype(THEMATIC_CHANNEL_TYPES['values'])).ravel()
+
+    if(len(coordinates) != len(values)*3):
+        raise Exception("Thematic layers must have one value per point (3 coordinates)")
+
+    for channel, array in [('coordinates', coordinates), ('values', values)]:
+        path = channel_filepath(filepath, channel)
+        cache._invalidate_channel(path)
+        array.tofile(path)
+
+    with open(filepath, "w") as outfile:
+        outfile.write(json.dumps({"id": layer_id, "channels": list(THEMATIC_CHANNEL_TYPES), "count": len(values)}))
+
+    manifest.update_layer(filepath)
+
+def read_thematic(filepath, as_numpy=False, mmap=True, layer_json=None):
+    '''
+        Reads a thematic layer (binary or with the values in the .json) and returns {"id", "coordinates", "values"}
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {bool} as_numpy If True coordinates and values are numpy arrays instead of lists
+        * @param {bool} mmap If True the .data files are memory mapped (only used with as_numpy)
+        * @param {object} layer_json Contents of the .json, if already read
+    '''
+
+    if(layer_json == None):
+        with open(filepath, "r", encoding="utf-8") as f:
+            layer_json = json.load(f)
+
+    if('values' in layer_json):
+        layer = dict(layer_json)
+
+        if(as_numpy):
+            layer['coordinates'] = np.asarray(layer['coordinates'], dtype=np.float64)
+            layer['values'] = np.asarray(layer['values'])
+
+        return layer
+
+    layer = {"id": layer_json['id']}
+
+    for channel in THEMATIC_CHANNEL_TYPES:
+        values = read_channel(channel_filepath(filepath, channel), THEMATIC_CHANNEL_TYPES[channel], mmap=(as_numpy and mmap))
+        layer[channel] = values if as_numpy else values.tolist()
+
+    return layer
@@ -0,0 +1,238 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import cache
+
+'''
+    Chunked compressed container for channel files
+
+    A compressed <id>_<channel>.data keeps its name and starts with MAGIC. The values are split in chunks of
+    chunk_elements elements that are compressed independently, so a range of values (e.g. one feature) can be read
+    decompressing only the chunks that contain it.
+
+    Layout (little-endian):
+        header: MAGIC, version (uint8), codec (uint8), struct format of the values (1 char), unused (uint8), chunk_elements (uint32)
+        chunks: compressed bytes of each chunk
+        table: (byte offset, element count) of each chunk, two uint64 per chunk
+        trailer: number of chunks (uint64), number of elements (uint64), MAGIC
+'''
+
+MAGIC = b'UTKZ'
+VERSION = 1
+
+CODECS = {
+    'zlib': 1,
+    'zstd': 2
+}
+
+CHUNK_ELEMENTS = 1<<18
+
+# decompressed chunks kept by each CompressedChannel (features read one by one often share chunks)
+CACHED_CHUNKS = 8
+
+_HEADER = struct.Struct('<4sBBcBI')
+_TRAILER = struct.Struct('<QQ4s')
+
+def available_codecs():
+    '''
+        Codecs that can be used in this environment (zstd requires the zstandard package)
+    '''
+
+    if(zstandard != None):
+        return list(CODECS)
+
+    return ['zlib']
+
+def _compress(data, codec, level):
+
+    if(codec == 'zlib'):
+        return zlib.compress(data, 6 if level == None else level)
+
+    if(codec == 'zstd'):
+        if(zstandard == None):
+            raise Exception("zstd compression requires the zstandard package")
+
+        return zstandard.ZstdCompressor(level=3 if level == None else level).compress(data)
+
+    raise Exception("Compression codec "+str(codec)+" not supported. Use one of "+str(list(CODECS)))
+
+def _decompress(data, codec_id):
+
+    if(codec_id == CODECS['zlib']):
+        return zlib.decompress(data)
+
+    if(codec_id == CODECS['zstd']):
+        if(zstandard == None):
+            raise Exception("File compressed with zstd. Install the zstandard package to read it")
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise Exception("Unknown compression codec "+str(codec_id))
+
+def is_compressed(path):
+    '''
+        True if the file is a compressed container
+    '''
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def file_codec(path):
+    '''
+        Codec of a compressed container (None if the file is not compressed)
+    '''
+
+    if(not is_compressed(path)):
+        return None
+
+    codec_id = CompressedChannel(path).codec
+
+    return [name for name in CODECS if CODECS[name] == codec_id][0]
+
+def compress_file(path, fmt, codec='zlib', level=None, chunk_elements=CHUNK_ELEMENTS):
+    '''
+        Rewrites a channel file as a compressed container. The file is read chunk by chunk (memory mapped).
+
+        * @param {string} path Location of the .data file
+        * @param {string} fmt struct format of the values stored in the file
+        * @param {string} codec 'zlib' or 'zstd'
+        * @param {int} level Compression level (codec default if None)
+        * @param {int} chunk_elements Number of values per chunk
+    '''
+
+    if(is_compressed(path)):
+        return
+
+    cache._invalidate_channel(path)
+
+    dtype = np.dtype(fmt)
+
+    values = np.memmap(path, dtype=dtype, mode='r') if os.path.getsize(path) > 0 else np.empty(0, dtype=dtype)
+
+    table = []
+    tmp_path = path+'.tmp'
+
+    with open(tmp_path, 'wb') as fout:
+        fout.write(_HEADER.pack(MAGIC, VERSION, CODECS[codec], fmt.encode(), 0, chunk_elements))
+
+        for start in range(0, len(values), chunk_elements):
+            chunk = np.ascontiguousarray(values[start:start+chunk_elements])
+
+            table.append((fout.tell(), len(chunk)))
+            fout.write(_compress(chunk.tobytes(), codec, level))
+
+        np.array(table, dtype='<u8').reshape(-1, 2).tofile(fout)
+        fout.write(_TRAILER.pack(len(table), len(values), MAGIC))
+
+    del values
+
+    os.replace(tmp_path, path)
+
+class CompressedChannel:
+    '''
+        Reads values from a compressed container. Only the table is read when it is created.
+    '''
+
+    def __init__(self, path):
+        '''
+            * @param {string} path Location of the .data file
+        '''
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            magic, version, self.codec, fmt, _, self.chunk_elements = _HEADER.unpack(f.read(_HEADER.size))
+
+            if(magic != MAGIC or version != VERSION):
+                raise Exception("Not a compressed channel file: "+str(path))
+
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            chunk_count, self.length, _ = _TRAILER.unpack(f.read(_TRAILER.size))
+
+            table_offset = f.seek(-(_TRAILER.size + chunk_count*16), os.SEEK_END)
+            table = np.fromfile(f, dtype='<u8', count=chunk_count*2).reshape(-1, 2).astype(np.int64)
+
+        self.dtype = np.dtype(fmt.decode())
+
+        self._byte_offsets = np.append(table[:,0], table_offset) # chunk i is in [byte_offsets[i], byte_offsets[i+1])
+        self._element_offsets = np.concatenate(([0], np.cumsum(table[:,1])))
+
+        self._chunks = OrderedDict()
+
+    def __len__(self):
+        return self.length
+
+    def _read_chunks(self, first, last):
+
+        if(first == last and first in self._chunks):
+            self._chunks.move_to_end(first)
+            return [self._chunks[first]]
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._byte_offsets[first])
+            data = f.read(self._byte_offsets[last+1] - self._byte_offsets[first])
+
+        chunks = []
+
+        for i in range(first, last+1):
+            begin = self._byte_offsets[i] - self._byte_offsets[first]
+            end = self._byte_offsets[i+1] - self._byte_offsets[first]
+            chunks.append(np.frombuffer(_decompress(data[begin:end], self.codec), dtype=self.dtype))
+
+        if(first == last):
+            self._chunks[first] = chunks[0]
+
+            if(len(self._chunks) > CACHED_CHUNKS):
+                self._chunks.popitem(last=False)
+
+        return chunks
+
+    def read(self, start, stop):
+        '''
+            Values in [start, stop) decompressing only the chunks that contain them
+        '''
+
+        start = max(0, start)
+        stop = min(self.length, stop)
+
+        if(stop <= start):
+            return np.empty(0, dtype=self.dtype)
+
+        first = int(np.searchsorted(self._element_offsets, start, side='right')) - 1
+        last = int(np.searchsorted(self._element_offsets, stop, side='left')) - 1
+
+        values = np.concatenate(self._read_chunks(first, last))
+
+        offset = self._element_offsets[first]
+
+        return values[start-offset:stop-offset]
+
+    def read_all(self):
+        '''
+            All values of the channel
+        '''
+
+        if(self.length == 0):
+            return np.empty(0, dtype=self.dtype)
+
+        return np.concatenate(self._read_chunks(0, len(self._element_offsets)-2))
+
+def read_file_bytes(path):
+    '''
+        Raw (decompressed) bytes of a channel file, compressed or not. Used to serve the files to the frontend.
+    '''
+
+    if(is_compressed(path)):
+        return CompressedChannel(path).read_all().tobytes()
+
+    with open(path, 'rb') as f:
+        return f.read()
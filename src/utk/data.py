@@ -3,6 +3,8 @@ from .load_utk import *
 from .utils import *
 from .load_physical import *
 from .load_thematic import *
+from .parquet import *
+from .gltf import *
 
 try:
     # Avoid importing it in systems without optix
@@ -17,21 +19,14 @@ except:
 # loads any kind of data the type is determined by the extension
 def shadow(filespaths, intervals):
 
-    coordinates = []
+    layers = load_layers(filespaths, lazy=True, mmap=False) # decoded concurrently, and shared with the ShadowAccumulator through the channel cache
 
-    for filepath in filespaths:
-        layer_json = load_utk(filepath)
-        coordinates += get_coordinates(layer_json)
+    coordinates = np.concatenate([np.asarray(get_coordinates(layer), dtype=np.float64) for layer in layers]).reshape(-1, 3)
 
-    latitudes = []
-    longitudes = []
+    latitudes = coordinates[:,0]
+    longitudes = coordinates[:,1]
 
-    for i in range(int(len(coordinates)/3)):
-        
-        latitudes.append(coordinates[i*3])
-        longitudes.append(coordinates[i*3+1])
-
-    centroid = convert_projections('3395', '4326', [(min(longitudes) + max(longitudes))/2, (min(latitudes) + max(latitudes))/2])
+    centroid = convert_projections('3395', '4326', [(longitudes.min() + longitudes.max())/2, (latitudes.min() + latitudes.max())/2])
 
     shadowAccumulator = ShadowAccumulator(centroid[1], centroid[0], filespaths, intervals)
     shadowAccumulator.accumulate_shadow()
@@ -3,11 +3,24 @@ import geopandas as gpd
 import pandas as pd
 import numpy as np
 import os
-import struct
 
 from shapely.geometry import Polygon, Point
 from scipy.spatial import KDTree
 
+from . import channels
+from . import manifest
+from .layer_view import LayerView, decode_concurrently
+
+def _as_list(values):
+    '''
+        Values of a channel as a list (channels of LayerViews are numpy arrays, and indexing them value by value is slow)
+    '''
+
+    if(isinstance(values, np.ndarray)):
+        return values.tolist()
+
+    return values
+
 class FilesInterface:
     """
     Basic Urban Toolkit component
@@ -51,8 +64,13 @@ class FilesInterface:
 
         dimensions = 3
 
+        # the 3d coordinates of buildings stored in LayerViews are only read if a 3d join uses them (see _layerGdf)
+        lazy_coordinates3d = False
 
         if(not abstract):
+            if(isinstance(layer_json, LayerView) and layer_json.feature_count > 0 and 'sectionFootprint' in layer_json['data'][0]['geometry']):
+                lazy_coordinates3d = True
+
             if('sectionFootprint' in layer_json['data'][0]['geometry']): # hard coded buildings case. We want to consider the footprint for 2D joins not the whole building
                 dimensions = 2 
 
@@ -62,10 +80,13 @@ class FilesInterface:
 
                 polygon_coordinates = None
 
-                if('sectionFootprint' in elem['geometry']):
-                    polygon_coordinates = elem['geometry']['sectionFootprint'][0] # used for buildings
+                geometry = elem['geometry'] # LayerView features build their geometry on access, so it is fetched once
+                is_building = 'sectionFootprint' in geometry
+
+                if(is_building):
+                    polygon_coordinates = geometry['sectionFootprint'][0] # used for buildings
                 else:
-                    polygon_coordinates = elem['geometry']['coordinates']
+                    polygon_coordinates = _as_list(geometry['coordinates'])
 
                 for i in range(0,int(len(polygon_coordinates)/dimensions)):
                     geometries_coordinates.append(Point(polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1]))
@@ -74,14 +95,16 @@ class FilesInterface:
                     
                     groupedCoordinates.append((polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1]))
 
-                    if(dimensions == 3 and 'sectionFootprint' not in elem['geometry']): # if it has a 3d representation and it is not a building
+                    if(dimensions == 3 and not is_building): # if it has a 3d representation and it is not a building
                         tridimensional_coordinates.append([polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1], polygon_coordinates[i*dimensions+2]])
                         ids_tridimensional_coordinates.append(counter_id_tridimensional_coordinates)        
                         counter_id_tridimensional_coordinates += 1  
 
-                if('sectionFootprint' in elem['geometry']): # it is a building so a 3d representation must be included (it comes from the coordinates field)
-                    for i in range(0,int(len(elem['geometry']['coordinates'])/3)):
-                        tridimensional_coordinates.append([elem['geometry']['coordinates'][i*3], elem['geometry']['coordinates'][i*3+1], elem['geometry']['coordinates'][i*3+2]])
+                if(is_building and not lazy_coordinates3d): # it is a building so a 3d representation must be included (it comes from the coordinates field)
+                    building_coordinates = _as_list(geometry['coordinates'])
+
+                    for i in range(0,int(len(building_coordinates)/3)):
+                        tridimensional_coordinates.append([building_coordinates[i*3], building_coordinates[i*3+1], building_coordinates[i*3+2]])
                         ids_tridimensional_coordinates.append(counter_id_tridimensional_coordinates)        
                         counter_id_tridimensional_coordinates += 1  
 
@@ -110,91 +133,66 @@ class FilesInterface:
         else:
             df_coordinates3d = pd.DataFrame({'geometry': tridimensional_coordinates, 'id': ids_tridimensional_coordinates}) if len(tridimensional_coordinates) > 0 and len(ids_tridimensional_coordinates) > 0 else None
 
-        return {'objects': gdf, 'coordinates': gdf_coordinates, 'coordinates3d': df_coordinates3d}
-
-    def addLayerFromJsonFile(self, json_pathfile, gdf=None, abstract=False):
-        layer_json = []
-        layer_gdf = gdf
-
-        coordinates = []
-        normals = []
-        indices = []
-        ids = []
-
-        with open(json_pathfile, "r", encoding="utf-8") as f:
-            layer_json = json.load(f)
-
-        if(not abstract):
-
-            directory = os.path.dirname(json_pathfile)
-
-            # file name with extension
-            file_name = os.path.basename(json_pathfile)
-            # file name without extension
-            file_name_wo_extension = os.path.splitext(file_name)[0]
-
-            if('coordinates' in layer_json['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_coordinates.data'), "rb")
-
-                data = f.read()
+        if(lazy_coordinates3d):
+            df_coordinates3d = lambda: self._coordinates3d(layer_json)
 
-                unpacked_data = struct.iter_unpack('d', data)
-
-                for elem in unpacked_data:
-                    coordinates.append(elem[0])
+        return {'objects': gdf, 'coordinates': gdf_coordinates, 'coordinates3d': df_coordinates3d}
 
-                f.close()
-            if('normals' in layer_json['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_normals.data'), "rb")
+    def _coordinates3d(self, layer):
+        '''
+            3d coordinates of a LayerView (one row per vertex, in the order of the features)
+        '''
 
-                data = f.read()
+        coordinates = np.asarray(layer.gather('coordinates')).reshape(-1, 3)
 
-                unpacked_data = struct.iter_unpack('f', data)
+        if(len(coordinates) == 0):
+            return None
 
-                for elem in unpacked_data:
-                    normals.append(elem[0])
+        return pd.DataFrame({'geometry': coordinates.tolist(), 'id': np.arange(len(coordinates))})
 
-                f.close()
-            if('indices' in layer_json['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_indices.data'), "rb")
+    def _layerGdf(self, level, index):
+        '''
+            gdf of a level (objects, coordinates, coordinates3d) of a layer, built now if it was deferred
+        '''
 
-                data = f.read()
+        layer_gdf = self.layers['gdf'][level][index]
 
-                unpacked_data = struct.iter_unpack('I', data)
+        if(callable(layer_gdf)):
+            layer_gdf = layer_gdf()
+            self.layers['gdf'][level][index] = layer_gdf
 
-                for elem in unpacked_data:
-                    indices.append(elem[0])
+        return layer_gdf
 
-                f.close()
-            if('ids' in layer_json['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_ids.data'), "rb")
+    def _readLayer(self, json_pathfile, abstract):
+        if(not abstract):
+            return LayerView(json_pathfile) # channels are only read when they are used by the join
 
-                data = f.read()
+        return channels.read_thematic(json_pathfile) # binary or with the values in the .json
 
-                unpacked_data = struct.iter_unpack('I', data)
+    def addLayersFromJsonFiles(self, json_pathfiles, abstract=False):
+        '''
+            Adds several layers. The files are read and their channels decoded concurrently.
 
-                for elem in unpacked_data:
-                    ids.append(elem[0])
+            * @param {List[string]} json_pathfiles Location of the .json of the layers
+            * @param {bool | List[bool]} abstract If the layers are abstract (one value for all or one per layer)
+        '''
 
-                f.close()
+        if(not isinstance(abstract, list)):
+            abstract = [abstract]*len(json_pathfiles)
 
-            for i in range(len(layer_json['data'])):
+        layers = decode_concurrently(lambda task: self._readLayer(task[0], task[1]), list(zip(json_pathfiles, abstract)))
 
-                if(len(coordinates) > 0):
-                    startAndSize = layer_json['data'][i]['geometry']['coordinates']
-                    layer_json['data'][i]['geometry']['coordinates'] = coordinates[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+        # coordinates of the physical layers used by jsonToGdf (buildings only need their footprints, stored in the .json)
+        decode_concurrently(lambda layer: layer.channel('coordinates'), [layer for layer in layers if isinstance(layer, LayerView) and 'coordinates' in layer.channel_types and not (layer.feature_count > 0 and 'sectionFootprint' in layer['data'][0]['geometry'])])
 
-                if(len(indices) > 0):
-                    startAndSize = layer_json['data'][i]['geometry']['indices']
-                    layer_json['data'][i]['geometry']['indices'] = indices[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+        for json_pathfile, layer_abstract, layer_json in zip(json_pathfiles, abstract, layers):
+            self.addLayerFromJsonFile(json_pathfile, abstract=layer_abstract, layer_json=layer_json)
 
-                if(len(normals) > 0):
-                    startAndSize = layer_json['data'][i]['geometry']['normals']
-                    layer_json['data'][i]['geometry']['normals'] = normals[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+    def addLayerFromJsonFile(self, json_pathfile, gdf=None, abstract=False, layer_json=None):
+        layer_gdf = gdf
 
-                if(len(ids) > 0):
-                    startAndSize = layer_json['data'][i]['geometry']['ids']
-                    layer_json['data'][i]['geometry']['ids'] = ids[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+        if(layer_json is None):
+            layer_json = self._readLayer(json_pathfile, abstract)
 
         if(layer_gdf == None):
             layer_gdf = self.jsonToGdf(layer_json, None, abstract)
@@ -320,10 +318,10 @@ class FilesInterface:
         for i in range(len(self.layers['json'])):
             if self.layers['json'][i]['id'] == id_left_layer:
                 left_layer_json = self.layers['json'][i]
-                left_layer_gdf = self.layers['gdf'][left_level][i]
+                left_layer_gdf = self._layerGdf(left_level, i)
                 left_layer_found = True
             elif self.layers['json'][i]['id'] == id_right_layer:
-                right_layer_gdf = self.layers['gdf'][right_level][i]
+                right_layer_gdf = self._layerGdf(right_level, i)
                 right_layer_found = True
 
         if(left_layer_found == False or right_layer_found == False):
@@ -485,4 +483,6 @@ class FilesInterface:
         for fileName in self.joinedJson:
             with open(os.path.join(dir,fileName+".json"), "w", encoding="utf-8") as f:
                 joined_json_str = str(json.dumps(self.joinedJson[fileName]))
-                f.write(joined_json_str)
\ No newline at end of file
+                f.write(joined_json_str)
+
+        manifest.update_manifest(dir, [fileName+".json" for fileName in self.joinedJson])
\ No newline at end of file
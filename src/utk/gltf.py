@@ -0,0 +1,217 @@
+import os
+import json
+import struct
+import numpy as np
+
+from .load_utk import load_utk
+
+'''
+    Binary glTF (GLB) export of layers
+
+    Each layer becomes one mesh with one buffer view per channel:
+        POSITION: float32 coordinates relative to an origin (the node of the layer is translated by it, so the float64
+            coordinates of the layer keep their precision)
+        NORMAL: float32 normals
+        indices: uint16 or uint32 (the indices of the features are offset so they refer to the whole layer)
+        _FEATURE_ID: feature of each vertex (float32, custom attribute)
+        _ID: ids of each vertex (float32, custom attribute). Layers with one id per triangle (e.g. buildings) store them
+            in a uint32 accessor referenced by the "extras" of the primitive ({"triangleIds": accessor})
+
+    UTK layers are z-up and glTF is y-up, so the root node of the scene rotates the layers. glTF does not allow empty
+    accessors, so layers without vertices are not exported and a layer without triangles is exported as points.
+'''
+
+_GLB_MAGIC = 0x46546C67
+_JSON_CHUNK = 0x4E4F534A
+_BIN_CHUNK = 0x004E4942
+
+_FLOAT = 5126
+_UNSIGNED_SHORT = 5123
+_UNSIGNED_INT = 5125
+
+_ARRAY_BUFFER = 34962
+_ELEMENT_ARRAY_BUFFER = 34963
+
+# -90 degrees around x: z-up to y-up
+_Z_UP_TO_Y_UP = [-0.7071067811865476, 0, 0, 0.7071067811865476]
+
+class _GLBBuilder:
+    '''
+        Accumulates the buffer views and accessors of the binary chunk
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.buffer_views = []
+        self.accessors = []
+
+    def add(self, array, component_type, accessor_type, target=None, bounds=False):
+        '''
+            Adds one buffer view (4-byte aligned) with the array and an accessor to it. Returns the accessor index.
+        '''
+
+        if(len(array) == 0):
+            raise Exception("glTF accessors can not be empty")
+
+        data = np.ascontiguousarray(array).tobytes()
+
+        view = {"buffer": 0, "byteOffset": self.length, "byteLength": len(data)}
+        if(target != None):
+            view["target"] = target
+
+        self.chunks.append(data)
+        self.length += len(data)
+
+        padding = (4 - self.length % 4) % 4
+        self.chunks.append(b'\x00'*padding)
+        self.length += padding
+
+        self.buffer_views.append(view)
+
+        components = {"SCALAR": 1, "VEC3": 3}[accessor_type]
+
+        accessor = {
+            "bufferView": len(self.buffer_views)-1,
+            "componentType": component_type,
+            "count": len(array)//components,
+            "type": accessor_type
+        }
+
+        if(bounds and len(array) > 0):
+            values = np.asarray(array).reshape(-1, components)
+            accessor["min"] = values.min(axis=0).tolist()
+            accessor["max"] = values.max(axis=0).tolist()
+
+        self.accessors.append(accessor)
+
+        return len(self.accessors)-1
+
+def _layer_mesh(builder, layer, origin):
+    '''
+        Adds the channels of a layer to the builder and returns its mesh (None if the layer has no vertices)
+    '''
+
+    if('coordinates' not in layer.channel_types):
+        return None
+
+    coordinates = np.asarray(layer.gather('coordinates'), dtype=np.float64).reshape(-1, 3)
+    vertex_count = len(coordinates)
+
+    if(vertex_count == 0):
+        return None
+
+    _, coordinates_sizes = layer.offsets('coordinates')
+    vertices_per_feature = np.asarray(coordinates_sizes, dtype=np.int64)//3
+
+    positions = (coordinates - origin).astype(np.float32)
+
+    attributes = {"POSITION": builder.add(positions.ravel(), _FLOAT, "VEC3", _ARRAY_BUFFER, bounds=True)}
+
+    if('normals' in layer.channel_types):
+        normals = np.asarray(layer.gather('normals'), dtype=np.float32)
+
+        if(len(normals) == vertex_count*3):
+            attributes["NORMAL"] = builder.add(normals, _FLOAT, "VEC3", _ARRAY_BUFFER)
+
+    feature_ids = np.repeat(np.arange(len(vertices_per_feature), dtype=np.float32), vertices_per_feature)
+    attributes["_FEATURE_ID"] = builder.add(feature_ids, _FLOAT, "SCALAR", _ARRAY_BUFFER)
+
+    primitive = {"attributes": attributes, "mode": 0} # points
+
+    triangle_count = 0
+
+    indices = np.asarray(layer.gather('indices'), dtype=np.int64) if 'indices' in layer.channel_types else []
+
+    if(len(indices) > 0):
+        _, indices_sizes = layer.offsets('indices')
+
+        # indices are local to each feature
+        first_vertex = np.cumsum(vertices_per_feature) - vertices_per_feature
+        indices = indices + np.repeat(first_vertex, indices_sizes)
+
+        if(vertex_count < 65536):
+            primitive["indices"] = builder.add(indices.astype(np.uint16), _UNSIGNED_SHORT, "SCALAR", _ELEMENT_ARRAY_BUFFER)
+        else:
+            primitive["indices"] = builder.add(indices.astype(np.uint32), _UNSIGNED_INT, "SCALAR", _ELEMENT_ARRAY_BUFFER)
+
+        primitive["mode"] = 4 # triangles
+        triangle_count = len(indices)//3
+
+    if('ids' in layer.channel_types):
+        ids = layer.gather('ids')
+
+        if(len(ids) == vertex_count):
+            attributes["_ID"] = builder.add(np.asarray(ids, dtype=np.float32), _FLOAT, "SCALAR", _ARRAY_BUFFER)
+        elif(len(ids) == triangle_count and triangle_count > 0):
+            primitive["extras"] = {"triangleIds": builder.add(np.asarray(ids, dtype=np.uint32), _UNSIGNED_INT, "SCALAR")}
+
+    return {"name": layer['id'], "primitives": [primitive]}
+
+def to_glb(filepaths, output_filepath=None, origin=None):
+    '''
+        Writes one or more layers as a binary glTF file (one mesh per layer). Returns the location of the file.
+
+        * @param {string | List[string]} filepaths Location of the .json of the layers
+        * @param {string} output_filepath Location of the .glb file (next to the first layer if None)
+        * @param {List[float]} origin Origin of the float32 positions (center of the first layer with coordinates if None)
+    '''
+
+    if(isinstance(filepaths, str)):
+        filepaths = [filepaths]
+
+    layers = [load_utk(filepath, lazy=True) for filepath in filepaths] # channels are read as numpy arrays
+
+    if(origin == None):
+        located = [layer for layer in layers if 'coordinates' in layer.channel_types]
+        bounds = located[0].bounds() if len(located) > 0 else np.empty((0, 4))
+        bounds = bounds[bounds[:,0] <= bounds[:,2]]
+        origin = [0, 0, 0] if len(bounds) == 0 else [(bounds[:,0].min()+bounds[:,2].max())/2, (bounds[:,1].min()+bounds[:,3].max())/2, 0]
+
+    origin = np.asarray(origin, dtype=np.float64)
+
+    builder = _GLBBuilder()
+
+    meshes = [_layer_mesh(builder, layer, origin) for layer in layers]
+    meshes = [mesh for mesh in meshes if mesh != None] # layers without vertices
+
+    nodes = [{"name": "utk", "rotation": _Z_UP_TO_Y_UP, "translation": [float(origin[0]), float(origin[2]), float(-origin[1])]}]
+    nodes += [{"name": mesh["name"], "mesh": index} for index, mesh in enumerate(meshes)]
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "utk"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": nodes,
+        "extras": {"origin": origin.tolist()}
+    }
+
+    # empty arrays (and a buffer of 0 bytes) are not allowed
+    if(len(meshes) > 0):
+        nodes[0]["children"] = list(range(1, len(meshes)+1))
+
+        gltf["meshes"] = meshes
+        gltf["accessors"] = builder.accessors
+        gltf["bufferViews"] = builder.buffer_views
+        gltf["buffers"] = [{"byteLength": builder.length}]
+
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' '*((4 - len(json_chunk) % 4) % 4)
+
+    if(output_filepath == None):
+        output_filepath = os.path.splitext(filepaths[0])[0]+'.glb'
+
+    bin_length = 8 + builder.length if builder.length > 0 else 0
+
+    with open(output_filepath, 'wb') as f:
+        f.write(struct.pack('<III', _GLB_MAGIC, 2, 12 + 8 + len(json_chunk) + bin_length))
+        f.write(struct.pack('<II', len(json_chunk), _JSON_CHUNK))
+        f.write(json_chunk)
+
+        if(builder.length > 0):
+            f.write(struct.pack('<II', builder.length, _BIN_CHUNK))
+
+            for chunk in builder.chunks:
+                f.write(chunk)
+
+    return output_filepath
@@ -0,0 +1,433 @@
+import os
+import json
+import numpy as np
+
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from . import channels
+from . import compression
+from . import manifest
+from . import spatial_index
+
+# threads used to read and decode channels (numpy, zlib and file reads release the GIL)
+DECODE_THREADS = min(8, os.cpu_count() or 1)
+
+def decode_concurrently(function, items, threads=DECODE_THREADS):
+    '''
+        Calls function for each item in a pool of threads and returns the results in order
+    '''
+
+    items = list(items)
+
+    if(threads <= 1 or len(items) <= 1):
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(items))) as executor:
+        return list(executor.map(function, items))
+
+class LayerView(Mapping):
+    '''
+        Lazy view of a physical layer stored in the binary layout.
+
+        It can be used as the json returned by load_utk (e.g. layer['data'][i]['geometry']['coordinates']), but the
+        channels are only read when a feature or the whole channel is accessed. Channel values are numpy arrays.
+
+        Both offset layouts are supported: [start, size] pairs in the .json and the _offsets.data sidecar.
+
+        Features deleted with a tombstone ("tombstones" in the .json, see layer_writer.delete_from_layer) are skipped, so
+        indices always refer to the live features.
+    '''
+
+    def __init__(self, filepath, mmap=True, header=None):
+        '''
+            * @param {string} filepath Location of the .json of the layer
+            * @param {bool} mmap If True the .data files are memory mapped instead of read into memory
+            * @param {object} header Header of the layer, if it was not written to filepath yet
+        '''
+
+        self.filepath = filepath
+        self.mmap = mmap
+
+        if(header != None):
+            self.header = header
+        else:
+            with open(filepath, "r", encoding="utf-8") as f:
+                self.header = json.load(f)
+
+        self.channel_types = channels.layer_channels(self.header)
+
+        self._channels = {}
+        self._offsets = {}
+        self._offsets_matrix = None
+        self._compressed = {}
+        self._rtree = None
+        self._live = None
+        self._features = _FeatureList(self)
+
+        if('tombstones' in self.header and len(self.header['tombstones']) > 0):
+            self._live = np.setdiff1d(np.arange(self.physical_count), np.array(self.header['tombstones'], dtype=np.int64))
+
+    def __getitem__(self, key):
+        if(key == 'data' and self.has_features):
+            return self._features
+
+        return self.header[key]
+
+    def __contains__(self, key):
+        return key in self.header or (key == 'data' and self.has_features)
+
+    def __iter__(self):
+        if('offsets' in self.header and 'data' not in self.header):
+            return iter(list(self.header)+['data'])
+
+        return iter(self.header)
+
+    def __len__(self):
+        return len(self.header) + (1 if 'offsets' in self.header and 'data' not in self.header else 0)
+
+    def __repr__(self):
+        return 'LayerView(%r, features=%d, channels=%s)'%(self.filepath, self.feature_count, list(self.channel_types))
+
+    @property
+    def has_features(self):
+        return 'data' in self.header or 'offsets' in self.header
+
+    @property
+    def physical_count(self):
+        '''
+            Number of features stored in the files, including the deleted ones
+        '''
+
+        if('offsets' in self.header):
+            return self.header['offsets']['count']
+
+        if('data' not in self.header):
+            return 0
+
+        return len(self.header['data'])
+
+    @property
+    def feature_count(self):
+        if(self._live is not None):
+            return len(self._live)
+
+        return self.physical_count
+
+    def physical_index(self, index):
+        '''
+            Position in the files of a live feature
+        '''
+
+        if(self._live is not None):
+            return int(self._live[index])
+
+        return index
+
+    def feature_header(self, index):
+        '''
+            Fields of a feature stored in the .json (without the channel offsets of the sidecar layout)
+        '''
+
+        if('data' in self.header):
+            return self.header['data'][self.physical_index(index)]
+
+        return {'geometry': {}}
+
+    def channel(self, name):
+        '''
+            Flat array with the values of a channel (decoded if the channel is encoded). Read on first access.
+        '''
+
+        if(name not in self.channel_types):
+            raise KeyError('Layer does not have a '+name+' field')
+
+        if(name not in self._channels):
+            self._channels[name] = channels.read_channel(channels.channel_filepath(self.filepath, name), self.channel_types[name], mmap=self.mmap,
+                channel=name, encoding=channels.channel_encoding(self.header, name))
+
+        return self._channels[name]
+
+    def close(self):
+        '''
+            Drops the arrays (memory maps) of the layer and their entries in the channel cache, so its files can be
+            replaced or truncated. The files are read again if the view is used after this call.
+        '''
+
+        for path in manifest.layer_files(self.filepath):
+            cache._invalidate_channel(path)
+
+        self._channels = {}
+        self._offsets = {}
+        self._offsets_matrix = None
+        self._compressed = {}
+        self._rtree = None
+
+    def load_channels(self, names=None, threads=DECODE_THREADS):
+        '''
+            Reads and decodes channels (all if names is None) concurrently, so later accesses do not wait for them.
+            Returns the view.
+        '''
+
+        if(names == None):
+            names = list(self.channel_types)
+
+        decode_concurrently(self.channel, [name for name in names if name not in self._channels], threads)
+
+        return self
+
+    def offsets(self, name):
+        '''
+            Start and size of every feature in a channel
+        '''
+
+        if(name not in self._offsets):
+
+            if('offsets' in self.header):
+                row = self._offsets_row(name)
+                starts, sizes = row[:-1].astype(np.int64), np.diff(row).astype(np.int64)
+            else:
+                starts, sizes = channels.channel_offsets(self.header, name)
+
+            if(self._live is not None):
+                starts, sizes = starts[self._live], sizes[self._live]
+
+            self._offsets[name] = (starts, sizes)
+
+        return self._offsets[name]
+
+    def _offsets_row(self, name):
+
+        if(self._offsets_matrix is None):
+            self._offsets_matrix = channels.read_offsets(self.filepath, self.header, mmap=self.mmap)
+
+        return self._offsets_matrix[self.header['offsets']['channels'].index(name)]
+
+    def feature_channel(self, index, name):
+        '''
+            Values of one channel of one feature (a view into the channel array)
+        '''
+
+        if(name not in self.channel_types):
+            raise KeyError('Layer does not have a '+name+' field')
+
+        index = self.physical_index(index)
+
+        if('offsets' in self.header):
+            row = self._offsets_row(name)
+            start = int(row[index])
+            size = int(row[index+1]) - start
+        else:
+            start, size = self.header['data'][index]['geometry'][name]
+
+        if(name not in self._channels and self._compressed_channel(name) != None): # only the chunks of the feature are decompressed
+            encoding = channels.channel_encoding(self.header, name)
+            stored_start, stored_size = channels.stored_range(encoding, start, size)
+
+            values = self._compressed[name].read(stored_start, stored_start+stored_size)
+
+            return channels.decode_channel(values, name, encoding)
+
+        return self.channel(name)[start:start+size]
+
+    def _compressed_channel(self, name):
+
+        if(name not in self._compressed):
+            path = channels.channel_filepath(self.filepath, name)
+            self._compressed[name] = compression.CompressedChannel(path) if compression.is_compressed(path) else None
+
+        return self._compressed[name]
+
+    def gather(self, name):
+        '''
+            Values of a channel concatenated in the order of the features
+        '''
+
+        values = self.channel(name)
+        starts, sizes = self.offsets(name)
+
+        if(len(starts) == 0):
+            return values[:0]
+
+        # features written by break_into_binary are contiguous and in order
+        contiguous_starts = np.concatenate(([0], np.cumsum(sizes[:-1])))
+        if(np.array_equal(starts, contiguous_starts) and starts[-1]+sizes[-1] == len(values)):
+            return values
+
+        return np.concatenate([values[start:start+size] for start, size in zip(starts, sizes)])
+
+    def bounds(self):
+        '''
+            2D bounding box (minx, miny, maxx, maxy) of every feature
+        '''
+
+        _, sizes = self.offsets('coordinates')
+
+        return spatial_index.feature_bounds(self.gather('coordinates'), sizes)
+
+    def write_index(self, node_size=spatial_index.NODE_SIZE):
+        '''
+            Writes the spatial index of the layer (see spatial_index) and adds its entry to the header.
+            The header has to be written after this call.
+        '''
+
+        if('coordinates' not in self.channel_types):
+            return
+
+        self.header['rtree'] = spatial_index.write_rtree(self.filepath, self.bounds(), node_size)
+        self._rtree = None
+
+    def query(self, bbox):
+        '''
+            Features whose bounding box intersects bbox ([minx, miny, maxx, maxy] in the coordinates of the layer), sorted.
+            Uses the spatial index if the layer has one.
+        '''
+
+        if('rtree' in self.header):
+            if(self._rtree == None):
+                self._rtree = spatial_index.RTree.read(self.filepath, self.header, mmap=self.mmap)
+
+            found = self._rtree.search(bbox) # positions in the files
+
+            if(self._live is None):
+                return found
+
+            found = found[np.isin(found, self._live, assume_unique=True)]
+
+            return np.searchsorted(self._live, found)
+
+        bounds = self.bounds()
+        minx, miny, maxx, maxy = bbox
+
+        return np.nonzero((bounds[:,0] <= maxx) & (bounds[:,1] <= maxy) & (bounds[:,2] >= minx) & (bounds[:,3] >= miny))[0]
+
+    def source_order(self):
+        '''
+            Position each feature had before the layer was sorted along a space filling curve (see spatial_index)
+        '''
+
+        if('order' not in self.header):
+            order = np.arange(self.physical_count)
+        else:
+            order = channels.read_channel(channels.channel_filepath(self.filepath, spatial_index.ORDER_CHANNEL), 'I', mmap=self.mmap)
+
+        if(self._live is not None):
+            return order[self._live]
+
+        return order
+
+    def to_json(self, as_numpy=False, features=None):
+        '''
+            Returns the layer as a json object (same output as load_utk) decoding all channels
+
+            * @param {bool} as_numpy If True the channels of each feature are numpy arrays
+            * @param {List[int]} features Only these features are returned (and read). All if None
+        '''
+
+        layer_json = {key: value for key, value in self.header.items() if key not in ['data', 'offsets', 'encodings', 'indexType', 'rtree', 'order', 'tombstones']}
+
+        if(not self.has_features):
+            return layer_json
+
+        if(features is None):
+            features = range(self.feature_count)
+
+        layer_json['data'] = []
+
+        for index in features:
+            feature = self.feature_header(index)
+            new_feature = feature.copy()
+            new_feature['geometry'] = feature['geometry'].copy()
+            layer_json['data'].append(new_feature)
+
+        if(not isinstance(features, range)): # only the ranges of the selected features are read
+            for name in self.channel_types:
+                for i, feature in zip(features, layer_json['data']):
+                    feature_values = self.feature_channel(i, name)
+
+                    if(as_numpy):
+                        feature['geometry'][name] = feature_values
+                    else:
+                        feature['geometry'][name] = feature_values.tolist()
+
+            return layer_json
+
+        for name in self.channel_types:
+
+            values = self.channel(name)
+            starts, sizes = self.offsets(name)
+
+            for i, feature in enumerate(layer_json['data']):
+                feature_values = values[starts[i]:starts[i]+sizes[i]]
+
+                if(as_numpy):
+                    feature['geometry'][name] = feature_values
+                else:
+                    feature['geometry'][name] = feature_values.tolist()
+
+        return layer_json
+
+class _FeatureList(Sequence):
+
+    def __init__(self, layer):
+        self._layer = layer
+
+    def __len__(self):
+        return self._layer.feature_count
+
+    def __getitem__(self, index):
+        if(isinstance(index, slice)):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if(index < 0):
+            index += len(self)
+
+        if(index < 0 or index >= len(self)):
+            raise IndexError('feature index out of range')
+
+        return _Feature(self._layer, index)
+
+class _Feature(Mapping):
+
+    def __init__(self, layer, index):
+        self._layer = layer
+        self._index = index
+        self._header = layer.feature_header(index)
+
+    def __getitem__(self, key):
+        if(key == 'geometry'):
+            return _Geometry(self._layer, self._index)
+
+        return self._header[key]
+
+    def __contains__(self, key):
+        return key in self._header
+
+    def __iter__(self):
+        return iter(self._header)
+
+    def __len__(self):
+        return len(self._header)
+
+class _Geometry(Mapping):
+
+    def __init__(self, layer, index):
+        self._layer = layer
+        self._index = index
+        self._header = layer.feature_header(index)['geometry']
+
+    def __getitem__(self, key):
+        if(key in self._layer.channel_types):
+            return self._layer.feature_channel(self._index, key)
+
+        return self._header[key]
+
+    def __contains__(self, key):
+        return key in self._layer.channel_types or key in self._header
+
+    def __iter__(self):
+        return iter(list(self._layer.channel_types) + [key for key in self._header if key not in self._layer.channel_types])
+
+    def __len__(self):
+        return len(set(self._layer.channel_types) | set(self._header))
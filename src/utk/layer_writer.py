@@ -0,0 +1,459 @@
+import json
+import os
+import numpy as np
+
+from . import cache
+from . import channels
+from . import compression
+from . import manifest
+from . import spatial_index
+from .layer_view import LayerView
+
+class LayerWriter:
+    '''
+        Writes a physical layer feature by feature.
+
+        The values of each channel are streamed to <layer_id>_<channel>.data as the features are appended, only the
+        [start, size] pairs (and the extra geometry fields) are kept in memory. The .json is written last, in close().
+
+        If offsets_sidecar is True the pairs are written to <layer_id>_offsets.data (see channels) instead of the .json.
+
+        encodings maps channels to the encoding used to store them (see channels.CHANNEL_ENCODINGS), e.g. {'coordinates': 'rtc'}
+        stores float32 coordinates relative to a float64 origin (origin, or the first vertex of the layer if not given).
+
+        If narrow_indices is True (default) and the indices are not encoded, the indices are stored as uint16 when they fit
+        (decided in close(), for the whole layer).
+
+        If compression is 'zlib' or 'zstd' the channel files are compressed in chunks when the layer is closed (see compression).
+
+        If build_index is True the bounding boxes of the features are kept and the spatial index of the layer is written in close()
+        (see spatial_index).
+
+        Usage:
+            writer = LayerWriter(directory, 'buildings', 'BUILDINGS_LAYER', ['SMOOTH_COLOR_MAP_TEX'], 'building')
+            writer.open()
+            writer.append_feature(coordinates, indices, normals, ids, extra={'sectionFootprint': footprint})
+            writer.close()
+    '''
+
+    def __init__(self, directory, layer_id, type='TRIANGLES_3D_LAYER', renderStyle=['FLAT_COLOR'], styleKey='surface', offsets_sidecar=False, encodings=None, origin=None, narrow_indices=True, compression=None, build_index=True):
+
+        self.directory = directory
+        self.layer_id = layer_id
+        self.type = type
+        self.renderStyle = renderStyle
+        self.styleKey = styleKey
+        self.offsets_sidecar = offsets_sidecar
+        self.encodings = encodings if encodings != None else {}
+        self.origin = origin
+        self.narrow_indices = narrow_indices
+        self.compression = compression
+        self.build_index = build_index
+
+        self.filepath = os.path.join(directory, layer_id+'.json')
+
+        self._files = None
+        self._sizes = {}
+        self._feature_sizes = {}
+        self._encodings = {}
+        self._max_index = 0
+        self._bounds = []
+        self._features = []
+        self._channels = None # defined by the first feature
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if(exc_type != None):
+            self._close_files()
+        else:
+            self.close()
+
+    def open(self):
+
+        if(not os.path.exists(self.directory)):
+            os.makedirs(self.directory)
+
+        self._files = {}
+        self._sizes = {}
+        self._feature_sizes = {}
+        self._encodings = {}
+        self._max_index = 0
+        self._bounds = []
+        self._features = []
+        self._channels = None
+
+        return self
+
+    def append_feature(self, coordinates=None, indices=None, normals=None, ids=None, extra=None):
+        '''
+            Appends one feature to the layer. All features must have the same channels.
+
+            * @param {List[float]} coordinates Flat list/array of coordinates
+            * @param {List[int]} indices Flat list/array of indices (local to the feature)
+            * @param {List[float]} normals Flat list/array of normals
+            * @param {List[int]} ids Flat list/array of ids
+            * @param {object} extra Other geometry fields stored in the .json (e.g. sectionFootprint)
+        '''
+
+        values = {'coordinates': coordinates, 'normals': normals, 'indices': indices, 'ids': ids}
+
+        self._append({channel: values[channel] for channel in values if values[channel] is not None}, extra)
+
+    def append_features(self, features):
+        '''
+            Appends features in the json format used by the layers ({'geometry': {'coordinates': [...], ...}})
+        '''
+
+        for feature in features:
+            geometry = feature['geometry']
+
+            values = {channel: geometry[channel] for channel in channels.CHANNEL_TYPES if channel in geometry}
+            extra = {key: geometry[key] for key in geometry if key not in values}
+            properties = {key: feature[key] for key in feature if key != 'geometry'}
+
+            self._append(values, extra, properties)
+
+    def _append(self, values, extra=None, properties=None):
+
+        if(self._files == None):
+            raise Exception("LayerWriter must be opened before appending features")
+
+        if(self._channels == None):
+            self._channels = [channel for channel in channels.CHANNEL_TYPES if channel in values]
+        elif(set(values) != set(self._channels)):
+            raise Exception("All features of a layer must have the same channels: "+str(self._channels))
+
+        geometry = {}
+
+        for channel in self._channels:
+
+            array = np.asarray(values[channel], dtype=np.dtype(channels.CHANNEL_TYPES[channel])).ravel()
+
+            if(channel not in self._files):
+                path = channels.channel_filepath(self.filepath, channel)
+                cache._invalidate_channel(path)
+                self._files[channel] = open(path, 'wb')
+                self._sizes[channel] = 0
+                self._feature_sizes[channel] = []
+
+                if(channel in self.encodings):
+                    self._encodings[channel] = channels.new_encoding(channel, self.encodings[channel], array, self.origin)
+
+            if(channel == 'indices' and len(array) > 0):
+                self._max_index = max(self._max_index, int(array.max()))
+
+            if(channel == 'coordinates' and self.build_index):
+                self._bounds.append(spatial_index.feature_bounds(array, [len(array)])[0])
+
+            channels.encode_channel(array, self._encodings.get(channel)).tofile(self._files[channel])
+
+            if(self.offsets_sidecar):
+                self._feature_sizes[channel].append(len(array))
+            else:
+                geometry[channel] = [self._sizes[channel], len(array)] # where this vector starts and its size
+
+            self._sizes[channel] += len(array)
+
+        if(extra != None):
+            geometry.update(extra)
+
+        feature = {}
+
+        if(properties != None):
+            feature.update(properties)
+
+        feature['geometry'] = geometry
+
+        self._features.append(feature)
+
+    def _close_files(self):
+
+        if(self._files == None):
+            return
+
+        for channel in self._files:
+            self._files[channel].close()
+
+        self._files = None
+
+    def close(self):
+        '''
+            Closes the channel files and writes the .json of the layer. Returns the layer header.
+        '''
+
+        self._close_files()
+
+        if(self.narrow_indices and self._channels != None and 'indices' in self._channels and 'indices' not in self._encodings):
+            encoding = channels.index_encoding(self._max_index)
+
+            if(encoding != None):
+                channels.narrow_channel_file(channels.channel_filepath(self.filepath, 'indices'), channels.CHANNEL_TYPES['indices'], encoding)
+                self._encodings['indices'] = encoding
+
+        layer = {
+            "id": self.layer_id,
+            "type": self.type,
+            "renderStyle": self.renderStyle,
+            "styleKey": self.styleKey,
+            "data": self._features
+        }
+
+        if(len(self._encodings) > 0):
+            layer['encodings'] = self._encodings
+
+        channels.set_index_type(layer, self._channels if self._channels != None else [])
+
+        if(self.build_index and self._channels != None and 'coordinates' in self._channels):
+            layer['rtree'] = spatial_index.write_rtree(self.filepath, np.array(self._bounds))
+            self._bounds = []
+
+        if(self.offsets_sidecar):
+            channel_names = self._channels if self._channels != None else []
+
+            channels.write_offsets(self.filepath, [self._feature_sizes[channel] for channel in channel_names])
+
+            layer['offsets'] = {"channels": channel_names, "count": len(self._features)}
+
+            if(all(len(feature) == 1 and len(feature['geometry']) == 0 for feature in self._features)): # nothing besides the offsets
+                del layer['data']
+
+        with open(self.filepath, "w") as outfile:
+            outfile.write(json.dumps(layer))
+
+        if(self.compression != None):
+            channels.compress_layer(self.filepath, layer, self.compression)
+
+        manifest.update_layer(self.filepath)
+
+        self._features = []
+
+        return layer
+
+# entries of the header that describe the files of the layer, written again by _rewrite_layer
+_LAYOUT_KEYS = ['id', 'data', 'encodings', 'indexType', 'offsets', 'rtree', 'order', 'tombstones']
+
+def _rewrite_layer(filepath, layer, features, order_header=None):
+    '''
+        Writes the given live features of a layer (in that order) to new files that replace the ones of the layer. The offsets
+        layout, encodings and compression are kept and the spatial index is rebuilt.
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {LayerView} layer View of the layer
+        * @param {np.ndarray} features Live features to write, in the new order
+        * @param {object} order_header "order" entry of the new header (None if the layer is not sorted)
+    '''
+
+    directory = os.path.dirname(filepath)
+    layer_id = layer['id']
+    tmp_id = layer_id+'.rewrite'
+
+    encodings = {}
+    origin = None
+
+    for channel, encoding in layer.header.get('encodings', {}).items():
+        if(encoding['type'] == 'rtc'):
+            origin = encoding['origin']
+
+        if(encoding['type'] != 'uint16'): # chosen again by the writer
+            encodings[channel] = encoding['type']
+
+    codec = None
+
+    if(len(layer.channel_types) > 0):
+        codec = compression.file_codec(channels.channel_filepath(filepath, list(layer.channel_types)[0]))
+
+    source_order = np.asarray(layer.source_order())[features] if order_header != None else None
+
+    with manifest.batch(): # one manifest update, without the temporary files
+        writer = LayerWriter(directory, tmp_id, layer['type'], layer['renderStyle'], layer['styleKey'], offsets_sidecar=('offsets' in layer.header),
+            encodings=encodings, origin=origin, compression=codec).open()
+
+        for index in np.asarray(features).tolist():
+            feature = layer.feature_header(index)
+
+            values = {channel: layer.feature_channel(index, channel) for channel in layer.channel_types}
+            extra = {key: feature['geometry'][key] for key in feature['geometry'] if key not in layer.channel_types}
+            properties = {key: feature[key] for key in feature if key != 'geometry'}
+
+            writer._append(values, extra, properties)
+
+        header = writer.close()
+
+        # the other entries of the header (e.g. added by the user or by tiles) are not about the files and are kept
+        for key, value in layer.header.items():
+            if(key not in _LAYOUT_KEYS and key not in header):
+                header[key] = value
+
+        layer.close() # the memory mapped files are released before they are replaced
+
+        # the written files replace the ones of the layer
+        tmp_filepath = os.path.join(directory, tmp_id+'.json')
+
+        for name in list(channels.CHANNEL_TYPES) + ['offsets', spatial_index.RTREE_CHANNEL, spatial_index.RTREE_IDS_CHANNEL]:
+            tmp_path = channels.channel_filepath(tmp_filepath, name)
+
+            if(os.path.exists(tmp_path)):
+                path = channels.channel_filepath(filepath, name)
+                cache._invalidate_channel(path)
+                os.replace(tmp_path, path)
+
+        header['id'] = layer_id
+
+        if(order_header != None):
+            spatial_index.write_order(filepath, source_order)
+            header['order'] = order_header
+
+        with open(filepath, "w") as outfile:
+            outfile.write(json.dumps(header))
+
+        os.remove(tmp_filepath)
+
+        manifest.update_layer(filepath) # the entries of the temporary files, recorded by the writer, are dropped as they are gone
+
+def reorder_layer(filepath, curve='hilbert'):
+    '''
+        Rewrites a layer with its features sorted along a space filling curve ('hilbert' or 'zorder'), so neighbouring
+        features are close in the .data files. The offsets layout, encodings, compression and spatial index of the layer
+        are kept, and <id>_order.data stores the position each feature had in the source (see spatial_index).
+
+        * @param {string} filepath Location of the .json of the layer
+    '''
+
+    layer = LayerView(filepath)
+
+    if('coordinates' not in layer.channel_types):
+        raise Exception("Only layers with coordinates can be reordered")
+
+    _rewrite_layer(filepath, layer, spatial_index.curve_order(layer.bounds(), curve), {"curve": curve})
+
+def compact_layer(filepath):
+    '''
+        Rewrites the files of a layer once, dropping the features deleted with delete_from_layer and the values left
+        unreferenced by them
+
+        * @param {string} filepath Location of the .json of the layer
+    '''
+
+    layer = LayerView(filepath)
+
+    _rewrite_layer(filepath, layer, np.arange(layer.feature_count), layer.header.get('order'))
+
+def delete_from_layer(filepath, ids):
+    '''
+        Deletes features of a layer with tombstones. Only the .json is rewritten, the values stay in the .data files until
+        compact_layer is called.
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {List[int]} ids Features to delete (indices of the live features)
+    '''
+
+    layer = LayerView(filepath)
+
+    tombstones = set(layer.header.get('tombstones', []))
+
+    for index in ids:
+        if(index < 0 or index >= layer.feature_count):
+            raise Exception("Feature "+str(index)+" does not exist")
+
+        tombstones.add(layer.physical_index(index))
+
+    layer.header['tombstones'] = sorted(tombstones)
+
+    with open(filepath, "w") as outfile:
+        outfile.write(json.dumps(layer.header))
+
+    manifest.update_layer(filepath)
+
+def append_to_layer(filepath, features):
+    '''
+        Appends features to a layer. Their values are added at the end of the .data files (encoded like the rest of the
+        channel) and only the offsets are rewritten. The spatial index is dropped until compact_layer is called.
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {List[object]} features Features in the json format of the layers ({'geometry': {'coordinates': [...], ...}})
+    '''
+
+    layer = LayerView(filepath)
+    header = layer.header
+
+    for channel in layer.channel_types:
+        if(compression.is_compressed(channels.channel_filepath(filepath, channel))):
+            raise Exception("Features cannot be appended to compressed channels. Write the layer without compression")
+
+    count = layer.physical_count
+    channel_names = list(layer.channel_types)
+
+    if(count == 0 or len(channel_names) == 0):
+        raise Exception("Features can only be appended to layers that already have features")
+
+    sizes = {channel: [] for channel in channel_names}
+    lengths = {} # decoded values already in each channel file
+    new_features = []
+
+    for channel in channel_names:
+        stored = os.path.getsize(channels.channel_filepath(filepath, channel)) // np.dtype(layer.channel_types[channel]).itemsize
+        lengths[channel] = channels.decoded_length(channels.channel_encoding(header, channel), stored)
+
+    previous_offsets = channels.read_offsets(filepath, header, mmap=False) if 'offsets' in header else None
+    previous_order = channels.read_channel(channels.channel_filepath(filepath, spatial_index.ORDER_CHANNEL), 'I', mmap=False) if 'order' in header else None
+
+    for feature in features:
+        geometry = feature['geometry']
+
+        if(set(channel_names) - set(geometry)):
+            raise Exception("All features of a layer must have the same channels: "+str(channel_names))
+
+        new_geometry = {key: geometry[key] for key in geometry if key not in channel_names}
+
+        for channel in channel_names:
+            values = np.asarray(geometry[channel], dtype=np.dtype(channels.CHANNEL_TYPES[channel])).ravel()
+            encoding = channels.channel_encoding(header, channel)
+            path = channels.channel_filepath(filepath, channel)
+
+            if(encoding != None and encoding['type'] == 'uint16' and len(values) > 0 and values.max() > np.iinfo(np.uint16).max):
+                channels.widen_channel_file(path, encoding['dtype'], channels.CHANNEL_TYPES[channel]) # indices do not fit anymore
+                del header['encodings'][channel]
+                encoding = None
+
+            cache._invalidate_channel(path)
+
+            with open(path, 'ab') as fout:
+                channels.encode_channel(values, encoding).tofile(fout)
+
+            if('offsets' not in header):
+                new_geometry[channel] = [lengths[channel], len(values)]
+
+            lengths[channel] += len(values)
+            sizes[channel].append(len(values))
+
+        new_feature = {key: feature[key] for key in feature if key != 'geometry'}
+        new_feature['geometry'] = new_geometry
+        new_features.append(new_feature)
+
+    channels.set_index_type(header, channel_names) # the indices may have been widened
+
+    if('offsets' in header):
+        channels.write_offsets(filepath, [np.diff(previous_offsets[index]).tolist() + sizes[channel] for index, channel in enumerate(header['offsets']['channels'])])
+        header['offsets']['count'] = count + len(new_features)
+
+        if('data' in header or any(len(feature) > 1 or len(feature['geometry']) > 0 for feature in new_features)):
+            header['data'] = header.get('data', [{'geometry': {}} for index in range(count)]) + new_features
+    else:
+        header['data'] += new_features
+
+    if('order' in header): # appended features come after the source features
+        spatial_index.write_order(filepath, np.concatenate((previous_order, np.arange(count, count+len(new_features)))))
+
+    if('rtree' in header):
+        for channel in [spatial_index.RTREE_CHANNEL, spatial_index.RTREE_IDS_CHANNEL]:
+            os.remove(channels.channel_filepath(filepath, channel))
+
+        del header['rtree']
+
+    with open(filepath, "w") as outfile:
+        outfile.write(json.dumps(header))
+
+    manifest.update_layer(filepath)
@@ -4,60 +4,43 @@ import geopandas as gpd
 import numpy as np
 import json
 import mapbox_earcut as earcut
-import struct
 from .utils import *
+from . import channels
+from . import manifest
+from .layer_writer import LayerWriter
+from .layer_view import LayerView
 from shapely import wkt
 
 from shapely.geometry import Point, Polygon
 
 def break_into_binary(filepath, filename, data, types, dataTypes, type='TRIANGLES_3D_LAYER', renderStyle=['FLAT_COLOR'], styleKey='surface'):
 
-    for index, element in enumerate(types):
-
-        readCoords = 0
-
-        floatList = []
-
-        if('data' in data):
-            for i in range(len(data['data'])):
-                geometry = data['data'][i]['geometry']
-
-                newValue = [readCoords, len(geometry[element])] # where this vector starts and its size
-
-                readCoords += len(geometry[element])
-
-                floatList += geometry[element].copy()
-
-                geometry[element] = newValue
-        else:
-            for i in range(len(data)):
-                geometry = data[i]['geometry']
-
-                newValue = [readCoords, len(geometry[element])] # where this vector starts and its size
-
-                readCoords += len(geometry[element])
+    if('data' in data):
+        features = data['data']
+    else:
+        features = data
 
-                floatList += geometry[element].copy()
+    encodings = channels.write_channels(filepath, filename, features, types, dataTypes)
 
-                geometry[element] = newValue
+    layer = {
+        "id": filename,
+        "type": type,
+        "renderStyle": renderStyle,
+        "styleKey": styleKey,
+        "data": features
+    }
 
-        fout = open(os.path.join(filepath,filename+'_'+element+'.data'), 'wb')
+    if(len(encodings) > 0):
+        layer['encodings'] = encodings
 
-        buf = struct.pack(str(len(floatList))+dataTypes[index], *floatList)
+    channels.set_index_type(layer, types)
 
-        fout.write(buf)
-        fout.close()
+    LayerView(os.path.join(filepath,filename+".json"), header=layer).write_index() # adds the "rtree" entry to the header
 
-        layer = {
-            "id": filename,
-            "type": type,
-            "renderStyle": renderStyle,
-            "styleKey": styleKey,
-            "data": data
-        }
+    with open(os.path.join(filepath,filename+".json"), "w") as outfile:
+        outfile.write(json.dumps(layer))
 
-        with open(os.path.join(filepath,filename+".json"), "w") as outfile:
-            outfile.write(json.dumps(layer))
+    manifest.update_layer(os.path.join(filepath,filename+".json"))
 
 '''
     Geometry column must be a string representing a Polygon in the WKT format
@@ -71,14 +54,13 @@ def physical_from_csv(filepath, geometry_column='geometry', crs='4326', renderSt
 
     gdf = gpd.GeoDataFrame(df, geometry = geometry_column, crs = crs)
 
-    mesh = mesh_from_gdf(gdf)
-
     directory = os.path.dirname(filepath)
     file_name = os.path.basename(filepath)
     # file name without extension
     file_name_wo_extension = os.path.splitext(file_name)[0]
 
-    break_into_binary(directory, file_name_wo_extension, mesh, ["coordinates", "indices"], ["d", "I"], 'TRIANGLES_3D_LAYER', renderStyle, styleKey)
+    with LayerWriter(directory, file_name_wo_extension, 'TRIANGLES_3D_LAYER', renderStyle, styleKey) as writer:
+        mesh_from_gdf(gdf, writer)
 
 def physical_from_geojson(filepath, bbox = None, renderStyle=['FLAT_COLOR'], styleKey='surface'):
 
@@ -87,19 +69,20 @@ def physical_from_geojson(filepath, bbox = None, renderStyle=['FLAT_COLOR'], sty
     if(bbox != None):
         gdf = gdf.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
 
-    mesh = mesh_from_gdf(gdf)
-
     directory = os.path.dirname(filepath)
     file_name = os.path.basename(filepath)
     # file name without extension
     file_name_wo_extension = os.path.splitext(file_name)[0]
 
-    break_into_binary(directory, file_name_wo_extension, mesh, ["coordinates", "indices"], ["d", "I"], 'TRIANGLES_3D_LAYER', renderStyle, styleKey)
+    with LayerWriter(directory, file_name_wo_extension, 'TRIANGLES_3D_LAYER', renderStyle, styleKey) as writer:
+        mesh_from_gdf(gdf, writer)
 
 '''
     Geometry has to be Polygon or Multipolygon
+
+    If a LayerWriter is provided the meshes are streamed to it instead of being returned
 '''
-def mesh_from_gdf(gdf):
+def mesh_from_gdf(gdf, writer=None):
 
     gdf_transformed = gdf.to_crs(3395)
 
@@ -134,7 +117,10 @@ def mesh_from_gdf(gdf):
                 nodes_3d.append(nodes[i*2+1])
                 nodes_3d.append(0)
 
-            mesh.append({'geometry': {'coordinates': [round(item,4) for item in nodes_3d], 'indices': indices}})
+            if(writer != None):
+                writer.append_feature(coordinates=np.round(nodes_3d, 4), indices=indices)
+            else:
+                mesh.append({'geometry': {'coordinates': [round(item,4) for item in nodes_3d], 'indices': indices}})
 
     return mesh
 
@@ -175,92 +161,47 @@ def physical_from_shapefile(filepath, layerName, bpoly=None, isBbox = False, ren
 
             loaded_shp = loaded_shp.clip(bpoly_series_4326)
 
-    zip_code_coordinates = []
+    with LayerWriter(os.path.dirname(filepath), layerName, 'TRIANGLES_3D_LAYER', renderStyle, styleKey) as writer:
+        objectId = []
+        coordinates_geometries = []
+        coordinates_ids = []
+        coord_id_counter = 0
 
-    data = []
-    objectId = []
-    coordinates_geometries = []
-    coordinates_ids = []
-    coord_id_counter = 0
+        for id, row in enumerate(loaded_shp.iloc):
 
-    for id, row in enumerate(loaded_shp.iloc):
+            objectId.append(id)
 
-        objectId.append(id)
-
-        geometries = []
-        if row['geometry'].geom_type == 'MultiPolygon':
-            geometries = list(row['geometry'])
-        elif row['geometry'].geom_type == 'Polygon':
-            geometries = [row['geometry']]
-
-        coordinates = []
-        indices = []
-        count = 0
-
-        for geometry in geometries:
-            points = np.array(geometry.exterior.coords[0:-1]) # remove last one (repeated)
-            rings = np.array([len(points)])
-
-            ind = earcut.triangulate_float64(points, rings)
-            ind = (ind+count).tolist()
-            indices += ind
-
-            points = points.flatten().tolist()
-
-            for i in range(0, len(points), 2):
-                coordinates.append(points[i])
-                coordinates.append(points[i+1])
-                coordinates_geometries.append(Point(points[i], points[i+1]))
-                coordinates_ids.append(coord_id_counter)
-                coord_id_counter += 1
-                coordinates.append(0)
-
-            count = int(len(coordinates)/3)
-        
-        zip_code_coordinates += coordinates
-
-        data.append({
-            "geometry": {
-                "coordinates": [round(item,4) for item in coordinates.copy()],
-                "indices": indices.copy()
-            }
-        })
-
-    outputfile = os.path.join(os.path.dirname(filepath), layerName+'.json') 
-
-    with open(outputfile, "w", encoding="utf-8") as f:
-        
-        # result = {
-        #     "id": layerName,
-        #     "type": type,
-        #     "renderStyle": renderStyle,
-        #     "styleKey": styleKey,
-        #     "data": data
-        # }
+            geometries = []
+            if row['geometry'].geom_type == 'MultiPolygon':
+                geometries = list(row['geometry'])
+            elif row['geometry'].geom_type == 'Polygon':
+                geometries = [row['geometry']]
 
-        types = []
-        dataTypes = []
+            coordinates = []
+            indices = []
+            count = 0
 
-        if('coordinates' in data[0]['geometry']):
-            types.append("coordinates")
-            dataTypes.append("d")
+            for geometry in geometries:
+                points = np.array(geometry.exterior.coords[0:-1]) # remove last one (repeated)
+                rings = np.array([len(points)])
 
-        if('normals' in data[0]['geometry']):
-            types.append("normals")
-            dataTypes.append("f")
+                ind = earcut.triangulate_float64(points, rings)
+                ind = (ind+count).tolist()
+                indices += ind
 
-        if('indices' in data[0]['geometry']):
-            types.append("indices")
-            dataTypes.append("I")
+                points = points.flatten().tolist()
 
-        if('ids' in data[0]['geometry']):
-            types.append("ids")
-            dataTypes.append("I")
+                for i in range(0, len(points), 2):
+                    coordinates.append(points[i])
+                    coordinates.append(points[i+1])
+                    coordinates_geometries.append(Point(points[i], points[i+1]))
+                    coordinates_ids.append(coord_id_counter)
+                    coord_id_counter += 1
+                    coordinates.append(0)
 
-        break_into_binary(os.path.dirname(filepath), layerName, data, types, dataTypes, 'TRIANGLES_3D_LAYER', renderStyle, styleKey)
+                count = int(len(coordinates)/3)
 
-        # layer_json_str = str(json.dumps(result))
-        # f.write(layer_json_str)
+            writer.append_feature(coordinates=np.round(coordinates, 4), indices=indices)
 
     loaded_shp['id'] = objectId
 
@@ -281,4 +222,5 @@ def physical_from_npy(filepath, layer_id, center_around=[]):
     if(len(center_around) > 0):
         coordinates = center_coordinates_around(coordinates, center_around)
 
-    break_into_binary(os.path.dirname(filepath), layer_id, [{'geometry': {'coordinates': [round(item,4) for item in coordinates]}}], ["coordinates"], ["d"], "POINTS_LAYER", ["FLAT_COLOR_POINTS"], "surface")
\ No newline at end of file
+    with LayerWriter(os.path.dirname(filepath), layer_id, "POINTS_LAYER", ["FLAT_COLOR_POINTS"], "surface") as writer:
+        writer.append_feature(coordinates=np.round(coordinates, 4))
\ No newline at end of file
@@ -5,6 +5,7 @@ import json
 from netCDF4 import Dataset
 import numpy as np
 from .utils import *
+from . import channels
 
 '''
     Converts a dataframe into an abstract layer
@@ -41,20 +42,11 @@ def thematic_from_df(df, output_filepath, latitude_column, longitude_column, coo
         coordinates.append(point[1])
         coordinates.append(z_value)
 
-    abstract_json = {
-        "id": os.path.basename(output_filepath),
-        "coordinates": coordinates,
-        "values": [elem for elem in values_list]
-    }
-
-    json_object = json.dumps(abstract_json)
-
     directory = os.path.dirname(output_filepath)
     if not os.path.exists(directory):
         os.makedirs(directory)
-    
-    with open(output_filepath, "w") as outfile:
-        outfile.write(json_object)
+
+    channels.write_thematic(output_filepath, coordinates, values_list, os.path.basename(output_filepath))
 
 '''
     Converts a csv file into an abstract layer
@@ -136,18 +128,9 @@ def thematic_from_netcdf(filepath, layer_id, value_variable, latitude_variable,
         coordinates.append(float(point[1]))
         coordinates.append(0)
 
-    abstract_json = {
-        "id": layer_id,
-        "coordinates": coordinates,
-        "values": values
-    }
-
-    json_object = json.dumps(abstract_json)
-
     directory = os.path.dirname(filepath)
 
-    with open(os.path.join(directory,layer_id+".json"), "w") as outfile:
-        outfile.write(json_object)
+    channels.write_thematic(os.path.join(directory,layer_id+".json"), coordinates, values, layer_id)
 
 '''
     Thematic data from numpy array file 
@@ -165,22 +148,6 @@ def thematic_from_npy(filepath_coordinates, filepath_values, layer_id, center_ar
     if(len(center_around) > 0):
         coordinates = center_coordinates_around(coordinates, center_around)
 
-    flat_values = []
-
-    if(isinstance(values[0], np.ndarray)):
-        flat_values = [item for row in values for item in row] 
-    else:
-        flat_values = values.tolist()
-
-    abstract_json = {
-        "id": layer_id,
-        "coordinates": coordinates.tolist(),
-        "values": flat_values
-    }
-
-    json_object = json.dumps(abstract_json)
-    
     directory = os.path.dirname(filepath_coordinates)
 
-    with open(os.path.join(directory,layer_id+".json"), "w") as outfile:
-        outfile.write(json_object)
\ No newline at end of file
+    channels.write_thematic(os.path.join(directory,layer_id+".json"), coordinates, values.ravel(), layer_id)
@@ -1,162 +1,101 @@
-import json
-import os
-import struct
 import numpy as np
 
+from . import channels
+from .layer_view import LayerView, DECODE_THREADS, decode_concurrently
+
 '''
     Load .utk and return a json that represents a layer
-'''
-def load_utk(filepath):
-
-    file = open(filepath, mode='r')
-    file_content = json.loads(file.read())
-
-    directory = os.path.dirname(filepath)
-    # file name with extension
-    file_name = os.path.basename(filepath)
-    # file name without extension
-    file_name_wo_extension = os.path.splitext(file_name)[0]
-
-    coordinates = []
-    normals = []
-    indices = []
-    ids = []
-
-    if('coordinates' in file_content['data'][0]['geometry']):
-        f = open(os.path.join(directory,file_name_wo_extension+'_coordinates.data'), "rb")
 
-        data = f.read()
+    If as_numpy is True each geometry channel of a feature is a numpy view into the channel array (memory mapped if mmap is True)
+    instead of a python list, so no python object is created per element.
 
-        unpacked_data = struct.iter_unpack('d', data)
+    If lazy is True a LayerView is returned instead. It reads a channel only when a feature or the channel is accessed.
 
-        for elem in unpacked_data:
-            coordinates.append(elem[0])
-
-        f.close()
-    if('normals' in file_content['data'][0]['geometry']):
-        f = open(os.path.join(directory,file_name_wo_extension+'_normals.data'), "rb")
+    If bbox ([minx, miny, maxx, maxy] in the coordinates of the layer) is provided only the features that intersect it are
+    returned, and only their values are read (using the spatial index of the layer if it has one).
+'''
+def load_utk(filepath, as_numpy=False, mmap=True, lazy=False, bbox=None):
 
-        data = f.read()
+    if(lazy):
+        return LayerView(filepath, mmap=mmap)
 
-        unpacked_data = struct.iter_unpack('f', data)
+    if(bbox != None):
+        layer = LayerView(filepath, mmap=True) # memory mapped so only the pages of the selected features are read
 
-        for elem in unpacked_data:
-            normals.append(elem[0])
+        return layer.to_json(as_numpy, features=layer.query(bbox))
 
-        f.close()
-    if('indices' in file_content['data'][0]['geometry']):
-        f = open(os.path.join(directory,file_name_wo_extension+'_indices.data'), "rb")
+    layer = LayerView(filepath, mmap=(as_numpy and mmap)).load_channels() # channels are decoded in parallel
 
-        data = f.read()
+    return layer.to_json(as_numpy)
 
-        unpacked_data = struct.iter_unpack('I', data)
+'''
+    Load several layers (same arguments as load_utk, bbox is not supported). The channels of all layers are read and
+    decoded concurrently by a pool of threads, instead of one file after another.
+'''
+def load_layers(filepaths, as_numpy=False, mmap=True, lazy=False, threads=DECODE_THREADS):
 
-        for elem in unpacked_data:
-            indices.append(elem[0])
+    layers = decode_concurrently(lambda filepath: LayerView(filepath, mmap=(mmap if lazy else (as_numpy and mmap))), filepaths, threads)
 
-        f.close()
-    if('ids' in file_content['data'][0]['geometry']):
-        f = open(os.path.join(directory,file_name_wo_extension+'_ids.data'), "rb")
+    # one task per channel of each layer so a big layer does not hold back the others
+    decode_concurrently(lambda task: task[0].channel(task[1]), [(layer, name) for layer in layers for name in layer.channel_types], threads)
 
-        data = f.read()
+    if(lazy):
+        return layers
 
-        unpacked_data = struct.iter_unpack('I', data)
+    return [layer.to_json(as_numpy) for layer in layers]
 
-        for elem in unpacked_data:
-            ids.append(elem[0])
+'''
+    Load a thematic layer (binary or with the values in the .json) and return a json with id, coordinates and values
 
-        f.close()
+    If as_numpy is True coordinates and values are numpy arrays (memory mapped if mmap is True) instead of python lists.
+'''
+def load_thematic_layer(filepath, as_numpy=False, mmap=True):
+    return channels.read_thematic(filepath, as_numpy, mmap)
 
-    for i in range(len(file_content['data'])):
+'''
+    Get all values (in a flat array) of a channel of a json layer. Numpy channels are concatenated into a numpy array
+'''
+def _get_channel(layer_json, channel):
 
-        if(len(coordinates) > 0):
-            startAndSize = file_content['data'][i]['geometry']['coordinates']
-            file_content['data'][i]['geometry']['coordinates'] = coordinates[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+    if(isinstance(layer_json, LayerView)):
+        return layer_json.gather(channel)
 
-        if(len(indices) > 0):
-            startAndSize = file_content['data'][i]['geometry']['indices']
-            file_content['data'][i]['geometry']['indices'] = indices[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+    if(len(layer_json['data']) == 0):
+        return []
+    else:
+        if channel not in layer_json['data'][0]['geometry']:
+            raise Exception('Layer does not have a '+channel+' field')
 
-        if(len(normals) > 0):
-            startAndSize = file_content['data'][i]['geometry']['normals']
-            file_content['data'][i]['geometry']['normals'] = normals[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+    if(isinstance(layer_json['data'][0]['geometry'][channel], np.ndarray)):
+        return np.concatenate([geometry['geometry'][channel] for geometry in layer_json['data']])
 
-        if(len(ids) > 0):
-            startAndSize = file_content['data'][i]['geometry']['ids']
-            file_content['data'][i]['geometry']['ids'] = ids[startAndSize[0]:startAndSize[0]+startAndSize[1]]
+    values = []
 
-    file.close()
+    for geometry in layer_json['data']:
+        values += geometry['geometry'][channel]
 
-    return file_content
+    return values
 
 '''
     Get all coordinates (in a flat array) of a json layer
 '''
 def get_coordinates(layer_json):
-    
-    if(len(layer_json['data']) == 0):
-        return []
-    else:
-        if 'coordinates' not in layer_json['data'][0]['geometry']:
-            raise Exception('Layer does not have a coordinates field')
-
-    coordinates = []
-
-    for geometry in layer_json['data']:
-        coordinates += geometry['geometry']['coordinates']
-
-    return coordinates
+    return _get_channel(layer_json, 'coordinates')
 
 '''
     Get all indices (in a flat array) of a json layer
 '''
 def get_indices(layer_json):
-    
-    if(len(layer_json['data']) == 0):
-        return []
-    else:
-        if 'indices' not in layer_json['data'][0]['geometry']:
-            raise Exception('Layer does not have a indices field')
-
-    indices = []
-
-    for geometry in layer_json['data']:
-        indices += geometry['geometry']['indices']
-
-    return indices
+    return _get_channel(layer_json, 'indices')
 
 '''
     Get all normals (in a flat array) of a json layer
 '''
 def get_normals(layer_json):
-    
-    if(len(layer_json['data']) == 0):
-        return []
-    else:
-        if 'normals' not in layer_json['data'][0]['geometry']:
-            raise Exception('Layer does not have a normals field')
-
-    normals = []
-
-    for geometry in layer_json['data']:
-        normals += geometry['geometry']['normals']
-
-    return normals
+    return _get_channel(layer_json, 'normals')
 
 '''
     Get all ids (in a flat array) of a json layer
 '''
 def get_ids(layer_json):
-    
-    if(len(layer_json['data']) == 0):
-        return []
-    else:
-        if 'ids' not in layer_json['data'][0]['geometry']:
-            raise Exception('Layer does not have a ids field')
-
-    ids = []
-
-    for geometry in layer_json['data']:
-        ids += geometry['geometry']['ids']
-
-    return ids
\ No newline at end of file
+    return _get_channel(layer_json, 'ids')
@@ -0,0 +1,215 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+
+'''
+    Content hashes of the files of a workdir
+
+    <workdir>/manifest.json has the hash of every .json and .data file of the directory (layers, channels, joined and
+    thematic files):
+        {"version": 1, "files": {"<relative path>": {"hash": ..., "size": ..., "mtime": ...}}}
+
+    It is created by UrbanComponent.save and build_tileset, and kept up to date when files are written by utk in a
+    directory that has one (LayerWriter, break_into_binary, joins, thematic layers). Only files whose size or modification
+    time changed are hashed again. Inside a batch() block the updates are written once at the end of the block.
+    Downstream caches (join and shadow results, ETags of the server) can compare hashes instead of reading and parsing
+    the files.
+'''
+
+MANIFEST_FILE = 'manifest.json'
+VERSION = 1
+
+_manifest_lock = threading.Lock()
+
+# updates deferred by batch() in this thread: directory -> [paths (None for all the files), create]
+_batch = threading.local()
+
+# manifests read by file_etag: directory -> (mtime of the manifest, files)
+_etag_cache = {}
+
+def file_hash(path, chunk_size=1<<20):
+    '''
+        Content hash (blake2b, 128 bits, hex) of a file
+    '''
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def manifest_filepath(directory):
+    return os.path.join(directory, MANIFEST_FILE)
+
+def read_manifest(directory):
+    '''
+        Manifest of a directory (empty if it does not have one)
+    '''
+
+    path = manifest_filepath(directory)
+
+    if(not os.path.isfile(path)):
+        return {"version": VERSION, "files": {}}
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _relative(directory, path):
+    return os.path.relpath(os.path.join(directory, path), directory).replace(os.sep, '/')
+
+def _is_tracked(name):
+    return (name.endswith('.json') or name.endswith('.data')) and name != MANIFEST_FILE
+
+def _is_fresh(entry, stat):
+    return entry != None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+@contextlib.contextmanager
+def batch():
+    '''
+        Defers the manifest updates of the block (e.g. one per tile of a tileset) to a single update of each manifest
+        when the block ends, which hashes the files given to the deferred updates
+    '''
+
+    outer = getattr(_batch, 'pending', None) == None
+
+    if(outer):
+        _batch.pending = {}
+
+    try:
+        yield
+    finally:
+        if(outer):
+            pending = _batch.pending
+            _batch.pending = None
+
+            for directory, (paths, create) in pending.items():
+                update_manifest(directory, paths, create)
+
+def update_manifest(directory, paths=None, create=None):
+    '''
+        Updates the hashes of the given files in the manifest of the directory. If paths is None all .json and .data
+        files of the directory are considered and the entries of removed files are dropped. Returns the manifest (None if
+        the update is deferred by batch() or the directory has no manifest to update).
+
+        * @param {string} directory Workdir
+        * @param {List[string]} paths Files to update (absolute or relative to directory)
+        * @param {bool} create Create the manifest if the directory does not have one (by default only when paths is None)
+    '''
+
+    if(create == None):
+        create = paths == None
+
+    pending = getattr(_batch, 'pending', None)
+
+    if(pending != None):
+        entry = pending.setdefault(os.path.abspath(directory), [[], False])
+
+        if(paths == None or entry[0] == None):
+            entry[0] = None
+        else:
+            entry[0] += [os.path.abspath(os.path.join(directory, path)) for path in paths]
+
+        entry[1] = entry[1] or create
+
+        return None
+
+    with _manifest_lock:
+        if(not create and not os.path.isfile(manifest_filepath(directory))):
+            return None
+
+        manifest = read_manifest(directory)
+        files = manifest['files']
+
+        if(paths == None):
+            names = [name for name in os.listdir(directory) if _is_tracked(name) and os.path.isfile(os.path.join(directory, name))]
+
+            for name in list(files):
+                if(name not in names):
+                    del files[name]
+        else:
+            names = list(dict.fromkeys(_relative(directory, path) for path in paths))
+
+        for name in names:
+            path = os.path.join(directory, name)
+
+            if(not os.path.isfile(path)):
+                files.pop(name, None)
+                continue
+
+            stat = os.stat(path)
+
+            if(_is_fresh(files.get(name), stat)): # not changed since it was hashed
+                continue
+
+            files[name] = {"hash": file_hash(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+        manifest['version'] = VERSION
+
+        tmp_path = manifest_filepath(directory)+'.tmp'
+
+        with open(tmp_path, "w") as outfile:
+            outfile.write(json.dumps(manifest, indent=4))
+
+        os.replace(tmp_path, manifest_filepath(directory))
+
+    return manifest
+
+def _layer_paths(filepath):
+    '''
+        Possible files of a layer: the .json and the .data files of its channels and sidecars
+    '''
+
+    from . import channels
+    from . import spatial_index
+
+    suffixes = list(channels.CHANNEL_TYPES) + list(channels.THEMATIC_CHANNEL_TYPES) + ['offsets', spatial_index.RTREE_CHANNEL, spatial_index.RTREE_IDS_CHANNEL, spatial_index.ORDER_CHANNEL]
+
+    return [filepath] + [channels.channel_filepath(filepath, suffix) for suffix in dict.fromkeys(suffixes)]
+
+def layer_files(filepath):
+    '''
+        Files of a layer (the .json and the .data files of its channels and sidecars) that exist
+    '''
+
+    return [path for path in _layer_paths(filepath) if os.path.isfile(path)]
+
+def update_layer(filepath):
+    '''
+        Updates the hashes of the files of a layer in the manifest of its directory
+    '''
+
+    filepath = os.path.abspath(filepath)
+
+    # the entries of removed sidecars (e.g. the spatial index dropped by append_to_layer) are dropped by update_manifest
+    return update_manifest(os.path.dirname(filepath), _layer_paths(filepath))
+
+def file_etag(directory, path):
+    '''
+        Hash of a file if the manifest has it and the file did not change since, None otherwise
+    '''
+
+    path_manifest = manifest_filepath(directory)
+
+    if(not os.path.isfile(path_manifest)):
+        return None
+
+    mtime = os.stat(path_manifest).st_mtime_ns
+
+    if(directory not in _etag_cache or _etag_cache[directory][0] != mtime): # the server asks for every file it serves
+        _etag_cache[directory] = (mtime, read_manifest(directory)['files'])
+
+    entry = _etag_cache[directory][1].get(_relative(directory, path))
+
+    full_path = os.path.join(directory, path)
+
+    if(entry == None or not os.path.isfile(full_path)):
+        return None
+
+    if(not _is_fresh(entry, os.stat(full_path))):
+        return None
+
+    return entry['hash']
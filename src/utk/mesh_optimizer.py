@@ -0,0 +1,264 @@
+import numpy as np
+
+'''
+    Post-processing of triangle meshes before they are written (see UrbanComponent.save(..., optimize=True))
+
+    1. weld_vertices merges vertices closer than epsilon whose normals agree (buildings walls and roofs emit one vertex
+       per quad/cell corner) and drops the triangles that become degenerate.
+    2. optimize_vertex_cache reorders the triangles for the post-transform vertex cache of the GPU (Tipsify, Sander et al. 2007).
+    3. optimize_vertex_fetch renumbers the vertices in the order they are first used by the triangles, so vertex fetches
+       are sequential.
+
+    ids are per triangle by default (as emitted by the buildings, the surface and the tiles) or per vertex with
+    ids_per_triangle=False. They are permuted with the triangles or the vertices accordingly.
+'''
+
+# vertex cache simulated by tipsify and by the ACMR statistics
+CACHE_SIZE = 16
+
+def _check_ids(ids, ids_per_triangle, triangle_count, vertex_count):
+
+    if(ids is None):
+        return
+
+    expected = triangle_count if ids_per_triangle else vertex_count
+
+    if(len(ids) != expected):
+        raise Exception("Expected "+str(expected)+" ids (one per "+("triangle" if ids_per_triangle else "vertex")+"), got "+str(len(ids)))
+
+def weld_vertices(coordinates, indices, normals=None, ids=None, epsilon=1e-4, normal_epsilon=1e-3, ids_per_triangle=True):
+    '''
+        Merges vertices whose positions (and normals, if provided) are equal up to epsilon (normal_epsilon). Returns
+        coordinates, indices, normals and ids of the welded mesh.
+
+        * @param {np.ndarray} coordinates Flat x, y, z coordinates
+        * @param {np.ndarray} indices Flat triangle indices
+        * @param {np.ndarray} normals Flat normals (one per vertex) or None
+        * @param {np.ndarray} ids One id per triangle or per vertex (see ids_per_triangle), or None
+        * @param {float} epsilon Distance under which two positions are the same
+        * @param {float} normal_epsilon Difference under which two normals are the same
+        * @param {bool} ids_per_triangle True if ids has one value per triangle, False if it has one per vertex
+    '''
+
+    vertices = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    triangles = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+
+    _check_ids(ids, ids_per_triangle, len(triangles), len(vertices))
+
+    # vertices are the same if they fall in the same cell of the grids of positions (and normals)
+    keys = [np.floor(vertices/epsilon + 0.5).astype(np.int64)]
+
+    if(normals is not None):
+        keys.append(np.floor(np.asarray(normals, dtype=np.float64).reshape(-1, 3)/normal_epsilon + 0.5).astype(np.int64))
+
+    if(ids is not None and not ids_per_triangle): # per vertex ids must be kept
+        keys.append(np.asarray(ids, dtype=np.int64).reshape(-1, 1))
+
+    _, first, remap = np.unique(np.concatenate(keys, axis=1), axis=0, return_index=True, return_inverse=True)
+    remap = remap.ravel()
+
+    triangles = remap[triangles]
+
+    # triangles with a repeated vertex have no area anymore
+    valid = (triangles[:,0] != triangles[:,1]) & (triangles[:,1] != triangles[:,2]) & (triangles[:,0] != triangles[:,2])
+
+    welded_normals = None if normals is None else np.asarray(normals).reshape(-1, 3)[first].ravel()
+
+    welded_ids = None
+    if(ids is not None):
+        welded_ids = np.asarray(ids)[valid] if ids_per_triangle else np.asarray(ids)[first]
+
+    return vertices[first].ravel(), triangles[valid].ravel(), welded_normals, welded_ids
+
+def optimize_vertex_cache(indices, vertex_count, cache_size=CACHE_SIZE):
+    '''
+        Reorders the triangles so consecutive triangles share vertices that are still in the vertex cache (Tipsify).
+        Returns the position of each triangle of the new order in the original indices.
+
+        * @param {np.ndarray} indices Flat triangle indices
+        * @param {int} vertex_count Number of vertices of the mesh
+        * @param {int} cache_size Size of the vertex cache of the target GPU
+    '''
+
+    triangles = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+
+    if(len(triangles) == 0):
+        return np.empty(0, dtype=np.int64)
+
+    # triangles of each vertex (CSR)
+    flat = triangles.ravel()
+    adjacency = (np.argsort(flat, kind='stable')//3).tolist()
+    live = np.bincount(flat, minlength=vertex_count)
+    starts = np.concatenate(([0], np.cumsum(live))).tolist()
+    live = live.tolist()
+
+    triangles = triangles.tolist()
+
+    cache_time = [0]*vertex_count
+    emitted = [False]*len(triangles)
+    dead_end = []
+    order = []
+
+    time = cache_size+1
+    cursor = 1
+    fanning = 0
+
+    while(fanning >= 0):
+        candidates = []
+
+        for triangle in adjacency[starts[fanning]:starts[fanning+1]]:
+            if(emitted[triangle]):
+                continue
+
+            for vertex in triangles[triangle]:
+                dead_end.append(vertex)
+                candidates.append(vertex)
+                live[vertex] -= 1
+
+                if(time - cache_time[vertex] > cache_size): # not in the cache
+                    cache_time[vertex] = time
+                    time += 1
+
+            emitted[triangle] = True
+            order.append(triangle)
+
+        # next fanning vertex: the candidate that will still be in the cache after its triangles are emitted
+        fanning = -1
+        best_priority = -1
+
+        for vertex in candidates:
+            if(live[vertex] > 0):
+                priority = 0
+
+                if(time - cache_time[vertex] + 2*live[vertex] <= cache_size):
+                    priority = time - cache_time[vertex]
+
+                if(priority > best_priority):
+                    best_priority = priority
+                    fanning = vertex
+
+        if(fanning == -1):
+            while(len(dead_end) > 0):
+                vertex = dead_end.pop()
+
+                if(live[vertex] > 0):
+                    fanning = vertex
+                    break
+
+        if(fanning == -1):
+            while(cursor < vertex_count):
+                if(live[cursor] > 0):
+                    fanning = cursor
+                    break
+
+                cursor += 1
+
+    return np.array(order, dtype=np.int64)
+
+def optimize_vertex_fetch(indices, vertex_count):
+    '''
+        Renumbers the vertices in the order they are first referenced. Returns the new indices and the original
+        vertex of each new vertex (vertices that are not referenced are dropped).
+    '''
+
+    indices = np.asarray(indices, dtype=np.int64)
+
+    _, first_use = np.unique(indices, return_index=True)
+    used = indices[np.sort(first_use)] # vertices in the order they are first referenced
+
+    remap = np.full(vertex_count, -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+
+    return remap[indices], used
+
+def average_cache_miss_ratio(indices, cache_size=CACHE_SIZE):
+    '''
+        Vertex cache misses per triangle of a FIFO cache (0.5 is ideal for large regular meshes, 3 is the worst case)
+    '''
+
+    indices = np.asarray(indices, dtype=np.int64).tolist()
+
+    if(len(indices) == 0):
+        return 0
+
+    cache = []
+    misses = 0
+
+    for vertex in indices:
+        if(vertex not in cache):
+            misses += 1
+            cache.append(vertex)
+
+            if(len(cache) > cache_size):
+                cache.pop(0)
+
+    return misses/(len(indices)/3)
+
+def optimize_geometry(geometry, epsilon=1e-4, normal_epsilon=1e-3, cache_size=CACHE_SIZE, ids_per_triangle=True):
+    '''
+        Welds and reorders the mesh of a feature ({'coordinates': [...], 'indices': [...], 'normals': [...], 'ids': [...]})
+        in place. Returns the vertex and triangle counts before and after.
+
+        * @param {bool} ids_per_triangle True if the ids of the feature are per triangle, False if they are per vertex
+    '''
+
+    vertices_before = len(geometry['coordinates'])//3
+    triangles_before = len(geometry['indices'])//3
+
+    normals = geometry.get('normals', None)
+    ids = geometry.get('ids', None)
+
+    coordinates, indices, normals, ids = weld_vertices(geometry['coordinates'], geometry['indices'], normals, ids, epsilon, normal_epsilon, ids_per_triangle)
+
+    vertex_count = len(coordinates)//3
+
+    triangle_order = optimize_vertex_cache(indices, vertex_count, cache_size)
+    indices = indices.reshape(-1, 3)[triangle_order].ravel()
+
+    if(ids is not None and ids_per_triangle):
+        ids = ids[triangle_order]
+
+    indices, used = optimize_vertex_fetch(indices, vertex_count)
+
+    geometry['coordinates'] = coordinates.reshape(-1, 3)[used].ravel().tolist()
+    geometry['indices'] = indices.tolist()
+
+    if(normals is not None):
+        geometry['normals'] = normals.reshape(-1, 3)[used].ravel().tolist()
+
+    if(ids is not None):
+        geometry['ids'] = (ids if ids_per_triangle else ids[used]).tolist()
+
+    return {
+        'vertices_before': vertices_before,
+        'vertices_after': len(used),
+        'triangles_before': triangles_before,
+        'triangles_after': len(indices)//3
+    }
+
+def optimize_layer(layer_json, epsilon=1e-4, normal_epsilon=1e-3, cache_size=CACHE_SIZE, ids_per_triangle=True):
+    '''
+        Runs optimize_geometry on every feature of a json layer (before it is written with break_into_binary).
+        Returns the vertex and triangle counts of the layer before and after.
+
+        * @param {object} layer_json Layer with the channels of the features as lists ({'data': [{'geometry': {...}}]})
+        * @param {float} epsilon Distance under which two vertices are welded (in the units of the coordinates)
+        * @param {float} normal_epsilon Difference under which the normals of two vertices agree
+        * @param {int} cache_size Size of the vertex cache of the target GPU
+        * @param {bool} ids_per_triangle True if the ids of the features are per triangle (buildings, surface), False if they are per vertex
+    '''
+
+    stats = {'vertices_before': 0, 'vertices_after': 0, 'triangles_before': 0, 'triangles_after': 0}
+
+    for feature in layer_json['data']:
+        geometry = feature['geometry']
+
+        if('indices' not in geometry or len(geometry['indices']) == 0): # points and lines are not meshes
+            continue
+
+        feature_stats = optimize_geometry(geometry, epsilon, normal_epsilon, cache_size, ids_per_triangle)
+
+        for key in stats:
+            stats[key] += feature_stats[key]
+
+    return stats
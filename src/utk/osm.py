@@ -1,4 +1,3 @@
-import overpass
 import pandas as pd
 import geopandas as gpd
 import mapbox_earcut as earcut
@@ -7,7 +6,6 @@ import re
 import time
 import vedo
 import osmium as o
-import subprocess
 import pyproj
 import matplotlib.pyplot as plt
 
@@ -19,18 +17,85 @@ from shapely.validation import explain_validity
 
 from . import utils
 from . import errors
-from . import cache
+from . import osm_extract
+from . import overpass_scheduler
 from .buildings import Buildings
 from .urban_component import UrbanComponent
+from .layer_writer import LayerWriter
+from .layer_view import LayerView
 
 
+class TagMatcher:
+    '''
+        Filters of get_osmium_filters of several layers compiled for one element type ('way' or 'rel')
+
+        Each tag key maps to the rules of the layers that test it, so a tag is checked with one dict lookup and one set
+        lookup per rule instead of walking the nested filters of every layer.
+
+        * @param {dict} layers_filters Filters of each layer ({layer: get_osmium_filters(layer)})
+        * @param {string} element_type 'way' or 'rel'
+    '''
+
+    def __init__(self, layers_filters, element_type):
+
+        self.accept = {} # key -> [(layer, values, matches any value)]
+        self.reject = {} # disqualifiers
+
+        for layer, filters in layers_filters.items():
+            filters = filters.get(element_type, {})
+
+            for key, values in filters.items():
+                if(key != 'disqualifiers'):
+                    self.accept.setdefault(key, []).append((layer, frozenset(value for value in values if value != -1), -1 in values)) # -1 includes all
+
+            for key, values in filters.get('disqualifiers', {}).items():
+                self.reject.setdefault(key, []).append((layer, frozenset(value for value in values if value != -1), -1 in values))
+
+    def __bool__(self):
+        return len(self.accept) > 0
+
+    def match(self, tags):
+        '''
+            Layers whose filters the tags pass and that do not disqualify them
+
+            * @param {Iterable[Tuple[string, string]]} tags (key, value) pairs of an element
+        '''
+
+        passed = set()
+        disqualified = set()
+
+        for k, v in tags:
+            rules = self.accept.get(k)
+
+            if(rules != None):
+                for layer, values, any_value in rules:
+                    if(any_value or v in values):
+                        passed.add(layer)
+
+            rules = self.reject.get(k)
+
+            if(rules != None):
+                for layer, values, any_value in rules:
+                    if(any_value or v in values):
+                        disqualified.add(layer)
+
+        return passed - disqualified
+
 class RelationHandler(o.SimpleHandler):
-    def __init__(self, filters):
+    '''
+        Collects the relations of all layers in one pass over the file
+
+        * @param {dict} layers_filters Filters of each layer ({layer: get_osmium_filters(layer)})
+    '''
+
+    def __init__(self, layers_filters):
         o.SimpleHandler.__init__(self)
-        self.relation_elements = {'elements':[]}
-        self.relations_position = {}
-        self.relation_ways_ids = [] # all ids of ways that are part of relations
-        self.filters = filters
+        self.matcher = TagMatcher(layers_filters, 'rel')
+
+        # one bucket per layer
+        self.relation_elements = {layer: {'elements':[]} for layer in layers_filters}
+        self.relations_position = {layer: {} for layer in layers_filters}
+        self.relation_ways_ids = {layer: set() for layer in layers_filters} # all ids of ways that are part of relations of each layer
 
     def node(self, n):
         pass
@@ -40,143 +105,154 @@ class RelationHandler(o.SimpleHandler):
 
     def relation(self, r):
 
+        layers = self.matcher.match((tag.k, tag.v) for tag in r.tags)
+
+        if(len(layers) == 0):
+            return
+
         tags = {}
-        pass_filters = False
-        disqualified = False
 
         for tag in r.tags:
             tags[tag.k] = tag.v
 
-            if('rel' in self.filters and tag.k in self.filters['rel'] and (tag.v in self.filters['rel'][tag.k] or -1 in self.filters['rel'][tag.k])): # -1 includes all
-                pass_filters = True
-
-            if('rel' in self.filters and 'disqualifiers' in self.filters['rel'] and tag.k in self.filters['rel']['disqualifiers'] and (tag.v in self.filters['rel']['disqualifiers'][tag.k] or -1 in self.filters['rel']['disqualifiers'][tag.k])): # -1 includes all
-                disqualified = True
-
-        if(pass_filters and not disqualified):
+        members = []
 
-            members = []
+        for member in r.members:
 
-            for member in r.members:
+            type = member.type
 
-                type = member.type
+            if type == 'w':
+                type = 'way'
 
-                if type == 'w':
-                    type = 'way'
+            members.append({
+                'id': member.ref,
+                'type': type,
+                'role': member.role
+            })
 
-                self.relation_ways_ids.append(member.ref)
+        for layer in layers:
 
-                members.append({
-                    'id': member.ref,
-                    'type': type,
-                    'role': member.role,
-                    'geometry': []
-                })
+            self.relation_ways_ids[layer].update(member['id'] for member in members)
 
-            self.relation_elements['elements'].append({
+            # fill_relation_geom_osmium modifies the relations, so each layer has its own copy
+            self.relation_elements[layer]['elements'].append({
                 'type': 'relation',
                 'id': r.id,
-                'members': members,
+                'members': [dict(member, geometry=[]) for member in members],
                 'bounds': None,
-                'tags': tags
+                'tags': tags.copy()
             })
 
-            self.relations_position[r.id] = len(self.relation_elements['elements'])-1
+            self.relations_position[layer][r.id] = len(self.relation_elements[layer]['elements'])-1
 
     def area(self, a):
         pass
 
 class OSMHandler(o.SimpleHandler):
-    def __init__(self, filters, relation_ways_ids):
+    '''
+        Collects the ways of all layers in one pass over the file. Each way is tested against the filters of every layer
+        and added to the buckets of the layers it passes (or whose relations it is part of)
+
+        * @param {dict} layers_filters Filters of each layer ({layer: get_osmium_filters(layer)})
+        * @param {dict} relation_ways_ids Ids of the ways that are part of relations of each layer (RelationHandler.relation_ways_ids)
+    '''
+
+    def __init__(self, layers_filters, relation_ways_ids):
         o.SimpleHandler.__init__(self)
-        self.relation_ways_ids = relation_ways_ids
+        self.matcher = TagMatcher(layers_filters, 'way')
+
+        # way id -> layers whose relations have the way
+        self.relation_ways_layers = {}
+
+        for layer in layers_filters:
+            for way_id in relation_ways_ids.get(layer, []):
+                self.relation_ways_layers.setdefault(way_id, set()).add(layer)
 
-        self.ways_elements = {'elements':[]}
-        self.ways_elements_of_relations = {'elements':[]}
-        self.areas = {}
-        self.ways_position = {}
-        self.filters = filters
+        # one bucket per layer
+        self.ways_elements = {layer: {'elements':[]} for layer in layers_filters}
+        self.ways_elements_of_relations = {layer: {'elements':[]} for layer in layers_filters}
+        self.areas = {layer: {} for layer in layers_filters}
+        self.ways_position = {layer: {} for layer in layers_filters}
     
     def node(self, n):
         pass
 
-    def way(self, w):
+    def _way_element(self, w, tags):
 
-        tags = {}
-        pass_filters = False
-        disqualified = False
+        nodes_ids = []
+        geometry = []
+        bounds = {
+            'minlat': None,
+            'minlon': None,
+            'maxlat': None, 
+            'maxlon': None
+        }
 
-        for tag in w.tags:
-            tags[tag.k] = tag.v
+        for elem in w.nodes:
+            nodes_ids.append(elem.ref)
 
-            if('way' in self.filters and tag.k in self.filters['way'] and (tag.v in self.filters['way'][tag.k] or -1 in self.filters['way'][tag.k])):
-                pass_filters = True
+            geometry.append({
+                'lat': elem.lat,
+                'lon': elem.lon
+            })
 
-            if('way' in self.filters and 'disqualifiers' in self.filters['way'] and tag.k in self.filters['way']['disqualifiers'] and (tag.v in self.filters['way']['disqualifiers'][tag.k] or -1 in self.filters['way']['disqualifiers'][tag.k])): # -1 includes all
-                disqualified = True
+            if(bounds['minlat'] == None):
+                bounds['minlat'] = elem.lat
+            elif(elem.lat < bounds['minlat']):
+                    bounds['minlat'] = elem.lat
 
-        if((pass_filters and not disqualified) or w.id in self.relation_ways_ids):
+            if(bounds['minlon'] == None):
+                bounds['minlon'] = elem.lon
+            elif(elem.lon < bounds['minlon']):
+                    bounds['minlon'] = elem.lon
 
-            nodes_ids = []
-            geometry = []
-            bounds = {
-                'minlat': None,
-                'minlon': None,
-                'maxlat': None, 
-                'maxlon': None
-            }
+            if(bounds['maxlat'] == None):
+                bounds['maxlat'] = elem.lat
+            elif(elem.lat > bounds['maxlat']):
+                    bounds['maxlat'] = elem.lat
 
-            for elem in w.nodes:
-                nodes_ids.append(elem.ref)
+            if(bounds['maxlon'] == None):
+                bounds['maxlon'] = elem.lon
+            elif(elem.lon > bounds['maxlon']):
+                    bounds['maxlon'] = elem.lon
+
+        return {
+            'type': 'way',
+            'id': w.id,
+            'bounds': bounds,
+            'nodes': nodes_ids,
+            'geometry': geometry,
+            'tags': tags
+        }
 
-                geometry.append({
-                    'lat': elem.lat,
-                    'lon': elem.lon
-                })
+    def way(self, w):
 
-                if(bounds['minlat'] == None):
-                    bounds['minlat'] = elem.lat
-                elif(elem.lat < bounds['minlat']):
-                        bounds['minlat'] = elem.lat
+        layers = self.matcher.match((tag.k, tag.v) for tag in w.tags)
+        relation_layers = self.relation_ways_layers.get(w.id, ())
 
-                if(bounds['minlon'] == None):
-                    bounds['minlon'] = elem.lon
-                elif(elem.lon < bounds['minlon']):
-                        bounds['minlon'] = elem.lon
+        if(len(layers) == 0 and len(relation_layers) == 0):
+            return
 
-                if(bounds['maxlat'] == None):
-                    bounds['maxlat'] = elem.lat
-                elif(elem.lat > bounds['maxlat']):
-                        bounds['maxlat'] = elem.lat
+        tags = {}
 
-                if(bounds['maxlon'] == None):
-                    bounds['maxlon'] = elem.lon
-                elif(elem.lon > bounds['maxlon']):
-                        bounds['maxlon'] = elem.lon
-
-            if(w.id in self.relation_ways_ids):
-
-                self.ways_elements_of_relations['elements'].append({
-                    'type': 'way',
-                    'id': w.id,
-                    'bounds': bounds,
-                    'nodes': nodes_ids,
-                    'geometry': geometry,
-                    'tags': tags
-                })
-            
-                self.ways_position[w.id] = len(self.ways_elements_of_relations['elements'])-1
-            
-            else:
-                self.ways_elements['elements'].append({
-                    'type': 'way',
-                    'id': w.id,
-                    'bounds': bounds,
-                    'nodes': nodes_ids,
-                    'geometry': geometry,
-                    'tags': tags
-                })
+        for tag in w.tags:
+            tags[tag.k] = tag.v
+
+        element = self._way_element(w, tags) # the geometry is read once and shared by all layers (parse_osm does not modify it)
+
+        for layer in relation_layers:
+            self.ways_elements_of_relations[layer]['elements'].append(element)
+            self.ways_position[layer][w.id] = len(self.ways_elements_of_relations[layer]['elements'])-1
 
+        self.add_way(element, [layer for layer in layers if layer not in relation_layers])
+
+    def add_way(self, element, layers):
+        '''
+            Adds a way that is not part of relations to the buckets of the layers
+        '''
+
+        for layer in layers:
+            self.ways_elements[layer]['elements'].append(element)
 
     def relation(self, r):
         pass
@@ -186,21 +262,65 @@ class OSMHandler(o.SimpleHandler):
 
 class OSM:
 
-    def load(region, layers=['parks','water','roads','buildings'], pbf_filepath=None):
+    def load(region, layers=['parks','water','roads','buildings'], pbf_filepath=None, output_dir=None):
         '''
             Region can be a bounding polygon, a bounding box or an address
+
+            If output_dir is provided the layers are streamed to disk while they are built (see get_osm)
         '''
 
         if(isinstance(region, str)): # address
-            return OSM.load_from_address(region, layers, pbf_filepath)
+            return OSM.load_from_address(region, layers, pbf_filepath, output_dir)
         elif(len(region) == 4 and (isinstance(region[0], float) or isinstance(region[0], int))): # bounding box
-            return OSM.load_from_bbox(region, layers, pbf_filepath)
+            return OSM.load_from_bbox(region, layers, pbf_filepath, output_dir)
         elif(len(region[0]) == 2): # polygon
-            return OSM.load_from_polygon(region, layers)
+            return OSM.load_from_polygon(region, layers, pbf_filepath, output_dir)
         else:
             raise Exception("Region format "+str(region)+" not supported")
 
-    def load_from_bbox(bbox, layers=['parks','water','roads','buildings'], pbf_filepath=None):
+    def load_pbf_layers(pbf_filepath, layers):
+        '''
+            Reads the ways and relations of several layers from a pbf file. All layers are filtered in the same pass over
+            the file (plus one pass for the relations if some layer has relation filters).
+
+            Args:
+                pbf_filepath (string): Location of the pbf file
+                layers (string[]): Name of the layers to read (parks, water, coastline, roads, buildings)
+
+            Returns:
+                result (object): parse_osm result of each layer ({layer: {'ways': ..., 'multiways': ...}})
+        '''
+
+        layers_filters = {layer: OSM.get_osmium_filters(layer) for layer in layers}
+
+        relation_elements = {layer: {'elements':[]} for layer in layers}
+        relations_position = {layer: {} for layer in layers}
+        relation_ways_ids = {layer: set() for layer in layers}
+
+        # relations only need their tags and members (no node locations)
+        if(TagMatcher(layers_filters, 'rel')):
+            relation_handler = RelationHandler(layers_filters)
+
+            relation_handler.apply_file(pbf_filepath)
+
+            relation_elements = relation_handler.relation_elements
+            relations_position = relation_handler.relations_position
+            relation_ways_ids = relation_handler.relation_ways_ids
+
+        osmhandler = OSMHandler(layers_filters, relation_ways_ids)
+
+        osmhandler.apply_file(pbf_filepath, locations=True)
+
+        result = {}
+
+        for layer in layers:
+            complete_relation_elements = OSM.fill_relation_geom_osmium(osmhandler.ways_elements_of_relations[layer], relation_elements[layer], osmhandler.ways_position[layer], relations_position[layer], osmhandler.areas[layer])
+
+            result[layer] = OSM.parse_osm({'elements': osmhandler.ways_elements[layer]['elements'] + complete_relation_elements['elements']})
+
+        return result
+
+    def load_from_bbox(bbox, layers=['parks','water','roads','buildings'], pbf_filepath=None, output_dir=None):
         '''
             Load layers inside bounding box to memory storing them into the UrbanComponent
 
@@ -210,6 +330,8 @@ class OSM:
                     (default is ['parks', 'water', 'roads','buildings'])
                 filepath (string): Location of the pbf file to load. This argument is optional. If provided the data will be loaded from the pbf instead of the OSM API
                     (default is None)
+                output_dir (string): If provided the layers are streamed to this directory while they are built
+                    (default is None)
 
             Returns:
                 component (UrbanComponent): Allows the manipulation of the loaded data
@@ -221,30 +343,15 @@ class OSM:
         loaded = None
 
         if(pbf_filepath != None):
-
-            aux = '%f,%f,%f,%f'%(bbox[1],bbox[0],bbox[3],bbox[2])
-
-            split_file = pbf_filepath.split('/')
-
-            output_file = ''
-
-            for index, section in enumerate(split_file):
-                if(index == len(split_file)-1):
-                    output_file += 'filtered_'+section
-                else:
-                    output_file += section+'/'
-
-            proc = subprocess.call(['wsl', 'osmium', 'extract', '-b', aux, '-o', output_file, '--overwrite', pbf_filepath], shell=True) # TODO: make it not depend on the OS
-
-            loaded = OSM.get_osm(bbox, True, layers, output_file)
+            loaded = OSM.get_osm(bbox, True, layers, OSM.pbf_source(pbf_filepath, bbox, layers), output_dir)
         else:
-            loaded = OSM.get_osm(bbox, True, layers)
+            loaded = OSM.get_osm(bbox, True, layers, output_dir=output_dir)
 
         component = UrbanComponent(layers = loaded, bpolygon = bbox, camera = cam)
 
         return component
 
-    def load_from_polygon(bpolygon, layers=['parks','water','roads','buildings']):
+    def load_from_polygon(bpolygon, layers=['parks','water','roads','buildings'], pbf_filepath=None, output_dir=None):
         
         flattened_polygon = [item for row in bpolygon for item in row]
 
@@ -252,14 +359,17 @@ class OSM:
         cam = utils.get_camera(flattened_polygon)
 
         # loaded = OSM.get_osm(bpolygon, False, layers)
-        loaded = OSM.get_osm(flattened_polygon, False, layers)
+        if(pbf_filepath != None):
+            loaded = OSM.get_osm(flattened_polygon, False, layers, OSM.pbf_source(pbf_filepath, flattened_polygon, layers), output_dir)
+        else:
+            loaded = OSM.get_osm(flattened_polygon, False, layers, output_dir=output_dir)
 
         # component = UrbanComponent(layers = loaded, bpolygon = bpolygon, camera = cam)
         component = UrbanComponent(layers = loaded, bpolygon = flattened_polygon, camera = cam)
 
         return component
 
-    def load_from_address(address, layers=['parks','water','roads','buildings'], pbf_filepath=None):
+    def load_from_address(address, layers=['parks','water','roads','buildings'], pbf_filepath=None, output_dir=None):
 
         geolocator = Nominatim(user_agent="urbantk")
 
@@ -269,11 +379,47 @@ class OSM:
         bbox = [bbox[0],bbox[2],bbox[1],bbox[3]]
 
         if(pbf_filepath != None):
-            return OSM.load_from_bbox(bbox, layers, pbf_filepath)
+            return OSM.load_from_bbox(bbox, layers, pbf_filepath, output_dir)
         else:
-            return OSM.load_from_bbox(bbox, layers)
+            return OSM.load_from_bbox(bbox, layers, output_dir=output_dir)
+
+    def layer_names(layers):
+        '''
+            Names of the layers that are read from OSM (the surface is not)
+
+            * @param {List[string | object]} layers Names of the layers or layer objects ({'name': ...})
+        '''
+
+        layer_names = []
+
+        for layer_obj in layers:
+
+            layer = layer_obj if isinstance(layer_obj, str) else layer_obj['name']
+
+            if layer != 'surface':
+                layer_names.append(layer)
+
+        return layer_names
+
+    def pbf_source(pbf_filepath, region, layers):
+        '''
+            File that get_osm reads to load a region of a pbf file: the pbf itself if its store (utk osm index) is up to date
+            and has all the layers, so only the elements of the region are read from the store, or the extract of the region
+            otherwise (cached by file and region)
+
+            * @param {string} pbf_filepath Location of the pbf file
+            * @param {List[float]} region Bounding box [minLat, minLng, maxLat, maxLng] or polygon [lat, lng, lat, lng, ...]
+            * @param {List[string | object]} layers Layers that will be loaded
+        '''
+
+        from . import osm_store
+
+        if(osm_store.is_indexed(pbf_filepath, OSM.layer_names(layers))):
+            return pbf_filepath
+
+        return osm_extract.extract(pbf_filepath, region)
 
-    def get_osm(bpolygon, bbox=False, layers=['parks','water','roads','buildings'], pbf_filepath=None):
+    def get_osm(bpolygon, bbox=False, layers=['parks','water','roads','buildings'], pbf_filepath=None, output_dir=None):
 
         '''
             Request data to OSM API using overpass and builds meshes for each loaded data from the result
@@ -285,61 +431,41 @@ class OSM:
                     (default is ['parks', 'water', 'roads','buildings'])
                 filepath (string): Location of the pbf file to load. This argument is optional. If provided the data will be loaded from the pbf instead of the OSM API
                     (default is None)
+                output_dir (string): If provided each layer is streamed to this directory with a LayerWriter while it is built, and the layers
+                    are returned as LayerViews of the written files instead of json objects held in memory
+                    (default is None)
 
             Returns:
                 result (list[object]): A list of python objects representing the layers in json format
         '''
 
         bpoly = bpolygon.copy()
-        api = overpass.API()
-
         overpass_responses = {}
 
-        for layer_obj in layers:
-
-            layer = ''
-
-            if isinstance(layer_obj, str):
-                layer = layer_obj
-            else:
-                layer = layer_obj['name']
-
-            if layer == 'surface':
-                continue
-            
-            if(pbf_filepath == None):
+        layer_names = OSM.layer_names(layers)
 
-                query = OSM.build_osm_query(bpoly, 'geom', bbox, [layer])
+        if(pbf_filepath == None):
 
-                response = cache._load_osm_from_cache(query)
-
-                if not response:
-                    time.sleep(1) # avoiding Overpass 429 Too Many Requests
-                    response = api.get(query, build=False)
-                    cache._save_osm_to_cache(query,response)
-
-                overpass_responses[layer] = OSM.parse_osm(response)
-            else:
-                relation_handler = RelationHandler(OSM.get_osmium_filters(layer))
+            # large bounding boxes are requested by tiles (overpass_scheduler.TILE_SIZE)
+            regions = overpass_scheduler.tile_bbox(bpoly, overpass_scheduler.TILE_SIZE) if bbox else [bpoly]
 
-                relation_handler.apply_file(pbf_filepath, locations=True)
+            layer_queries = {layer: [OSM.build_osm_query(region, 'geom', bbox, [layer]) for region in regions] for layer in layer_names}
 
-                relation_elements = relation_handler.relation_elements
-                relations_position = relation_handler.relations_position
-                relation_ways_ids = relation_handler.relation_ways_ids
+            # all layers and tiles are requested concurrently (rate limits of the server are handled by the scheduler)
+            responses = overpass_scheduler.OverpassScheduler().fetch_all([query for layer in layer_names for query in layer_queries[layer]])
 
-                osmhandler = OSMHandler(OSM.get_osmium_filters(layer), relation_ways_ids)
+            for layer in layer_names:
+                overpass_responses[layer] = OSM.parse_osm(overpass_scheduler.merge_responses([responses[query] for query in layer_queries[layer]]))
 
-                osmhandler.apply_file(pbf_filepath, locations=True)
+        elif(len(layer_names) > 0):
 
-                ways_position = osmhandler.ways_position
-                ways_elements = osmhandler.ways_elements
-                ways_elements_of_relations = osmhandler.ways_elements_of_relations
-                areas = osmhandler.areas
+            from . import osm_store
 
-                complete_relation_elements = OSM.fill_relation_geom_osmium(ways_elements_of_relations, relation_elements, ways_position, relations_position, areas)
-
-                overpass_responses[layer] = OSM.parse_osm({'elements': ways_elements['elements'] + complete_relation_elements['elements']})
+            if(osm_store.is_indexed(pbf_filepath, layer_names)): # only the elements of the region are read from the store
+                region_bbox = bpoly if bbox else [min(bpoly[0::2]), min(bpoly[1::2]), max(bpoly[0::2]), max(bpoly[1::2])]
+                overpass_responses = osm_store.query_layers(pbf_filepath, region_bbox, layer_names)
+            else:
+                overpass_responses = OSM.load_pbf_layers(pbf_filepath, layer_names)
 
         result = []
         result_gdf_objects = []
@@ -360,6 +486,8 @@ class OSM:
                 layer = layer_obj['name']
                 args = layer_obj['args']
 
+            writer = None
+
             if layer == 'surface':
                 nCells = -1
                 sizeCells = -1
@@ -385,47 +513,61 @@ class OSM:
                 if 'sizeCells' in args:
                     sizeCells = args['sizeCells']
 
-                layer_geometry = OSM.osm_to_building_mesh(overpass_responses[layer], bpoly, bbox, sizeCells)
-                geometry = layer_geometry['data']
-                result_gdf_objects.append(layer_geometry['gdf']['objects'])
-                result_gdf_coordinates.append(layer_geometry['gdf']['coordinates'])
-                result_gdf_coordinates_3d.append(layer_geometry['gdf']['coordinates3d'])
                 ttype = 'BUILDINGS_LAYER'
                 styleKey = 'building'
                 renderStyle = ['SMOOTH_COLOR_MAP_TEX']
-            elif layer == 'roads':
-                layer_geometry = OSM.osm_to_roads_polyline(overpass_responses[layer], bpoly, bbox)
-                geometry = layer_geometry['data']
-                result_gdf_objects.append(layer_geometry['gdf']['objects'])
-                result_gdf_coordinates.append(layer_geometry['gdf']['coordinates'])
-                result_gdf_coordinates_3d.append(layer_geometry['gdf']['coordinates3d'])
-                ttype = 'TRIANGLES_3D_LAYER'
-                styleKey = 'roads'
-                renderStyle = ['FLAT_COLOR']
-            elif layer == 'coastline':
-                layer_geometry = OSM.osm_to_coastline_mesh(overpass_responses[layer], bpoly, bbox)
+
+                if(output_dir != None): # buildings are streamed while they are flattened
+                    writer = LayerWriter(output_dir, layer, ttype, renderStyle, styleKey).open()
+
+                layer_geometry = OSM.osm_to_building_mesh(overpass_responses[layer], bpoly, bbox, sizeCells, writer)
                 geometry = layer_geometry['data']
                 result_gdf_objects.append(layer_geometry['gdf']['objects'])
                 result_gdf_coordinates.append(layer_geometry['gdf']['coordinates'])
                 result_gdf_coordinates_3d.append(layer_geometry['gdf']['coordinates3d'])
+            else:
                 ttype = 'TRIANGLES_3D_LAYER'
-                styleKey = 'land'
+                styleKey = {'roads': 'roads', 'coastline': 'land'}.get(layer, layer)
                 renderStyle = ['FLAT_COLOR']
-            else:
-                layer_geometry = OSM.osm_to_generic_mesh(overpass_responses[layer], bpoly, bbox, convert2dto3d=True)
+
+                if(output_dir != None): # features are streamed while they are triangulated
+                    writer = LayerWriter(output_dir, layer, ttype, renderStyle, styleKey).open()
+
+                if layer == 'roads':
+                    layer_geometry = OSM.osm_to_roads_polyline(overpass_responses[layer], bpoly, bbox, writer)
+                elif layer == 'coastline':
+                    layer_geometry = OSM.osm_to_coastline_mesh(overpass_responses[layer], bpoly, bbox, writer)
+                else:
+                    layer_geometry = OSM.osm_to_generic_mesh(overpass_responses[layer], bpoly, bbox, convert2dto3d=True, writer=writer)
+
                 geometry = layer_geometry['data']
                 result_gdf_objects.append(layer_geometry['gdf']['objects'])
                 result_gdf_coordinates.append(layer_geometry['gdf']['coordinates'])
                 result_gdf_coordinates_3d.append(layer_geometry['gdf']['coordinates3d'])
-                ttype = 'TRIANGLES_3D_LAYER'
-                styleKey = layer
-                renderStyle = ['FLAT_COLOR']
 
-            result.append({'id': layer, 'type': ttype, 'renderStyle': renderStyle, 'styleKey': styleKey, 'data': geometry})
+            if(output_dir != None):
+                if(writer == None): # the surface is a single feature
+                    writer = LayerWriter(output_dir, layer, ttype, renderStyle, styleKey).open()
+                    writer.append_features(geometry)
+
+                writer.close()
+                result.append(LayerView(writer.filepath))
+            else:
+                result.append({'id': layer, 'type': ttype, 'renderStyle': renderStyle, 'styleKey': styleKey, 'data': geometry})
         
         return {'json': result, 'gdf': {'objects': result_gdf_objects, 'coordinates': result_gdf_coordinates, 'coordinates3d': result_gdf_coordinates_3d}}
 
-    def osm_to_roads_polyline(osm_elements, bpoly, bbox):
+    def _emit_feature(mesh, writer, feature_type, nodes, indices):
+        '''
+            Adds a feature built by a mesh builder to the mesh, or writes it with the writer (streamed layers do not keep it)
+        '''
+
+        if(writer != None):
+            writer.append_features([{'type': feature_type, 'geometry': {'coordinates': np.round(np.asarray(nodes, dtype=np.float64), 4), 'indices': indices}}])
+        else:
+            mesh.append({'type': feature_type, 'geometry': {'coordinates': [round(item,4) for item in nodes], 'indices': indices}})
+
+    def osm_to_roads_polyline(osm_elements, bpoly, bbox, writer=None):
         '''
             Creates the roads polyline based on the OSM elements
 
@@ -433,6 +575,7 @@ class OSM:
                 osm_elements (object): A json object describing the components of the roads layer 
                 bpoly (float[]): coordinates of bounding polygon
                 bbox: if bpoly follows the format [minLat, minLng, maxLat, maxLng]
+                writer (LayerWriter): If provided the roads are streamed to the writer and the returned data is empty
 
             Returns:
                 mesh (object): A json object describing the geometry of the layer
@@ -496,7 +639,7 @@ class OSM:
 
             nodes = utils.from_2d_to_3d(nodes)
 
-            mesh.append({'type': 'type', 'geometry': {'coordinates': [round(item,4) for item in nodes], 'indices': indices}})
+            OSM._emit_feature(mesh, writer, 'type', nodes, indices)
 
         gdf = gpd.GeoDataFrame({'geometry': geometries, 'id': ids}, crs=3395)
 
@@ -504,7 +647,7 @@ class OSM:
 
         return {'data': mesh, 'gdf': {'objects': gdf, 'coordinates': gdf_coordinates, 'coordinates3d': None}}
 
-    def osm_to_coastline_mesh(osm_elements, bpoly, using_bbox):
+    def osm_to_coastline_mesh(osm_elements, bpoly, using_bbox, writer=None):
 
         '''
             Creates the coastline mesh based on the OSM elements
@@ -513,6 +656,7 @@ class OSM:
                 osm_elements (object): A json object describing the components of the coastline layer 
                 bpoly (float[]): coordinates of bounding polygon
                 bbox: if bpoly follows the format [minLat, minLng, maxLat, maxLng]
+                writer (LayerWriter): If provided the features are streamed to the writer and the returned data is empty
 
             Returns:
                 mesh (object): A json object describing the geometry of the layer
@@ -736,7 +880,7 @@ class OSM:
 
             nodes = utils.from_2d_to_3d(nodes)
 
-            mesh.append({'type': poly['type'], 'geometry': {'coordinates': [round(item,4) for item in nodes], 'indices': indices}})
+            OSM._emit_feature(mesh, writer, poly['type'], nodes, indices)
 
         gdf = gpd.GeoDataFrame({'geometry': geometries, 'id': ids}, crs=3395)
 
@@ -744,7 +888,7 @@ class OSM:
 
         return {'data': mesh, 'gdf': {'objects': gdf, 'coordinates': gdf_coordinates, 'coordinates3d': None}}
 
-    def osm_to_building_mesh(osm_elements, bpoly, bbox = False, sizeCells = -1):
+    def osm_to_building_mesh(osm_elements, bpoly, bbox = False, sizeCells = -1, writer = None, batchSize = 1000):
         '''
             Creates the building mesh based on the OSM elements
 
@@ -752,6 +896,12 @@ class OSM:
                 osm_elements (object): A json object describing the components of the layer 
                 bpoly (float[]): coordinates of bounding polygon
                 bbox: if bpoly follows the format [minLat, minLng, maxLat, maxLng]
+                writer (LayerWriter): If provided the buildings are streamed to the writer and the returned data is empty
+                    (default is None)
+                batchSize (int): Number of buildings meshed at a time when streaming to a writer. Only the meshes of one batch
+                    are in memory, the footprints of the region and the gdf tables of the layer (objects, coordinates and
+                    coordinates3d) are still kept whole
+                    (default is 1000)
 
             Returns:
                 mesh (object): A json object describing the geometry of the layer
@@ -942,15 +1092,33 @@ class OSM:
 
         gdf_merged_buildings = Buildings.merge_overlapping_buildings(gdf)
 
-        layer_dataframes = Buildings.generate_building_layer(gdf_merged_buildings, sizeCells) #gdf, size
+        if(writer == None):
+            layer_dataframes = Buildings.generate_building_layer(gdf_merged_buildings, sizeCells) #gdf, size
+
+            df_mesh = layer_dataframes['df']
+
+            json_mesh = Buildings.df_to_json(df_mesh) # prepares the layer
+
+            return {"data": json_mesh['data'], "gdf": {'objects': layer_dataframes['gdf']['objects'], 'coordinates': layer_dataframes['gdf']['coordinates'], "coordinates3d": layer_dataframes['gdf']['coordinates3d']}}
+
+        # meshes batchSize buildings at a time so the meshes of the whole region are never in memory
+        unique_buildings = gdf_merged_buildings.index.unique()
+        layer_gdfs = []
+
+        for start in range(0, len(unique_buildings), batchSize) or [0]:
+            batch = gdf_merged_buildings.loc[unique_buildings[start:start+batchSize]]
+
+            layer_dataframes = Buildings.generate_building_layer(batch, sizeCells)
+
+            Buildings.df_to_json(layer_dataframes['df'], writer=writer)
 
-        df_mesh = layer_dataframes['df']
+            layer_gdfs.append(layer_dataframes['gdf'])
 
-        json_mesh = Buildings.df_to_json(df_mesh) # prepares the layer   
+        layer_gdf = Buildings.concat_layer_gdfs(layer_gdfs)
 
-        return {"data": json_mesh['data'], "gdf": {'objects': layer_dataframes['gdf']['objects'], 'coordinates': layer_dataframes['gdf']['coordinates'], "coordinates3d": layer_dataframes['gdf']['coordinates3d']}}
+        return {"data": [], "gdf": {'objects': layer_gdf['objects'], 'coordinates': layer_gdf['coordinates'], "coordinates3d": layer_gdf['coordinates3d']}}
 
-    def osm_to_generic_mesh(osm_elements, bpoly, bbox, convert2dto3d=False):
+    def osm_to_generic_mesh(osm_elements, bpoly, bbox, convert2dto3d=False, writer=None):
         '''
             Used to load all generic layers that do not have specific functions to handle
 
@@ -960,6 +1128,7 @@ class OSM:
                 bbox: if bpoly follows the format [minLat, minLng, maxLat, maxLng]
                 convert2dto3d (boolean): Indicates if the layer should be converted to 3D by adding z=0
                     (default is False)
+                writer (LayerWriter): If provided the features are streamed to the writer and the returned data is empty
 
             Returns:
                 mesh (object): A json object describing the geometry of the layer
@@ -1109,7 +1278,7 @@ class OSM:
             if convert2dto3d:
                 nodes = utils.from_2d_to_3d(nodes)
 
-            mesh.append({'type': 'type', 'geometry': {'coordinates': [round(item,4) for item in nodes], 'indices': indices}})
+            OSM._emit_feature(mesh, writer, 'type', nodes, indices)
         
         gdf = gpd.GeoDataFrame({'geometry': geometries, 'id': ids}, crs=3395)
 
@@ -0,0 +1,238 @@
+import os
+import json
+import hashlib
+import threading
+
+import osmium as o
+
+from shapely.geometry import Polygon, Point
+from shapely.prepared import prep
+
+from . import manifest
+
+'''
+    Extraction of the region of a pbf file (in process, replaces "osmium extract")
+
+    The extract has the ways with at least one node inside the region (with all their nodes, so the ways are complete)
+    and the relations that have one of these ways as a member, like the "simple" strategy of osmium extract.
+
+    Extracts are cached in ./urbantk_cache/extracts/, keyed by the content hash of the source file and the region. If a
+    cached bounding box extract of the same source contains the region, the new extract is read from it instead of the
+    source file, so loading neighbourhoods of a region that was already loaded does not read the whole file again.
+'''
+
+EXTRACTS_DIR = './urbantk_cache/extracts/'
+INDEX_FILE = 'index.json'
+
+_index_lock = threading.Lock()
+
+class Region:
+    '''
+        Bounding box ([minLat, minLng, maxLat, maxLng]) or polygon (flat list of lat, lng) of an extract
+    '''
+
+    def __init__(self, region):
+
+        region = [float(value) for value in region]
+
+        self.polygon = None
+
+        if(len(region) == 4):
+            self.bbox = region
+        elif(len(region) >= 6 and len(region) % 2 == 0):
+            points = [(region[i], region[i+1]) for i in range(0, len(region), 2)]
+
+            self.polygon = prep(Polygon(points))
+
+            lats = region[0::2]
+            lngs = region[1::2]
+            self.bbox = [min(lats), min(lngs), max(lats), max(lngs)]
+        else:
+            raise Exception("Region format "+str(region)+" not supported")
+
+        self.coordinates = [round(value, 7) for value in region]
+
+    def contains(self, lat, lng):
+
+        if(lat < self.bbox[0] or lat > self.bbox[2] or lng < self.bbox[1] or lng > self.bbox[3]):
+            return False
+
+        return self.polygon == None or self.polygon.contains(Point(lat, lng))
+
+    def within(self, bbox):
+        '''
+            True if the region is inside the bounding box
+        '''
+
+        return bbox[0] <= self.bbox[0] and bbox[1] <= self.bbox[1] and bbox[2] >= self.bbox[2] and bbox[3] >= self.bbox[3]
+
+class _RegionHandler(o.SimpleHandler):
+    '''
+        First pass: ways with a node inside the region, their nodes and the relations that have them
+    '''
+
+    def __init__(self, region):
+        o.SimpleHandler.__init__(self)
+        self.region = region
+
+        self.node_ids = set()
+        self.way_ids = set()
+        self.relation_ids = set()
+
+    def way(self, w):
+
+        inside = False
+
+        for node in w.nodes:
+            if(node.location.valid() and self.region.contains(node.location.lat, node.location.lon)):
+                inside = True
+                break
+
+        if(inside):
+            self.way_ids.add(w.id)
+            self.node_ids.update(node.ref for node in w.nodes)
+
+    def relation(self, r):
+
+        for member in r.members:
+            if(member.type == 'w' and member.ref in self.way_ids):
+                self.relation_ids.add(r.id)
+                break
+
+class _ExtractWriter(o.SimpleHandler):
+    '''
+        Second pass: writes the elements selected by _RegionHandler
+    '''
+
+    def __init__(self, selection, writer):
+        o.SimpleHandler.__init__(self)
+        self.selection = selection
+        self.writer = writer
+
+    def node(self, n):
+        if(n.id in self.selection.node_ids):
+            self.writer.add_node(n)
+
+    def way(self, w):
+        if(w.id in self.selection.way_ids):
+            self.writer.add_way(w)
+
+    def relation(self, r):
+        if(r.id in self.selection.relation_ids):
+            self.writer.add_relation(r)
+
+def extract_region(pbf_filepath, region, output_filepath):
+    '''
+        Writes the elements of the pbf file in the region to output_filepath (.osm.pbf). Returns output_filepath.
+
+        * @param {string} pbf_filepath Location of the source pbf file
+        * @param {List[float]} region Bounding box [minLat, minLng, maxLat, maxLng] or polygon [lat, lng, lat, lng, ...]
+        * @param {string} output_filepath Location of the extract
+    '''
+
+    if(not isinstance(region, Region)):
+        region = Region(region)
+
+    selection = _RegionHandler(region)
+    selection.apply_file(pbf_filepath, locations=True)
+
+    # the writer does not overwrite files and picks the format from the extension
+    tmp_filepath = output_filepath[:-len('.osm.pbf')]+'.tmp.osm.pbf'
+
+    if(os.path.isfile(tmp_filepath)):
+        os.remove(tmp_filepath)
+
+    writer = o.SimpleWriter(tmp_filepath)
+
+    try:
+        _ExtractWriter(selection, writer).apply_file(pbf_filepath)
+    finally:
+        writer.close()
+
+    os.replace(tmp_filepath, output_filepath)
+
+    return output_filepath
+
+def _read_index():
+
+    path = os.path.join(EXTRACTS_DIR, INDEX_FILE)
+
+    if(not os.path.isfile(path)):
+        return {"sources": {}, "extracts": {}}
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_index(index):
+
+    path = os.path.join(EXTRACTS_DIR, INDEX_FILE)
+
+    with open(path+'.tmp', "w") as outfile:
+        outfile.write(json.dumps(index, indent=4))
+
+    os.replace(path+'.tmp', path)
+
+def _source_hash(index, pbf_filepath):
+    '''
+        Content hash of the source file (hashed again only if its size or modification time changed)
+    '''
+
+    path = os.path.abspath(pbf_filepath)
+    stat = os.stat(path)
+
+    entry = index['sources'].get(path)
+
+    if(entry == None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns):
+        entry = {"hash": manifest.file_hash(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        index['sources'][path] = entry
+
+    return entry['hash']
+
+def extract(pbf_filepath, region):
+    '''
+        Returns the location of the extract of the region of a pbf file, extracting it if it is not cached
+
+        * @param {string} pbf_filepath Location of the source pbf file
+        * @param {List[float]} region Bounding box [minLat, minLng, maxLat, maxLng] or polygon [lat, lng, lat, lng, ...]
+    '''
+
+    region = Region(region)
+
+    if not os.path.exists(EXTRACTS_DIR):
+        os.makedirs(EXTRACTS_DIR)
+
+    with _index_lock:
+        index = _read_index()
+        source = _source_hash(index, pbf_filepath)
+        _write_index(index)
+
+    key = hashlib.blake2b(json.dumps({"source": source, "region": region.coordinates}).encode('utf-8'), digest_size=16).hexdigest()
+    output_filepath = os.path.join(EXTRACTS_DIR, key+'.osm.pbf')
+
+    if(key in index['extracts'] and os.path.isfile(output_filepath)):
+        return output_filepath
+
+    # smallest cached bounding box extract of the same source that contains the region
+    parent_filepath = pbf_filepath
+    parent_area = None
+
+    for parent_key, entry in index['extracts'].items():
+        parent = os.path.join(EXTRACTS_DIR, parent_key+'.osm.pbf')
+
+        if(entry['source'] != source or len(entry['region']) != 4 or not region.within(entry['region']) or not os.path.isfile(parent)):
+            continue
+
+        area = (entry['region'][2]-entry['region'][0])*(entry['region'][3]-entry['region'][1])
+
+        if(parent_area == None or area < parent_area):
+            parent_filepath = parent
+            parent_area = area
+
+    extract_region(parent_filepath, region, output_filepath)
+
+    with _index_lock:
+        index = _read_index()
+        index['extracts'][key] = {"source": source, "region": region.coordinates}
+        _write_index(index)
+
+    return output_filepath
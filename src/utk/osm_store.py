@@ -0,0 +1,250 @@
+import os
+import json
+import sqlite3
+
+from . import manifest
+from .osm import OSM, OSMHandler, RelationHandler, TagMatcher
+
+'''
+    Spatially indexed store of the OSM elements of a pbf file (utk osm index region.pbf)
+
+    The ways and relations of the OSM layers are read from the pbf once and stored in a SQLite database next to it
+    (region.osm.pbf -> region.osm.sqlite):
+        elements: one row per way or relation with the layers it belongs to (bit mask of LAYERS), its tags and its
+            bounds and geometry (json). Relations have the geometry of their member ways.
+        elements_rtree: R-tree of the bounding boxes (lat/lon) of the elements.
+        meta: size, modification time and content hash of the source file.
+
+    OSM.load(region, pbf_filepath=...) queries the store instead of reading the pbf when the store exists and is up to
+    date, so loading a bounding box only reads the elements that intersect it.
+'''
+
+LAYERS = ['buildings', 'roads', 'water', 'parks', 'coastline']
+VERSION = 1
+
+_BATCH_SIZE = 10000
+
+def store_filepath(pbf_filepath):
+    '''
+        Location of the store of a pbf file
+    '''
+
+    return os.path.splitext(pbf_filepath)[0]+'.sqlite'
+
+def _layers_mask(layers):
+
+    mask = 0
+
+    for layer in layers:
+        mask |= 1 << LAYERS.index(layer)
+
+    return mask
+
+def _pack(element):
+    '''
+        Compact json of a way or relation ({lat, lon} points as [lat, lon] pairs, ids of the nodes dropped)
+    '''
+
+    if(element['type'] == 'way'):
+        return json.dumps({'bounds': element['bounds'], 'geometry': [[point['lat'], point['lon']] for point in element['geometry']]})
+
+    return json.dumps({'bounds': element['bounds'], 'members': [{'id': member['id'], 'type': member['type'], 'role': member['role'], 'geometry': [[point['lat'], point['lon']] for point in member['geometry']]} for member in element['members']]})
+
+def _unpack(osm_type, osm_id, tags, geometry):
+
+    element = json.loads(geometry)
+
+    element['type'] = osm_type
+    element['id'] = osm_id
+    element['tags'] = json.loads(tags)
+
+    if(osm_type == 'way'):
+        element['geometry'] = [{'lat': point[0], 'lon': point[1]} for point in element['geometry']]
+    else:
+        for member in element['members']:
+            member['geometry'] = [{'lat': point[0], 'lon': point[1]} for point in member['geometry']]
+
+    return element
+
+class _StoreWriter:
+    '''
+        Inserts the elements in batches
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.count = 0
+
+    def add(self, element, layers):
+
+        bounds = element['bounds']
+
+        if(bounds == None or bounds['minlat'] == None): # no geometry
+            return
+
+        self.rows.append((element['type'], element['id'], _layers_mask(layers), json.dumps(element['tags']), _pack(element), bounds['minlat'], bounds['maxlat'], bounds['minlon'], bounds['maxlon']))
+
+        if(len(self.rows) >= _BATCH_SIZE):
+            self.flush()
+
+    def flush(self):
+
+        for row in self.rows:
+            cursor = self.connection.execute("INSERT INTO elements (osm_type, osm_id, layers, tags, geometry) VALUES (?, ?, ?, ?, ?)", row[:5])
+            self.connection.execute("INSERT INTO elements_rtree (id, minlat, maxlat, minlon, maxlon) VALUES (?, ?, ?, ?, ?)", (cursor.lastrowid,)+row[5:])
+
+        self.count += len(self.rows)
+        self.rows = []
+
+class _StoreHandler(OSMHandler):
+    '''
+        OSMHandler that writes the ways that are not part of relations to the store instead of keeping them in memory
+    '''
+
+    def __init__(self, layers_filters, relation_ways_ids, writer):
+        OSMHandler.__init__(self, layers_filters, relation_ways_ids)
+        self.writer = writer
+
+    def add_way(self, element, layers):
+
+        if(len(layers) > 0):
+            self.writer.add(element, layers)
+
+def _create_tables(connection):
+
+    connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    connection.execute("CREATE TABLE elements (id INTEGER PRIMARY KEY, osm_type TEXT, osm_id INTEGER, layers INTEGER, tags TEXT, geometry TEXT)")
+    connection.execute("CREATE VIRTUAL TABLE elements_rtree USING rtree(id, minlat, maxlat, minlon, maxlon)")
+
+def _source_meta(pbf_filepath):
+
+    stat = os.stat(pbf_filepath)
+
+    return {'size': str(stat.st_size), 'mtime': str(stat.st_mtime_ns)}
+
+def index_pbf(pbf_filepath, layers=LAYERS):
+    '''
+        Reads the layers of a pbf file into its store (store_filepath(pbf_filepath), where OSM.load looks for it). Returns
+        the location of the store.
+
+        * @param {string} pbf_filepath Location of the pbf file
+        * @param {List[string]} layers Layers to store (subset of LAYERS)
+    '''
+
+    for layer in layers:
+        if(layer not in LAYERS):
+            raise Exception("Layer "+layer+" can not be indexed. Possible values: "+", ".join(LAYERS))
+
+    output_filepath = store_filepath(pbf_filepath)
+
+    tmp_filepath = output_filepath+'.tmp'
+
+    if(os.path.isfile(tmp_filepath)):
+        os.remove(tmp_filepath)
+
+    layers_filters = {layer: OSM.get_osmium_filters(layer) for layer in layers}
+
+    connection = sqlite3.connect(tmp_filepath)
+
+    try:
+        _create_tables(connection)
+
+        writer = _StoreWriter(connection)
+
+        relation_handler = RelationHandler(layers_filters)
+
+        if(TagMatcher(layers_filters, 'rel')):
+            relation_handler.apply_file(pbf_filepath)
+
+        osmhandler = _StoreHandler(layers_filters, relation_handler.relation_ways_ids, writer)
+        osmhandler.apply_file(pbf_filepath, locations=True)
+
+        # relations (with the geometry of their ways) of each layer. A relation of several layers is stored once
+        relations = {}
+
+        for layer in layers:
+            complete_relation_elements = OSM.fill_relation_geom_osmium(osmhandler.ways_elements_of_relations[layer], relation_handler.relation_elements[layer], osmhandler.ways_position[layer], relation_handler.relations_position[layer], osmhandler.areas[layer])
+
+            for relation in complete_relation_elements['elements']:
+                relations.setdefault(relation['id'], (relation, []))[1].append(layer)
+
+        for relation, relation_layers in relations.values():
+            writer.add(relation, relation_layers)
+
+        writer.flush()
+
+        meta = _source_meta(pbf_filepath)
+        meta['source'] = os.path.abspath(pbf_filepath)
+        meta['hash'] = manifest.file_hash(pbf_filepath)
+        meta['layers'] = json.dumps(layers)
+        meta['version'] = str(VERSION)
+
+        connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", list(meta.items()))
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_filepath, output_filepath)
+
+    return output_filepath
+
+def _read_meta(connection):
+    return dict(connection.execute("SELECT key, value FROM meta").fetchall())
+
+def is_indexed(pbf_filepath, layers=None):
+    '''
+        True if the pbf file has a store that is up to date (and has the layers, if provided)
+    '''
+
+    path = store_filepath(pbf_filepath)
+
+    if(not os.path.isfile(path) or not os.path.isfile(pbf_filepath)):
+        return False
+
+    connection = sqlite3.connect(path)
+
+    try:
+        meta = _read_meta(connection)
+    except sqlite3.Error:
+        return False
+    finally:
+        connection.close()
+
+    source = _source_meta(pbf_filepath)
+
+    if(meta.get('version') != str(VERSION) or meta.get('size') != source['size'] or meta.get('mtime') != source['mtime']):
+        return False
+
+    return layers == None or all(layer in json.loads(meta['layers']) for layer in layers)
+
+def query_layers(pbf_filepath, bbox, layers):
+    '''
+        Elements of the layers that intersect a bounding box, in the format of OSM.parse_osm ({layer: {'ways': ..., 'multiways': ...}})
+
+        * @param {string} pbf_filepath Location of the indexed pbf file
+        * @param {List[float]} bbox [minLat, minLng, maxLat, maxLng]
+        * @param {List[string]} layers Layers to read
+    '''
+
+    connection = sqlite3.connect(store_filepath(pbf_filepath))
+
+    elements = {layer: [] for layer in layers}
+
+    try:
+        rows = connection.execute(
+            "SELECT e.osm_type, e.osm_id, e.layers, e.tags, e.geometry FROM elements_rtree r JOIN elements e ON e.id = r.id "
+            "WHERE r.maxlat >= ? AND r.minlat <= ? AND r.maxlon >= ? AND r.minlon <= ? AND (e.layers & ?) != 0",
+            (bbox[0], bbox[2], bbox[1], bbox[3], _layers_mask(layers))
+        )
+
+        for osm_type, osm_id, mask, tags, geometry in rows:
+            element = _unpack(osm_type, osm_id, tags, geometry)
+
+            for layer in layers:
+                if(mask & (1 << LAYERS.index(layer))):
+                    elements[layer].append(element)
+    finally:
+        connection.close()
+
+    return {layer: OSM.parse_osm({'elements': elements[layer]}) for layer in layers}
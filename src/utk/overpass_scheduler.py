@@ -0,0 +1,205 @@
+import os
+import time
+import random
+import threading
+import email.utils
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+
+'''
+    Concurrent requests to the Overpass API
+
+    The queries of the layers (and of the tiles of the region, see TILE_SIZE) are sent up to SLOTS at a time. When the
+    server answers 429 Too Many Requests (or 503/504 when it is overloaded) no slot sends a new request before the time
+    given by its Retry-After header, or before an exponential backoff if it has none. Responses are cached by query
+    (./urbantk_cache/).
+
+    The endpoint can be changed with configure(endpoint=...) or the UTK_OVERPASS_ENDPOINT environment variable (e.g.
+    a local Overpass instance or a stand-in server for tests).
+'''
+
+ENDPOINT = os.environ.get('UTK_OVERPASS_ENDPOINT', 'https://overpass-api.de/api/interpreter')
+SLOTS = 2 # the public instance gives two slots per client
+MAX_RETRIES = 5
+BACKOFF = 1.0 # seconds, doubled after each retry
+TIMEOUT = 180 # seconds
+TILE_SIZE = None # degrees. Bounding boxes larger than this are requested by tiles
+
+RETRY_STATUS = [429, 503, 504]
+
+def configure(endpoint=None, slots=None, max_retries=None, backoff=None, timeout=None, tile_size=None):
+    '''
+        Changes the defaults used by OSM.load (None keeps the current value; tile_size=0 disables tiling)
+
+        * @param {string} endpoint Url of the Overpass interpreter
+        * @param {int} slots Maximum number of concurrent requests
+        * @param {int} max_retries Retries of a request that was rate limited
+        * @param {float} backoff Wait (seconds) before the first retry of a response without Retry-After
+        * @param {float} timeout Timeout (seconds) of a request
+        * @param {float} tile_size Size (degrees) of the tiles of large bounding boxes
+    '''
+    global ENDPOINT, SLOTS, MAX_RETRIES, BACKOFF, TIMEOUT, TILE_SIZE
+
+    if(endpoint != None):
+        ENDPOINT = endpoint
+    if(slots != None):
+        SLOTS = slots
+    if(max_retries != None):
+        MAX_RETRIES = max_retries
+    if(backoff != None):
+        BACKOFF = backoff
+    if(timeout != None):
+        TIMEOUT = timeout
+    if(tile_size != None):
+        TILE_SIZE = tile_size if tile_size > 0 else None
+
+def _retry_after(value):
+    '''
+        Seconds to wait given by a Retry-After header (seconds or http date), None if missing or invalid
+    '''
+
+    if(value == None):
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def tile_bbox(bbox, tile_size):
+    '''
+        Splits a bounding box ([minLat, minLng, maxLat, maxLng]) in tiles of at most tile_size degrees
+    '''
+
+    if(tile_size == None or tile_size <= 0):
+        return [bbox]
+
+    rows = max(1, int(-(-(bbox[2]-bbox[0]) // tile_size)))
+    columns = max(1, int(-(-(bbox[3]-bbox[1]) // tile_size)))
+
+    height = (bbox[2]-bbox[0]) / rows
+    width = (bbox[3]-bbox[1]) / columns
+
+    tiles = []
+
+    for row in range(rows):
+        for column in range(columns):
+            tiles.append([bbox[0]+row*height, bbox[1]+column*width, bbox[0]+(row+1)*height, bbox[1]+(column+1)*width])
+
+    return tiles
+
+def merge_responses(responses):
+    '''
+        Elements of several responses (e.g. of the tiles of a region) without repetitions
+    '''
+
+    elements = []
+    seen = set()
+
+    for response in responses:
+        for element in response['elements']:
+            key = (element['type'], element['id'])
+
+            if(key not in seen):
+                seen.add(key)
+                elements.append(element)
+
+    return {'elements': elements}
+
+class OverpassScheduler:
+    '''
+        Sends Overpass queries concurrently
+
+        * @param {string} endpoint Url of the Overpass interpreter (ENDPOINT if None)
+        * @param {int} slots Maximum number of concurrent requests (SLOTS if None)
+    '''
+
+    def __init__(self, endpoint=None, slots=None, max_retries=None, backoff=None, timeout=None):
+        self.endpoint = ENDPOINT if endpoint == None else endpoint
+        self.slots = SLOTS if slots == None else slots
+        self.max_retries = MAX_RETRIES if max_retries == None else max_retries
+        self.backoff = BACKOFF if backoff == None else backoff
+        self.timeout = TIMEOUT if timeout == None else timeout
+
+        # no slot sends a request before this time (set by rate limited responses)
+        self._lock = threading.Lock()
+        self._not_before = 0
+
+    def _wait_turn(self):
+
+        with self._lock:
+            delay = self._not_before - time.monotonic()
+
+        if(delay > 0):
+            time.sleep(delay)
+
+    def _defer(self, delay):
+
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + delay)
+
+    def request(self, query):
+        '''
+            Sends a query (retrying with backoff while it is rate limited or the request fails) and returns the json response
+        '''
+
+        for attempt in range(self.max_retries+1):
+            self._wait_turn()
+
+            try:
+                response = requests.post(self.endpoint, data={'data': query}, timeout=self.timeout)
+            except requests.exceptions.RequestException as e: # connection errors, timeouts (e.g. a busy server), dropped responses
+                if(attempt == self.max_retries):
+                    raise Exception("Overpass request to "+self.endpoint+" failed: "+str(e))
+
+                self._defer(self.backoff * 2**attempt)
+                continue
+
+            if(response.status_code == 200):
+                return response.json()
+
+            if(response.status_code not in RETRY_STATUS):
+                raise Exception("Overpass request failed with status "+str(response.status_code)+": "+response.text[:200])
+
+            delay = _retry_after(response.headers.get('Retry-After'))
+
+            if(delay == None): # exponential backoff with jitter, so the slots do not retry at the same time
+                delay = self.backoff * 2**attempt * (1 + random.random()/2)
+
+            self._defer(delay)
+
+        raise Exception("Overpass request failed after "+str(self.max_retries+1)+" attempts (status "+str(response.status_code)+")")
+
+    def fetch(self, query):
+        '''
+            Response of a query from the cache, or from the endpoint if it is not cached
+        '''
+
+        response = cache._load_osm_from_cache(query)
+
+        if not response:
+            response = self.request(query)
+            cache._save_osm_to_cache(query, response)
+
+        return response
+
+    def fetch_all(self, queries):
+        '''
+            Responses of the queries ({query: response}), up to slots requests at a time
+        '''
+
+        queries = list(dict.fromkeys(queries))
+
+        if(len(queries) == 0):
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(self.slots, len(queries))) as executor:
+            return dict(zip(queries, executor.map(self.fetch, queries)))
@@ -0,0 +1,360 @@
+import os
+import json
+import struct
+import pyproj
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from . import channels
+from .layer_view import LayerView
+from .layer_writer import LayerWriter
+
+'''
+    Arrow/Parquet (GeoParquet) export and import of layers
+
+    Physical layers have one row per feature. Each channel (coordinates, normals, indices, ids) is a list column with the
+    type of the channel, the 2D bounding box of the feature is in the xmin, ymin, xmax, ymax columns and the other fields
+    of the features (e.g. sectionFootprint) are json strings. Thematic layers have one row per point with the x, y, z and
+    value columns. The header of the layer (id, type, renderStyle, styleKey) is stored in the "utk" metadata of the schema.
+
+    The geometry column has the WKB of each row (triangles of a mesh as a MultiPolygon Z, other features as a LineString Z
+    or Point Z, points of thematic layers as Point Z) and the "geo" metadata of GeoParquet, so GIS tools (e.g.
+    geopandas.read_parquet) can read the files. The other columns are the ones read back by from_parquet.
+'''
+
+# arrow type of the values of each channel
+ARROW_TYPES = {
+    'coordinates': 'float64',
+    'normals': 'float32',
+    'indices': 'uint32',
+    'ids': 'uint32'
+}
+
+BOUNDS_COLUMNS = ['xmin', 'ymin', 'xmax', 'ymax']
+
+GEOMETRY_COLUMN = 'geometry'
+GEOPARQUET_VERSION = '1.0.0'
+
+# ISO WKB (little endian) of a triangle: Polygon Z with one closed ring of four points
+_WKB_TRIANGLE = np.dtype([('order', 'u1'), ('type', '<u4'), ('rings', '<u4'), ('points', '<u4'), ('xyz', '<f8', (4, 3))])
+_WKB_POINT = np.dtype([('order', 'u1'), ('type', '<u4'), ('xyz', '<f8', (3,))])
+
+def _require_pyarrow():
+    if(pa == None):
+        raise Exception("Arrow/Parquet support requires the pyarrow package")
+
+def _triangles_wkb(coordinates, indices):
+    '''
+        WKB (MultiPolygon Z) of the triangles of a mesh
+
+        * @param {np.ndarray} coordinates Flat x, y, z values
+        * @param {np.ndarray} indices Flat indices of the triangles
+    '''
+
+    triangles = coordinates.reshape(-1, 3)[np.asarray(indices, dtype=np.int64).reshape(-1, 3)]
+
+    polygons = np.zeros(len(triangles), dtype=_WKB_TRIANGLE)
+    polygons['order'] = 1
+    polygons['type'] = 1003
+    polygons['rings'] = 1
+    polygons['points'] = 4
+    polygons['xyz'] = np.concatenate((triangles, triangles[:,:1]), axis=1)
+
+    return struct.pack('<BII', 1, 1006, len(polygons)) + polygons.tobytes()
+
+def _line_wkb(coordinates):
+    '''
+        WKB of a feature without triangles: Point Z if it has one point, LineString Z otherwise
+    '''
+
+    if(len(coordinates) == 3):
+        return struct.pack('<BI3d', 1, 1001, *coordinates.tolist())
+
+    return struct.pack('<BII', 1, 1002, len(coordinates)//3) + coordinates.astype('<f8').tobytes()
+
+def _points_wkb(coordinates):
+    '''
+        WKB (Point Z) of each point of a (n, 3) array
+    '''
+
+    points = np.zeros(len(coordinates), dtype=_WKB_POINT)
+    points['order'] = 1
+    points['type'] = 1001
+    points['xyz'] = coordinates
+
+    return [row.tobytes() for row in points]
+
+def _geo_metadata(geometry_types, bbox, crs):
+    '''
+        "geo" metadata of GeoParquet
+    '''
+
+    column = {'encoding': 'WKB', 'geometry_types': sorted(geometry_types), 'bbox': [float(value) for value in bbox]}
+
+    # a missing crs means OGC:CRS84 in GeoParquet, null means unknown
+    column['crs'] = pyproj.CRS.from_user_input(crs).to_json_dict() if crs != None else None
+
+    return {'version': GEOPARQUET_VERSION, 'primary_column': GEOMETRY_COLUMN, 'columns': {GEOMETRY_COLUMN: column}}
+
+def _physical_geometry(layer):
+    '''
+        WKB of each feature and its geometry types
+    '''
+
+    if('coordinates' not in layer.channel_types):
+        return None, []
+
+    values = {}
+    starts = {}
+
+    for channel in ['coordinates', 'indices']:
+        if(channel in layer.channel_types):
+            _, sizes = layer.offsets(channel)
+
+            values[channel] = np.asarray(layer.gather(channel), dtype=np.float64 if channel == 'coordinates' else np.int64)
+            starts[channel] = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+    geometries = []
+    geometry_types = set()
+
+    for index in range(layer.feature_count):
+        coordinates = values['coordinates'][starts['coordinates'][index]:starts['coordinates'][index+1]]
+
+        if('indices' in values):
+            geometries.append(_triangles_wkb(coordinates, values['indices'][starts['indices'][index]:starts['indices'][index+1]]))
+            geometry_types.add('MultiPolygon Z')
+        else:
+            geometries.append(_line_wkb(coordinates))
+            geometry_types.add('Point Z' if len(coordinates) == 3 else 'LineString Z')
+
+    return geometries, geometry_types
+
+def _physical_to_arrow(layer):
+
+    columns = {}
+
+    for channel in layer.channel_types:
+        _, sizes = layer.offsets(channel)
+
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        values = np.asarray(layer.gather(channel), dtype=np.dtype(ARROW_TYPES[channel]))
+
+        columns[channel] = pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(values))
+
+    if('coordinates' in layer.channel_types):
+        bounds = layer.bounds()
+
+        for index, name in enumerate(BOUNDS_COLUMNS):
+            columns[name] = pa.array(bounds[:,index])
+
+    # other fields are json strings
+    feature_fields = {}
+    geometry_fields = {}
+
+    for index in range(layer.feature_count):
+        feature = layer.feature_header(index)
+
+        for key in feature:
+            if(key != 'geometry'):
+                feature_fields.setdefault(key, [None]*layer.feature_count)[index] = json.dumps(feature[key])
+
+        for key in feature.get('geometry', {}):
+            if(key not in layer.channel_types):
+                geometry_fields.setdefault(key, [None]*layer.feature_count)[index] = json.dumps(feature['geometry'][key])
+
+    for fields in [feature_fields, geometry_fields]:
+        for key in fields:
+            columns[key] = pa.array(fields[key], type=pa.string())
+
+    geometries, geometry_types = _physical_geometry(layer)
+
+    if(geometries != None):
+        columns[GEOMETRY_COLUMN] = pa.array(geometries, type=pa.binary())
+
+    return pa.table(columns), list(feature_fields), list(geometry_fields), geometry_types
+
+def to_arrow(filepath, crs=3395):
+    '''
+        Returns a layer (.json of a physical or thematic layer) as an Arrow table
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {object} crs Coordinate reference system of the coordinates of the layer (EPSG code or anything accepted by pyproj), stored in the GeoParquet metadata
+    '''
+
+    _require_pyarrow()
+
+    with open(filepath, "r", encoding="utf-8") as f:
+        header = json.load(f)
+
+    if(channels.is_thematic(header)):
+        layer = channels.read_thematic(filepath, as_numpy=True, layer_json=header)
+        coordinates = np.asarray(layer['coordinates'], dtype=np.float64).reshape(-1, 3)
+
+        table = pa.table({
+            'x': coordinates[:,0],
+            'y': coordinates[:,1],
+            'z': coordinates[:,2],
+            'value': np.asarray(layer['values'], dtype=np.float64),
+            GEOMETRY_COLUMN: pa.array(_points_wkb(coordinates), type=pa.binary())
+        })
+
+        metadata = {'id': header['id'], 'thematic': True}
+        geometry_types = ['Point Z'] if len(coordinates) > 0 else []
+        bbox = [coordinates[:,0].min(), coordinates[:,1].min(), coordinates[:,0].max(), coordinates[:,1].max()] if len(coordinates) > 0 else None
+    else:
+        layer = LayerView(filepath)
+
+        table, feature_fields, geometry_fields, geometry_types = _physical_to_arrow(layer)
+
+        metadata = {key: header[key] for key in ['id', 'type', 'renderStyle', 'styleKey'] if key in header}
+        metadata['featureFields'] = feature_fields
+        metadata['geometryFields'] = geometry_fields
+
+        bbox = None
+
+        if(GEOMETRY_COLUMN in table.column_names and layer.feature_count > 0):
+            bounds = layer.bounds()
+            bbox = [bounds[:,0].min(), bounds[:,1].min(), bounds[:,2].max(), bounds[:,3].max()]
+
+    schema_metadata = {'utk': json.dumps(metadata)}
+
+    if(GEOMETRY_COLUMN in table.column_names and bbox != None):
+        schema_metadata['geo'] = json.dumps(_geo_metadata(geometry_types, bbox, crs))
+
+    return table.replace_schema_metadata(schema_metadata)
+
+def to_parquet(filepath, output_filepath=None, compression='zstd', crs=3395):
+    '''
+        Writes a layer as a GeoParquet file (see to_arrow)
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {string} output_filepath Location of the .parquet file (next to the layer if None)
+        * @param {string} compression Compression codec of the Parquet file
+        * @param {object} crs Coordinate reference system of the coordinates of the layer (see to_arrow)
+    '''
+
+    table = to_arrow(filepath, crs)
+
+    if(output_filepath == None):
+        output_filepath = os.path.splitext(filepath)[0]+'.parquet'
+
+    pq.write_table(table, output_filepath, compression=compression)
+
+    return output_filepath
+
+def _column_values(column):
+    '''
+        Flat values and size of each row of a list column
+    '''
+
+    column = column.combine_chunks()
+
+    return column.flatten().to_numpy(zero_copy_only=False), column.value_lengths().to_numpy(zero_copy_only=False)
+
+def from_arrow(table, directory=None):
+    '''
+        Converts an Arrow table created by to_arrow back to a layer
+
+        * @param {pa.Table} table Table with the layer (it may have only some of the columns)
+        * @param {string} directory If provided the layer is written to this directory (.json and .data files) and a
+            LayerView of it is returned. Otherwise the layer is returned as a json object (same format as load_utk)
+    '''
+
+    _require_pyarrow()
+
+    metadata = json.loads(table.schema.metadata[b'utk'])
+
+    if(metadata.get('thematic', False)):
+        coordinates = np.zeros((table.num_rows, 3), dtype=np.float64)
+
+        for index, name in enumerate(['x', 'y', 'z']):
+            if(name in table.column_names):
+                coordinates[:,index] = table.column(name).to_numpy()
+
+        layer_json = {"id": metadata['id'], "coordinates": coordinates.ravel().tolist()}
+
+        if('value' in table.column_names):
+            layer_json['values'] = table.column('value').to_numpy().tolist()
+
+        if(directory != None and 'values' in layer_json):
+            channels.write_thematic(os.path.join(directory, metadata['id']+'.json'), layer_json['coordinates'], layer_json['values'], metadata['id'])
+
+        return layer_json
+
+    channel_columns = [channel for channel in channels.CHANNEL_TYPES if channel in table.column_names]
+    feature_columns = [name for name in metadata.get('featureFields', []) if name in table.column_names]
+    geometry_columns = [name for name in metadata.get('geometryFields', []) if name in table.column_names]
+    extra_columns = feature_columns + geometry_columns
+
+    values = {}
+    starts = {}
+
+    for channel in channel_columns:
+        values[channel], sizes = _column_values(table.column(channel))
+        starts[channel] = np.concatenate(([0], np.cumsum(sizes)))
+
+    extra = {name: table.column(name).to_pylist() for name in extra_columns}
+
+    features = []
+
+    for index in range(table.num_rows):
+        geometry = {channel: values[channel][starts[channel][index]:starts[channel][index+1]] for channel in channel_columns}
+        feature = {}
+
+        for name in feature_columns:
+            if(extra[name][index] != None):
+                feature[name] = json.loads(extra[name][index])
+
+        for name in geometry_columns:
+            if(extra[name][index] != None):
+                geometry[name] = json.loads(extra[name][index])
+
+        feature['geometry'] = geometry
+        features.append(feature)
+
+    if(directory != None):
+        with LayerWriter(directory, metadata['id'], metadata.get('type', 'TRIANGLES_3D_LAYER'), metadata.get('renderStyle', ['FLAT_COLOR']), metadata.get('styleKey', 'surface')) as writer:
+            writer.append_features(features)
+
+        return LayerView(writer.filepath)
+
+    for feature in features:
+        for channel in channel_columns:
+            feature['geometry'][channel] = feature['geometry'][channel].tolist()
+
+    layer_json = {key: metadata[key] for key in metadata if key not in ['featureFields', 'geometryFields']}
+    layer_json['data'] = features
+
+    return layer_json
+
+def from_parquet(filepath, columns=None, directory=None, bbox=None):
+    '''
+        Reads a layer written by to_parquet
+
+        * @param {string} filepath Location of the .parquet file
+        * @param {List[string]} columns Only these columns are read (e.g. ['coordinates', 'indices']). All if None
+        * @param {string} directory If provided the layer is written to this directory (see from_arrow)
+        * @param {List[float]} bbox Only the features (or points) inside [minx, miny, maxx, maxy] are read
+    '''
+
+    _require_pyarrow()
+
+    filters = None
+
+    if(bbox != None):
+        names = pq.read_schema(filepath).names
+
+        if('xmin' in names): # physical layer
+            filters = [('xmin', '<=', bbox[2]), ('ymin', '<=', bbox[3]), ('xmax', '>=', bbox[0]), ('ymax', '>=', bbox[1])]
+        else:
+            filters = [('x', '>=', bbox[0]), ('y', '>=', bbox[1]), ('x', '<=', bbox[2]), ('y', '<=', bbox[3])]
+
+    table = pq.read_table(filepath, columns=columns, filters=filters)
+
+    return from_arrow(table, directory)
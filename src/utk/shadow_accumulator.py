@@ -1,7 +1,6 @@
 import pysolar
 import threading
 import pytz
-import struct
 
 import timezonefinder
 import math
@@ -18,6 +17,10 @@ if sys.platform != "darwin":
     from plotoptix import NpOptiX
     from plotoptix.geometry import PinnedBuffer
 
+from . import channels
+from .layer_view import LayerView
+from .load_utk import load_layers
+
 class ShadowAccumulator:
     '''
         Calculate shadow accumulation considering meshes stored in json files.
@@ -299,10 +302,7 @@ class ShadowAccumulator:
                     flat_coords = flat_coords[geometry_count*3:] # remove the values that belong to the current mesh
                     function_values = function_values[geometry_count:] # remove the values that belong to the current mesh
 
-                shadow_layer = {'id': "shadow"+str(function_index)+'_'+fileName, 'coordinates': [round(item,4) for item in flat_coords_this_file], 'values': [round(item,4) for item in function_values_this_file]}
-
-                with open(os.path.join(directory, "shadow"+str(function_index)+'_'+fileName+".json"), "w") as outfile:
-                    json.dump(shadow_layer, outfile)
+                channels.write_thematic(os.path.join(directory, "shadow"+str(function_index)+'_'+fileName+".json"), flat_coords_this_file, function_values_this_file)
 
     def accumulate_shadow(self):
         '''
@@ -339,106 +339,25 @@ class ShadowAccumulator:
 
     def load_files(self):
 
-        for filepath in self.filespaths:
-
-            file = open(filepath, mode='r')
-            file_content = json.loads(file.read())
-
-            directory = os.path.dirname(filepath)
-            # file name with extension
-            file_name = os.path.basename(filepath)
-            # file name without extension
-            file_name_wo_extension = os.path.splitext(file_name)[0]
-
-            coordinates = []
-            normals = []
-            indices = []
-            ids = []
-
-            if('coordinates' in file_content['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_coordinates.data'), "rb")
-
-                data = f.read()
-
-                unpacked_data = struct.iter_unpack('d', data)
-
-                for elem in unpacked_data:
-                    coordinates.append(elem[0])
-
-                f.close()
-            if('normals' in file_content['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_normals.data'), "rb")
-
-                data = f.read()
-
-                unpacked_data = struct.iter_unpack('f', data)
-
-                for elem in unpacked_data:
-                    normals.append(elem[0])
-
-                f.close()
-            if('indices' in file_content['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_indices.data'), "rb")
-
-                data = f.read()
+        layers = load_layers(self.filespaths, lazy=True, mmap=False) # the channels of all files are decoded concurrently
 
-                unpacked_data = struct.iter_unpack('I', data)
+        for layer in layers:
 
-                for elem in unpacked_data:
-                    indices.append(elem[0])
+            _, coordinates_sizes = layer.offsets('coordinates')
+            _, indices_sizes = layer.offsets('indices')
+            _, ids_sizes = layer.offsets('ids')
 
-                f.close()
-            if('ids' in file_content['data'][0]['geometry']):
-                f = open(os.path.join(directory,file_name_wo_extension+'_ids.data'), "rb")
+            # indices are local to each feature. They are offset by the vertices of the previous features (and files)
+            vertices_per_feature = coordinates_sizes//3 # considers always a 3d mesh
+            first_vertex = np.concatenate(([0], np.cumsum(vertices_per_feature)[:-1])) + self.coords.shape[0]
 
-                data = f.read()
+            file_coords = np.reshape(layer.gather('coordinates').astype(np.float64), (-1, 3))
+            file_indices = np.reshape(layer.gather('indices').astype(np.int64) + np.repeat(first_vertex, indices_sizes), (-1, 3))
+            file_ids = layer.gather('ids').astype(np.int64)
+            file_normals = np.reshape(layer.gather('normals').astype(np.float64), (-1, 3))
 
-                unpacked_data = struct.iter_unpack('I', data)
-
-                for elem in unpacked_data:
-                    ids.append(elem[0])
-
-                f.close()
-
-            for i in range(len(file_content['data'])):
-
-                if(len(coordinates) > 0):
-                    startAndSize = file_content['data'][i]['geometry']['coordinates']
-                    file_content['data'][i]['geometry']['coordinates'] = coordinates[startAndSize[0]:startAndSize[0]+startAndSize[1]]
-
-                if(len(indices) > 0):
-                    startAndSize = file_content['data'][i]['geometry']['indices']
-                    file_content['data'][i]['geometry']['indices'] = indices[startAndSize[0]:startAndSize[0]+startAndSize[1]]
-
-                if(len(normals) > 0):
-                    startAndSize = file_content['data'][i]['geometry']['normals']
-                    file_content['data'][i]['geometry']['normals'] = normals[startAndSize[0]:startAndSize[0]+startAndSize[1]]
-
-                if(len(ids) > 0):
-                    startAndSize = file_content['data'][i]['geometry']['ids']
-                    file_content['data'][i]['geometry']['ids'] = ids[startAndSize[0]:startAndSize[0]+startAndSize[1]]
-
-            file_coords = []
-            file_indices = []
-            file_ids = []
-            file_normals = []
-
-            self.coords_per_file.append([])
-
-            for element in file_content['data']:
-                file_indices += [int(item)+int(len(file_coords)/3)+self.coords.shape[0] for item in element['geometry']['indices']] # concat in the end of the list # considers always a 3d mesh
-                file_coords += element['geometry']['coordinates'] # concat in the end of the list
-                file_ids += element['geometry']['ids'] # concat in the end of the list
-                file_normals += element['geometry']['normals'] # concat in the end of the list
-
-                self.ids_per_structure.append(len(element['geometry']['ids']))
-
-                self.coords_per_file[-1].append(int(len(element['geometry']['coordinates'])/3)) # considers always a 3d mesh
-
-            file_coords = np.reshape(np.array(file_coords), (int(len(file_coords)/3), -1)) # considers always a 3d mesh
-            file_indices = np.reshape(np.array(file_indices), (int(len(file_indices)/3), -1)) # considers always a 3d mesh
-            file_ids = np.array(file_ids)
-            file_normals = np.reshape(np.array(file_normals), (int(len(file_normals)/3), -1)) # considers always a 3d mesh
+            self.ids_per_structure += ids_sizes.tolist()
+            self.coords_per_file.append(vertices_per_feature.tolist())
 
             if len(self.coords) == 0:
                 self.coords = np.copy(file_coords)
@@ -460,8 +379,6 @@ class ShadowAccumulator:
             else:
                 self.normals = np.concatenate((self.normals, file_normals), axis=0)
 
-            file.close()
-
         self.ids_per_structure = np.array(self.ids_per_structure)
 
         self.coords_before_transformation = np.copy(self.coords)
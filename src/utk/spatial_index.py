@@ -0,0 +1,310 @@
+import numpy as np
+
+from . import cache
+from . import channels
+
+'''
+    Spatial index of the features of a layer
+
+    The 2D bounding boxes of the features are stored as a packed Hilbert R-tree next to the layer:
+        <id>_rtree.data: float64 boxes (minx, miny, maxx, maxy) of all nodes, level by level starting by the leaves
+        <id>_rtree_ids.data: uint32 feature of each leaf
+    and described in the .json by "rtree": {"nodeSize": ..., "levelBounds": [end of each level]}.
+
+    Leaves are sorted along a Hilbert curve and each node has nodeSize children, so the children of the node j of
+    a level are the nodes j*nodeSize ... (j+1)*nodeSize-1 of the level below.
+
+    The features themselves can also be sorted along a Hilbert or Z-order curve when the layer is saved, so neighbouring
+    features are close in the channel files. The position each feature had before is stored in <id>_order.data (uint32)
+    and the .json gets "order": {"curve": ...}.
+'''
+
+NODE_SIZE = 16
+
+RTREE_CHANNEL = 'rtree'
+RTREE_IDS_CHANNEL = 'rtree_ids'
+ORDER_CHANNEL = 'order'
+
+def _interleave(values):
+
+    values = (values | (values << np.uint32(8))) & np.uint32(0x00FF00FF)
+    values = (values | (values << np.uint32(4))) & np.uint32(0x0F0F0F0F)
+    values = (values | (values << np.uint32(2))) & np.uint32(0x33333333)
+    values = (values | (values << np.uint32(1))) & np.uint32(0x55555555)
+
+    return values
+
+def zorder_index(x, y):
+    '''
+        Position along a Z-order (Morton) curve of integer coordinates in [0, 65535]
+    '''
+
+    x = np.asarray(x, dtype=np.uint32)
+    y = np.asarray(y, dtype=np.uint32)
+
+    return _interleave(x) | (_interleave(y) << np.uint32(1))
+
+def hilbert_index(x, y):
+    '''
+        Position along a Hilbert curve of integer coordinates in [0, 65535] (branchless version used by flatbush)
+    '''
+
+    x = np.asarray(x, dtype=np.uint32)
+    y = np.asarray(y, dtype=np.uint32)
+
+    full = np.uint32(0xFFFF)
+    one, two, four, eight = np.uint32(1), np.uint32(2), np.uint32(4), np.uint32(8)
+
+    a = x ^ y
+    b = full ^ a
+    c = full ^ (x | y)
+    d = x & (y ^ full)
+
+    A = a | (b >> one)
+    B = (a >> one) ^ a
+    C = ((c >> one) ^ (b & (d >> one))) ^ c
+    D = ((a & (c >> one)) ^ (d >> one)) ^ d
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> two)) ^ (b & (b >> two))
+    B = (a & (b >> two)) ^ (b & ((a ^ b) >> two))
+    C = C ^ ((a & (c >> two)) ^ (b & (d >> two)))
+    D = D ^ ((b & (c >> two)) ^ ((a ^ b) & (d >> two)))
+
+    a, b, c, d = A, B, C, D
+    A = (a & (a >> four)) ^ (b & (b >> four))
+    B = (a & (b >> four)) ^ (b & ((a ^ b) >> four))
+    C = C ^ ((a & (c >> four)) ^ (b & (d >> four)))
+    D = D ^ ((b & (c >> four)) ^ ((a ^ b) & (d >> four)))
+
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> eight)) ^ (b & (d >> eight)))
+    D = D ^ ((b & (c >> eight)) ^ ((a ^ b) & (d >> eight)))
+
+    a = C ^ (C >> one)
+    b = D ^ (D >> one)
+
+    i0 = x ^ y
+    i1 = b | (full ^ (i0 | a))
+
+    return (_interleave(i1) << one) | _interleave(i0)
+
+def curve_order(bounds, curve='hilbert'):
+    '''
+        Order of the boxes along a space filling curve (by their centers). Empty boxes go to the end.
+
+        * @param {np.ndarray} bounds (n, 4) array of boxes (minx, miny, maxx, maxy)
+        * @param {string} curve 'hilbert' or 'zorder'
+    '''
+
+    if(curve not in ['hilbert', 'zorder']):
+        raise Exception("Curve "+str(curve)+" not supported. Use hilbert or zorder")
+
+    if(len(bounds) == 0):
+        return np.empty(0, dtype=np.int64)
+
+    valid = bounds[:,0] <= bounds[:,2]
+
+    if(not valid.any()):
+        return np.arange(len(bounds))
+
+    centers = np.stack(((bounds[valid,0]+bounds[valid,2])/2, (bounds[valid,1]+bounds[valid,3])/2), axis=1)
+
+    low = centers.min(axis=0)
+    extent = centers.max(axis=0) - low
+    extent[extent == 0] = 1
+
+    grid = np.zeros((len(bounds), 2), dtype=np.uint32)
+    grid[valid] = np.floor((centers - low) / extent * 65535).astype(np.uint32)
+
+    if(curve == 'hilbert'):
+        keys = hilbert_index(grid[:,0], grid[:,1]).astype(np.int64)
+    else:
+        keys = zorder_index(grid[:,0], grid[:,1]).astype(np.int64)
+
+    keys[~valid] = np.iinfo(np.int64).max
+
+    return np.argsort(keys, kind='stable')
+
+def feature_bounds(coordinates, sizes, dimensions=3):
+    '''
+        2D bounding box of every feature. Features without coordinates get an empty box (inf, inf, -inf, -inf).
+
+        * @param {np.ndarray} coordinates Coordinates of all features, concatenated in order
+        * @param {np.ndarray} sizes Number of coordinate values of each feature
+        * @param {int} dimensions Values per vertex
+    '''
+
+    vertices = np.asarray(coordinates).reshape(-1, dimensions)
+    vertex_sizes = np.asarray(sizes, dtype=np.int64) // dimensions
+
+    bounds = np.empty((len(vertex_sizes), 4), dtype=np.float64)
+    bounds[:,:2] = np.inf
+    bounds[:,2:] = -np.inf
+
+    nonempty = vertex_sizes > 0
+
+    if(nonempty.any()):
+        starts = (np.cumsum(vertex_sizes) - vertex_sizes)[nonempty] # empty features take no room, so reduceat sees contiguous segments
+
+        bounds[nonempty,0] = np.minimum.reduceat(vertices[:,0], starts)
+        bounds[nonempty,1] = np.minimum.reduceat(vertices[:,1], starts)
+        bounds[nonempty,2] = np.maximum.reduceat(vertices[:,0], starts)
+        bounds[nonempty,3] = np.maximum.reduceat(vertices[:,1], starts)
+
+    return bounds
+
+class RTree:
+    '''
+        Packed Hilbert R-tree over the bounding boxes of the features of a layer
+    '''
+
+    def __init__(self, boxes, ids, level_bounds, node_size=NODE_SIZE):
+        '''
+            * @param {np.ndarray} boxes (nodes, 4) boxes of all nodes, level by level starting by the leaves
+            * @param {np.ndarray} ids Feature of each leaf
+            * @param {List[int]} level_bounds End of each level in boxes
+            * @param {int} node_size Children per node
+        '''
+
+        self.boxes = boxes
+        self.ids = ids
+        self.level_bounds = list(level_bounds)
+        self.node_size = node_size
+
+    @staticmethod
+    def build(bounds, node_size=NODE_SIZE):
+        '''
+            Builds the tree from the (n, 4) bounding boxes of the features
+        '''
+
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+        order = curve_order(bounds)
+
+        levels = [bounds[order]]
+
+        while(len(levels[-1]) > 1):
+            level = levels[-1]
+            starts = np.arange(0, len(level), node_size)
+
+            parents = np.empty((len(starts), 4), dtype=np.float64)
+            parents[:,0] = np.minimum.reduceat(level[:,0], starts)
+            parents[:,1] = np.minimum.reduceat(level[:,1], starts)
+            parents[:,2] = np.maximum.reduceat(level[:,2], starts)
+            parents[:,3] = np.maximum.reduceat(level[:,3], starts)
+
+            levels.append(parents)
+
+        level_bounds = np.cumsum([len(level) for level in levels]).tolist()
+
+        return RTree(np.concatenate(levels), order.astype(np.uint32), level_bounds, node_size)
+
+    def search(self, bbox):
+        '''
+            Features whose bounding box intersects bbox ([minx, miny, maxx, maxy]), sorted
+
+            * @param {List[float]} bbox Window in the coordinates of the layer
+        '''
+
+        if(len(self.ids) == 0):
+            return np.empty(0, dtype=np.int64)
+
+        minx, miny, maxx, maxy = bbox
+
+        level_starts = [0] + self.level_bounds[:-1]
+
+        level = len(self.level_bounds) - 1
+        nodes = np.arange(level_starts[level], self.level_bounds[level]) # global position of the nodes to test
+
+        while(True):
+            boxes = self.boxes[nodes]
+
+            hits = nodes[(boxes[:,0] <= maxx) & (boxes[:,1] <= maxy) & (boxes[:,2] >= minx) & (boxes[:,3] >= miny)]
+
+            if(level == 0):
+                return np.sort(self.ids[hits].astype(np.int64))
+
+            if(len(hits) == 0):
+                return np.empty(0, dtype=np.int64)
+
+            # children of the hits in the level below
+            first_child = (hits - level_starts[level]) * self.node_size + level_starts[level-1]
+            last_child = np.minimum(first_child + self.node_size, self.level_bounds[level-1])
+
+            counts = last_child - first_child
+            nodes = np.repeat(first_child - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+            level -= 1
+
+    def write(self, filepath):
+        '''
+            Writes the tree next to the layer and returns the "rtree" entry of the .json
+
+            * @param {string} filepath Location of the .json of the layer
+        '''
+
+        for channel, values in [(RTREE_CHANNEL, self.boxes.astype(np.float64)), (RTREE_IDS_CHANNEL, self.ids.astype(np.uint32))]:
+            path = channels.channel_filepath(filepath, channel)
+            cache._invalidate_channel(path)
+            values.tofile(path)
+
+        return {"nodeSize": self.node_size, "levelBounds": self.level_bounds}
+
+    @staticmethod
+    def read(filepath, layer_json, mmap=True):
+        '''
+            Reads the tree described by the "rtree" entry of a layer
+        '''
+
+        header = layer_json['rtree']
+
+        boxes = channels.read_channel(channels.channel_filepath(filepath, RTREE_CHANNEL), 'd', mmap=mmap).reshape(-1, 4)
+        ids = channels.read_channel(channels.channel_filepath(filepath, RTREE_IDS_CHANNEL), 'I', mmap=mmap)
+
+        return RTree(boxes, ids, header['levelBounds'], header['nodeSize'])
+
+def write_rtree(filepath, bounds, node_size=NODE_SIZE):
+    '''
+        Builds and writes the spatial index of a layer. Returns the "rtree" entry of the .json
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {np.ndarray} bounds (n, 4) bounding boxes of the features (see feature_bounds)
+    '''
+
+    return RTree.build(bounds, node_size).write(filepath)
+
+def write_order(filepath, order):
+    '''
+        Writes the <id>_order.data sidecar of a reordered layer: the position each feature had in the source (uint32)
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {np.ndarray} order Source position of each feature, in the new order
+    '''
+
+    path = channels.channel_filepath(filepath, ORDER_CHANNEL)
+
+    cache._invalidate_channel(path)
+
+    np.asarray(order, dtype=np.uint32).tofile(path)
+
+def reorder_features(features, curve='hilbert'):
+    '''
+        Sorts the features of a json layer (with the channels still as lists/arrays) along a space filling curve, in place.
+        Returns the source position of each feature in the new order.
+
+        * @param {List[object]} features Features of the layer ({'geometry': {'coordinates': [...], ...}})
+        * @param {string} curve 'hilbert' or 'zorder'
+    '''
+
+    coordinates = [np.asarray(feature['geometry']['coordinates'], dtype=np.float64) for feature in features]
+
+    sizes = [len(values) for values in coordinates]
+
+    bounds = feature_bounds(np.concatenate(coordinates) if len(coordinates) > 0 else np.empty(0), sizes)
+
+    order = curve_order(bounds, curve)
+
+    features[:] = [features[index] for index in order]
+
+    return order
@@ -0,0 +1,257 @@
+import os
+import json
+import numpy as np
+
+from . import manifest
+from . import spatial_index
+from .layer_view import LayerView
+from .layer_writer import LayerWriter
+
+'''
+    Quadtree tileset of a physical layer (utk tiles build)
+
+    The square that contains the layer is split recursively in four while a tile has more than max_features features
+    (by the center of their bounding box). Each tile is written as a layer <id>_<level>_<x>_<y> next to the tileset:
+        leaf tiles have the full geometry of their features. Their <tile>_order.data has the feature of the source
+        layer each feature comes from (LayerView.source_order()).
+        inner tiles have blocks: the features in each cell of a block_resolution x block_resolution grid of the tile are
+        merged into one box (their 2D bounding box, from the lowest to the highest z), so coarser levels have bigger
+        blocks and fewer triangles.
+
+    The tileset (<id>_tileset.json) lists the tiles with their bounds and the zoom range where they should be drawn. zoom
+    is the one of the grammar's knotVisibility tests (height of the camera in km): a tile is drawn while the camera is
+    lower than its size times zoom_scale and higher than the size of its children, and each tile has its "test" string.
+'''
+
+MAX_FEATURES = 2000
+MAX_LEVEL = 8
+BLOCK_RESOLUTION = 16
+
+def _zoom_test(min_zoom, max_zoom):
+    '''
+        knotVisibility test of a zoom range (None is unbounded)
+    '''
+
+    tests = []
+
+    if(min_zoom != None):
+        tests.append("zoom > "+str(min_zoom))
+
+    if(max_zoom != None):
+        tests.append("zoom <= "+str(max_zoom))
+
+    if(len(tests) == 0):
+        return "true"
+
+    return " && ".join(tests)
+
+def _feature_heights(layer):
+    '''
+        Lowest and highest z of every feature
+    '''
+
+    _, sizes = layer.offsets('coordinates')
+
+    vertices = np.asarray(layer.gather('coordinates')).reshape(-1, 3)
+    vertex_sizes = np.asarray(sizes, dtype=np.int64)//3
+
+    heights = np.zeros((len(vertex_sizes), 2), dtype=np.float64)
+
+    nonempty = vertex_sizes > 0
+
+    if(nonempty.any()):
+        starts = (np.cumsum(vertex_sizes) - vertex_sizes)[nonempty]
+        heights[nonempty,0] = np.minimum.reduceat(vertices[:,2], starts)
+        heights[nonempty,1] = np.maximum.reduceat(vertices[:,2], starts)
+
+    return heights
+
+def _block(box, bottom, top):
+    '''
+        Mesh (coordinates, normals, indices) of a box: top face and, if it has height, the four sides
+    '''
+
+    minx, miny, maxx, maxy = box
+
+    faces = [([(minx, miny, top), (maxx, miny, top), (maxx, maxy, top), (minx, maxy, top)], (0, 0, 1))]
+
+    if(top > bottom):
+        faces += [
+            ([(minx, miny, bottom), (maxx, miny, bottom), (maxx, miny, top), (minx, miny, top)], (0, -1, 0)),
+            ([(maxx, miny, bottom), (maxx, maxy, bottom), (maxx, maxy, top), (maxx, miny, top)], (1, 0, 0)),
+            ([(maxx, maxy, bottom), (minx, maxy, bottom), (minx, maxy, top), (maxx, maxy, top)], (0, 1, 0)),
+            ([(minx, maxy, bottom), (minx, miny, bottom), (minx, miny, top), (minx, maxy, top)], (-1, 0, 0))
+        ]
+
+    coordinates = []
+    normals = []
+    indices = []
+
+    for corners, normal in faces:
+        first = len(coordinates)//3
+
+        for corner in corners:
+            coordinates += corner
+            normals += normal
+
+        indices += [first, first+1, first+2, first, first+2, first+3]
+
+    return coordinates, normals, indices
+
+def _write_blocks(directory, tile_id, layer, features, bounds, heights, tile_bounds, block_resolution):
+    '''
+        Writes an inner tile: the features merged by cell of a grid of the tile
+    '''
+
+    size = (tile_bounds[2] - tile_bounds[0]) / block_resolution
+
+    centers = np.stack(((bounds[features,0]+bounds[features,2])/2, (bounds[features,1]+bounds[features,3])/2), axis=1)
+    cells = np.clip(np.floor((centers - tile_bounds[:2]) / size).astype(np.int64), 0, block_resolution-1)
+    keys = cells[:,1]*block_resolution + cells[:,0]
+
+    with LayerWriter(directory, tile_id, layer['type'], layer['renderStyle'], layer['styleKey']) as writer:
+        for block_id, key in enumerate(np.unique(keys)):
+            group = features[keys == key]
+
+            box = [bounds[group,0].min(), bounds[group,1].min(), bounds[group,2].max(), bounds[group,3].max()]
+
+            coordinates, normals, indices = _block(box, heights[group,0].min(), heights[group,1].max())
+
+            values = {'coordinates': coordinates, 'indices': indices}
+
+            if('normals' in layer.channel_types):
+                values['normals'] = normals
+
+            if('ids' in layer.channel_types):
+                values['ids'] = [block_id]*(len(indices)//3)
+
+            writer.append_feature(**values)
+
+    return writer.filepath
+
+def _write_leaf(directory, tile_id, layer, features):
+    '''
+        Writes a leaf tile: the features with their full geometry
+    '''
+
+    tile_json = layer.to_json(as_numpy=True, features=features)
+
+    with LayerWriter(directory, tile_id, layer['type'], layer['renderStyle'], layer['styleKey']) as writer:
+        writer.append_features(tile_json['data'])
+
+    # feature of the source layer of each feature of the tile
+    spatial_index.write_order(writer.filepath, features)
+
+    with open(writer.filepath, "r", encoding="utf-8") as f:
+        header = json.load(f)
+
+    header['order'] = {"source": layer['id']}
+
+    with open(writer.filepath, "w") as outfile:
+        outfile.write(json.dumps(header))
+
+    manifest.update_layer(writer.filepath)
+
+    return writer.filepath
+
+def build_tileset(filepath, output_dir=None, max_features=MAX_FEATURES, max_level=MAX_LEVEL, block_resolution=BLOCK_RESOLUTION, zoom_scale=1.0):
+    '''
+        Splits a layer in a quadtree of tiles and writes them with the tileset index. Returns the location of the tileset.
+
+        * @param {string} filepath Location of the .json of the layer
+        * @param {string} output_dir Directory of the tiles and the tileset (directory of the layer if None)
+        * @param {int} max_features Tiles with more features are split (unless they are at max_level)
+        * @param {int} max_level Deepest level of the quadtree
+        * @param {int} block_resolution Cells per side of the grid used to merge the features of inner tiles
+        * @param {float} zoom_scale Camera height (in tile sizes) under which the children of a tile replace it
+    '''
+
+    layer = LayerView(filepath)
+
+    if('coordinates' not in layer.channel_types):
+        raise Exception("Only layers with coordinates can be tiled")
+
+    if(output_dir == None):
+        output_dir = os.path.dirname(filepath)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    bounds = layer.bounds()
+    heights = _feature_heights(layer)
+
+    valid = np.nonzero(bounds[:,0] <= bounds[:,2])[0]
+
+    if(len(valid) == 0):
+        raise Exception("Layer has no geometry to tile")
+
+    centers = np.stack(((bounds[:,0]+bounds[:,2])/2, (bounds[:,1]+bounds[:,3])/2), axis=1)
+
+    low = bounds[valid,:2].min(axis=0)
+    size = max((bounds[valid,2:].max(axis=0) - low).max(), 1e-6) # square root tile
+
+    with manifest.batch(): # a single manifest update for all the tiles
+        tiles = []
+
+        # (level, x, y, features)
+        pending = [(0, 0, 0, valid)]
+
+        while(len(pending) > 0):
+            level, x, y, features = pending.pop()
+
+            tile_size = size / (1<<level)
+            tile_bounds = np.array([low[0] + x*tile_size, low[1] + y*tile_size, low[0] + (x+1)*tile_size, low[1] + (y+1)*tile_size])
+
+            tile_id = layer['id']+'_'+str(level)+'_'+str(x)+'_'+str(y)
+
+            leaf = len(features) <= max_features or level >= max_level
+
+            if(leaf):
+                _write_leaf(output_dir, tile_id, layer, features)
+            else:
+                _write_blocks(output_dir, tile_id, layer, features, bounds, heights, tile_bounds, block_resolution)
+
+                # children by the center of the features
+                half = tile_bounds[:2] + tile_size/2
+                right = centers[features,0] >= half[0]
+                top = centers[features,1] >= half[1]
+
+                for child_x, child_y, mask in [(0, 0, ~right & ~top), (1, 0, right & ~top), (0, 1, ~right & top), (1, 1, right & top)]:
+                    if(mask.any()):
+                        pending.append((level+1, x*2+child_x, y*2+child_y, features[mask]))
+
+            # drawn between the size of its children (unless it is a leaf) and its size (unless it is the root)
+            max_zoom = None if level == 0 else tile_size*zoom_scale/1000
+            min_zoom = None if leaf else tile_size/2*zoom_scale/1000
+
+            tiles.append({
+                "id": tile_id,
+                "level": level,
+                "x": x,
+                "y": y,
+                "bounds": tile_bounds.tolist(),
+                "features": int(len(features)),
+                "leaf": leaf,
+                "minZoom": min_zoom,
+                "maxZoom": max_zoom,
+                "test": _zoom_test(min_zoom, max_zoom)
+            })
+
+        tiles.sort(key=lambda tile: (tile['level'], tile['y'], tile['x']))
+
+        tileset = {
+            "id": layer['id'],
+            "bounds": [float(low[0]), float(low[1]), float(low[0]+size), float(low[1]+size)],
+            "maxFeatures": max_features,
+            "levels": max(tile['level'] for tile in tiles)+1,
+            "tiles": tiles
+        }
+
+        tileset_filepath = os.path.join(output_dir, layer['id']+'_tileset.json')
+
+        with open(tileset_filepath, "w") as outfile:
+            outfile.write(json.dumps(tileset, indent=4))
+
+        manifest.update_manifest(output_dir, [tileset_filepath], create=True)
+
+    return tileset_filepath
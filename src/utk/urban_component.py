@@ -1,12 +1,30 @@
 import json
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os
-import struct
+import re
+import shutil
 import webbrowser
 
 from shapely.geometry import Polygon, Point
 
+from . import channels
+from . import spatial_index
+from . import manifest
+from . import mesh_optimizer
+from .layer_view import LayerView
+
+def _as_list(values):
+    '''
+        Values of a channel as a list (channels of LayerViews are numpy arrays, and indexing them value by value is slow)
+    '''
+
+    if(isinstance(values, np.ndarray)):
+        return values.tolist()
+
+    return values
+
 class UrbanComponent:
     """
     Basic Urban Toolkit component
@@ -62,10 +80,13 @@ class UrbanComponent:
 
                 polygon_coordinates = None
 
-                if('sectionFootprint' in elem['geometry']):
-                    polygon_coordinates = elem['geometry']['sectionFootprint'][0] # used for buildings
+                geometry = elem['geometry'] # LayerView features build their geometry on access, so it is fetched once
+                is_building = 'sectionFootprint' in geometry
+
+                if(is_building):
+                    polygon_coordinates = geometry['sectionFootprint'][0] # used for buildings
                 else:
-                    polygon_coordinates = elem['geometry']['coordinates']
+                    polygon_coordinates = _as_list(geometry['coordinates'])
 
                 for i in range(0,int(len(polygon_coordinates)/dimensions)):
                     geometries_coordinates.append(Point(polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1]))
@@ -74,14 +95,16 @@ class UrbanComponent:
                     
                     groupedCoordinates.append((polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1]))
 
-                    if(dimensions == 3 and 'sectionFootprint' not in elem['geometry']): # if it has a 3d representation and it is not a building
+                    if(dimensions == 3 and not is_building): # if it has a 3d representation and it is not a building
                         tridimensional_coordinates.append([polygon_coordinates[i*dimensions], polygon_coordinates[i*dimensions+1], polygon_coordinates[i*dimensions+2]])
                         ids_tridimensional_coordinates.append(counter_id_tridimensional_coordinates)        
                         counter_id_tridimensional_coordinates += 1  
 
-                if('sectionFootprint' in elem['geometry']): # it is a building so a 3d representation must be included (it comes from the coordinates field)
-                    for i in range(0,int(len(elem['geometry']['coordinates'])/3)):
-                        tridimensional_coordinates.append([elem['geometry']['coordinates'][i*3], elem['geometry']['coordinates'][i*3+1], elem['geometry']['coordinates'][i*3+2]])
+                if(is_building): # it is a building so a 3d representation must be included (it comes from the coordinates field)
+                    building_coordinates = _as_list(geometry['coordinates'])
+
+                    for i in range(0,int(len(building_coordinates)/3)):
+                        tridimensional_coordinates.append([building_coordinates[i*3], building_coordinates[i*3+1], building_coordinates[i*3+2]])
                         ids_tridimensional_coordinates.append(counter_id_tridimensional_coordinates)        
                         counter_id_tridimensional_coordinates += 1  
 
@@ -112,42 +135,70 @@ class UrbanComponent:
 
         return {'objects': gdf, 'coordinates': gdf_coordinates, 'coordinates3d': df_coordinates3d}
 
-    def break_into_binary(self, filepath, filename, data, types, dataTypes):
-
-        transformed_data = data
+    def _per_vertex_data(self, workDir, layer_id):
+        '''
+            Files of workDir with data attached to each vertex of a layer: shadows (ShadowAccumulator) and joins at the
+            COORDINATES or COORDINATES3D level, made from the layer or to it
+        '''
 
-        for index, type in enumerate(types):
+        if(not os.path.isdir(workDir)):
+            return []
 
-            readCoords = 0
+        vertex_levels = ['COORDINATES', 'COORDINATES3D']
 
-            floatList = []
+        attached = []
 
-            for i in range(len(transformed_data['data'])):
-                geometry = transformed_data['data'][i]['geometry']
+        for name in sorted(os.listdir(workDir)):
+            if(re.fullmatch('shadow[0-9]+_'+re.escape(layer_id)+'\\.json', name)):
+                attached.append(name)
 
-                newValue = [readCoords, len(geometry[type])] # where this vector starts and its size
+            elif(name.endswith('_joined.json')):
+                with open(os.path.join(workDir, name), "r", encoding="utf-8") as f:
+                    joined_layers = json.load(f).get('joinedLayers', [])
 
-                readCoords += len(geometry[type])
+                for join in joined_layers:
+                    if((name == layer_id+'_joined.json' and join.get('outLevel') in vertex_levels) or (join.get('layerId') == layer_id and join.get('inLevel') in vertex_levels)):
+                        attached.append(name)
+                        break
 
-                floatList += geometry[type].copy()
+        return attached
 
-                # geometry[type] = newValue
+    def break_into_binary(self, filepath, filename, data, types, dataTypes):
 
-                transformed_data['data'][i]['geometry'][type] = newValue
+        encodings = channels.write_channels(filepath, filename, data['data'], types, dataTypes)
 
-            fout = open(os.path.join(filepath,filename+'_'+type+'.data'), 'wb')
+        if(len(encodings) > 0):
+            data['encodings'] = encodings
 
-            buf = struct.pack(str(len(floatList))+dataTypes[index], *floatList)
+        channels.set_index_type(data, types)
 
-            fout.write(buf)
-            fout.close()
+        LayerView(os.path.join(filepath,filename+".json"), header=data).write_index() # adds the "rtree" entry to the header
 
-        json_object = json.dumps(transformed_data)
+        json_object = json.dumps(data)
 
         with open(os.path.join(filepath,filename+".json"), "w") as outfile:
             outfile.write(json_object)
 
-    def save(self, dir=None, includeGrammar=True):
+    def _save_view(self, layer, workDir, compression=None):
+        '''
+            Saves a layer already written by a LayerWriter: its files (json, channels and sidecars) are copied to
+            workDir, and compressed if compression is provided
+        '''
+
+        filepath = os.path.join(workDir, layer['id']+'.json')
+
+        if(os.path.abspath(layer.filepath) != os.path.abspath(filepath)):
+            prefix = os.path.splitext(layer.filepath)[0]
+
+            for path in manifest.layer_files(layer.filepath): # <id>.json, <id>_<channel>.data, offsets, rtree and order sidecars
+                shutil.copyfile(path, os.path.join(workDir, layer['id']+path[len(prefix):]))
+        elif(compression != None):
+            layer.close() # its files are replaced by compress_layer
+
+        if(compression != None):
+            channels.compress_layer(filepath, None, compression)
+
+    def save(self, dir=None, includeGrammar=True, compression=None, order=None, optimize=False, ids_per_triangle=True):
 
         if(self.workDir == None and dir == None):
             raise Exception("Directory not specified")
@@ -164,8 +215,8 @@ class UrbanComponent:
 
 
         # create dir
-        if(os.path.exists(self.workDir) == False):
-            os.makedirs(self.workDir)
+        if(os.path.exists(workDir) == False):
+            os.makedirs(workDir)
 
         grammar_json = {
             "components": [
@@ -223,39 +274,104 @@ class UrbanComponent:
             }
         }
 
-        for layer in self.layers['json']:
+        mesh_stats = {}
+
+        if(optimize): # welding changes the vertices of the layers, so data attached to them would no longer line up
+            for layer in self.layers['json']:
+                if(isinstance(layer, LayerView)):
+                    mesh = 'indices' in layer.channel_types
+                else:
+                    mesh = 'data' in layer and len(layer['data']) > 0 and 'indices' in layer['data'][0]['geometry']
+
+                if(not mesh):
+                    continue
+
+                attached = self._per_vertex_data(workDir, layer['id'])
+
+                if(len(attached) > 0):
+                    raise Exception("Layer "+layer['id']+" can not be optimized, it has data attached to its vertices in "+", ".join(attached)+". Save it without optimize or remove that data first")
+
+        with manifest.batch(): # the manifest is written once, after every layer
+            for index, layer in enumerate(self.layers['json']):
+
+                grammar_json['components'][0]['knots'].append({"id": "pure"+layer['id'], "integration_scheme": [{"out": {"name": layer['id'], "level": "OBJECTS"}}], "operation": "NONE"})
+                grammar_json['components'][0]['map']['knots'].append("pure"+layer['id'])
+                grammar_json['components'][0]['map']['interactions'].append("NONE")
+
+                view = None
+                unordered = None
+
+                if(isinstance(layer, LayerView)):
+                    if(order == None and not optimize): # already written by a LayerWriter, only the files are needed
+                        self._save_view(layer, workDir, compression)
+                        continue
+
+                    # order and optimize rewrite the features, so the layer is read and written again like a json layer
+                    view = layer
+                    layer = view.to_json()
+                    view.close()
+
+                    if(os.path.abspath(view.filepath) == os.path.abspath(os.path.join(workDir, layer['id']+'.json'))): # sidecars of the old files
+                        for path in manifest.layer_files(view.filepath):
+                            os.remove(path)
+
+                if('data' in layer): # if it is not an abstract layer
+
+                    # the files are written from a copy of the features: write_channels replaces the channels of the written
+                    # features by their [start, size] in the .data files and optimize/order change them, while the component
+                    # (and its gdf, whose ids are positions in its features) keeps its features as they are
+                    source = layer
+                    layer = dict(layer, data=[dict(feature, geometry=dict(feature['geometry'])) for feature in layer['data']])
+
+                    types = []
+                    dataTypes = []
+
+                    if('coordinates' in layer['data'][0]['geometry']):
+                        types.append("coordinates")
+                        dataTypes.append("d")
+
+                    if('normals' in layer['data'][0]['geometry']):
+                        types.append("normals")
+                        dataTypes.append("f")
+
+                    if('indices' in layer['data'][0]['geometry']):
+                        types.append("indices")
+                        dataTypes.append("I")
+
+                    if('ids' in layer['data'][0]['geometry']):
+                        types.append("ids")
+                        dataTypes.append("I")
 
-            grammar_json['components'][0]['knots'].append({"id": "pure"+layer['id'], "integration_scheme": [{"out": {"name": layer['id'], "level": "OBJECTS"}}], "operation": "NONE"})
-            grammar_json['components'][0]['map']['knots'].append("pure"+layer['id'])
-            grammar_json['components'][0]['map']['interactions'].append("NONE")
+                    if(optimize and 'indices' in types): # weld duplicated vertices and reorder them for the GPU caches
+                        mesh_stats[layer['id']] = mesh_optimizer.optimize_layer(layer, ids_per_triangle=ids_per_triangle)
 
-            if('data' in layer): # if it is not an abstract layer
+                    if(order != None and 'coordinates' in types): # neighbouring features end up close in the .data files
+                        unordered = source
+                        source_order = spatial_index.reorder_features(layer['data'], order)
+                        spatial_index.write_order(os.path.join(workDir, layer['id']+'.json'), source_order)
+                        layer['order'] = {"curve": order}
 
-                types = []
-                dataTypes = []
+                    self.break_into_binary(workDir, layer['id'], layer, types, dataTypes)
 
-                if('coordinates' in layer['data'][0]['geometry']):
-                    types.append("coordinates")
-                    dataTypes.append("d")
+                    if(compression != None):
+                        channels.compress_layer(os.path.join(workDir, layer['id']+'.json'), layer, compression)
 
-                if('normals' in layer['data'][0]['geometry']):
-                    types.append("normals")
-                    dataTypes.append("f")
+                if(view != None):
+                    filepath = os.path.join(workDir, layer['id']+'.json')
 
-                if('indices' in layer['data'][0]['geometry']):
-                    types.append("indices")
-                    dataTypes.append("I")
+                    if(unordered == None): # the component keeps a view of the written layer
+                        self.layers['json'][index] = LayerView(filepath, mmap=view.mmap)
+                    elif(os.path.abspath(view.filepath) == os.path.abspath(filepath)): # the files of the view were replaced by the reordered ones
+                        self.layers['json'][index] = unordered
 
-                if('ids' in layer['data'][0]['geometry']):
-                    types.append("ids")
-                    dataTypes.append("I")
+            if(includeGrammar):
+                grammar_json_str = str(json.dumps(grammar_json, indent=4))
+                with open(os.path.join(workDir,"grammar.json"), "w", encoding="utf-8") as f:
+                    f.write(grammar_json_str)
 
-                self.break_into_binary(workDir, layer['id'], layer, types, dataTypes)
+            manifest.update_manifest(workDir) # hashes of every layer, joined and thematic file of the workdir
 
-        if(includeGrammar):
-            grammar_json_str = str(json.dumps(grammar_json, indent=4))
-            with open(os.path.join(workDir,"grammar.json"), "w", encoding="utf-8") as f:
-                f.write(grammar_json_str)
+        return mesh_stats
 
     def view(self):
 
@@ -9,13 +9,17 @@ import json
 import psutil
 import threading
 import requests, zipfile, io
-from flask import Flask, request, send_from_directory, abort, jsonify
+from flask import Flask, Response, request, send_from_directory, abort, jsonify
+from werkzeug.security import safe_join
 from geopy.geocoders import Nominatim
 from watchdog.observers import Observer
 from watchdog.events import LoggingEventHandler
 
 from utk.utils import *
 from utk.files_interface import *
+from utk import compression
+from utk import channels
+from utk import manifest
 
 app = Flask(__name__)
 geolocator = Nominatim(user_agent="urbantk")
@@ -99,8 +103,7 @@ def serve_linkLayers():
     if(fi.existsJoin(out, inData, spatial_relation.upper(), outLevel.upper(), inLevel.upper(), abstract)):
         return ''
 
-    fi.addLayerFromJsonFile(os.path.join(workdir, out+".json"))
-    fi.addLayerFromJsonFile(os.path.join(workdir, inData+".json"), abstract=abstract)
+    fi.addLayersFromJsonFiles([os.path.join(workdir, out+".json"), os.path.join(workdir, inData+".json")], abstract=[False, abstract]) # read concurrently
 
     if(abstract):
         if(maxDistance != None):
@@ -129,7 +132,22 @@ def serve_clearLinks():
 
 @app.route('/files/<path:path>')
 def serve_files(path):
-    return send_from_directory(workdir, path)
+    filepath = safe_join(workdir, path)
+
+    etag = manifest.file_etag(workdir, path) if filepath != None else None # content hash, if the manifest is up to date
+
+    if(etag != None and etag in request.if_none_match):
+        return Response(status=304, headers={'ETag': '"'+etag+'"'})
+
+    if(filepath != None and path.endswith('.data') and os.path.isfile(filepath) and compression.is_compressed(filepath)): # the frontend expects the raw values
+        response = Response(compression.read_file_bytes(filepath), mimetype='application/octet-stream')
+    else:
+        response = send_from_directory(workdir, path)
+
+    if(etag != None):
+        response.set_etag(etag)
+
+    return response
 
 @app.route('/getGrammar', methods=['GET'])
 def serve_getGrammar():
@@ -157,6 +175,9 @@ def serve_getLayer():
     with open(os.path.join(workdir,layer+".json"), "r", encoding="utf-8") as f:
         layer_json = json.load(f)
 
+    if(channels.is_thematic(layer_json)): # binary thematic layers are sent with their values
+        layer_json = channels.read_thematic(os.path.join(workdir,layer+".json"), layer_json=layer_json)
+
     return json.dumps(layer_json, indent=4)
 
 @app.route('/solveNominatim', methods=['GET'])
@@ -326,13 +347,19 @@ def main():
     global port
 
     parser = argparse.ArgumentParser(description='Urban Toolkit')
-    parser.add_argument('mode', nargs=1, choices=['start', 'list', 'stop', 'example'], help='Start, list or stop utk servers, or start server with a simple example.')
+    parser.add_argument('mode', nargs=1, choices=['start', 'list', 'stop', 'example', 'tiles', 'osm'], help='Start, list or stop utk servers, start server with a simple example, build the tileset of a layer (tiles build), or index the OSM layers of a pbf file (osm index region.pbf).')
+    parser.add_argument('action', nargs='?', choices=['build', 'index'], default=None, help='Action of the tiles or osm mode.')
+    parser.add_argument('input', nargs='?', type=str, default=None, help='pbf file to index (osm mode).')
     parser.add_argument('-d', '--data', nargs='?', type=str, required=False, default=None, help='Path to data folder.')
     parser.add_argument('-b', '--bundle', nargs='?', type=str, required=False, help='Path to app bundle (defaults to installed utk bundle).')
     parser.add_argument('-g', '--grammar', nargs='?', type=str, required=False, default=None, help='Path to grammar JSON file, if different from [DATA]/grammar.json (default: [DATA]/grammar.json).')
     parser.add_argument('-a', '--address', nargs='?', type=str, required=False, default='localhost', help='Server address (default: %(default)s).')
     parser.add_argument('-p', '--port', nargs=1, type=int, required=False, default='5001', help='Server port (default: %(default)s).')
     parser.add_argument('-w', '--watch', action='store_true', help='Watch folders, and re-build if there are changes.')
+    parser.add_argument('-l', '--layer', nargs='?', type=str, required=False, default=None, help='Id of the layer to tile (tiles mode).')
+    parser.add_argument('-o', '--output', nargs='?', type=str, required=False, default=None, help='Folder of the tiles and the tileset (tiles mode, default: [DATA]).')
+    parser.add_argument('--max-features', nargs='?', type=int, required=False, default=2000, help='Tiles with more features are split (tiles mode, default: %(default)s).')
+    parser.add_argument('--max-level', nargs='?', type=int, required=False, default=8, help='Deepest level of the quadtree (tiles mode, default: %(default)s).')
 
 
     args = parser.parse_args()
@@ -348,6 +375,38 @@ def main():
         stop_used_ports()
     elif mode == 'list':
         list_used_ports()
+    elif mode == 'tiles':
+        if args.action != 'build':
+            parser.error("the tiles mode only supports the build action (utk tiles build -d DATA -l LAYER).")
+
+        if workdir == None or args.layer == None:
+            print("Error: tiles build needs --data and --layer.")
+            exit(1)
+
+        from utk import tiles
+
+        tileset = tiles.build_tileset(os.path.join(workdir, args.layer+'.json'), args.output, max_features=args.max_features, max_level=args.max_level)
+        print("Tileset written to %s"%tileset)
+    elif mode == 'osm':
+        if args.action != 'index':
+            parser.error("the osm mode only supports the index action (utk osm index region.pbf).")
+
+        if args.input == None:
+            print("Error: usage is utk osm index region.pbf.")
+            exit(1)
+
+        if os.path.isfile(args.input) is False:
+            print("Error: %s does not exist, check arguments."%args.input)
+            exit(1)
+
+        if args.output != None: # the store is looked up next to the pbf file when it is loaded
+            print("Error: the store of a pbf file is always written next to it (-o is not supported in osm mode).")
+            exit(1)
+
+        from utk import osm_store
+
+        store = osm_store.index_pbf(args.input)
+        print("OSM store written to %s"%store)
     else:
         if mode == 'example':
             download_example()
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+
+from utk import cache
+from utk.layer_view import LayerView
+from utk.layer_writer import LayerWriter
+
+def _write_layer(directory):
+    with LayerWriter(str(directory), 'buildings', encodings={'coordinates': 'rtc', 'normals': 'oct16'}) as writer:
+        for i in range(20):
+            coordinates = np.array([0, 0, 0, 1, 0, 0, 0, 1, 0], dtype=np.float64) + [5e5+i, 4e6, 0]*3
+            writer.append_feature(coordinates=coordinates, normals=[0, 0, 1]*3, indices=[0, 1, 2])
+
+    return os.path.join(str(directory), 'buildings.json')
+
+def test_encoded_channels_are_cached_decoded(tmp_path):
+    cache.clear_channel_cache()
+
+    filepath = _write_layer(tmp_path)
+
+    first = LayerView(filepath).channel('coordinates')
+    second = LayerView(filepath).channel('coordinates')
+
+    assert first is second # decoded once, shared by both views
+    assert np.allclose(first[:3], [5e5, 4e6, 0])
+
+def test_memory_maps_do_not_count_against_the_budget(tmp_path):
+    cache.clear_channel_cache()
+
+    filepath = _write_layer(tmp_path)
+
+    indices = LayerView(filepath, mmap=True).channel('indices')
+
+    assert isinstance(indices, np.memmap)
+    assert cache._channel_cache_bytes == 0
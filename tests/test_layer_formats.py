@@ -0,0 +1,120 @@
+import os
+import json
+import numpy as np
+import pytest
+
+from utk import compression
+from utk.layer_view import LayerView
+from utk.layer_writer import LayerWriter, append_to_layer, compact_layer, delete_from_layer
+from utk.load_utk import load_utk
+
+def _feature(i):
+    coordinates = [i, 0, 0, i+1, 0, 0, i, 1, 0, i+1, 1, 1]
+
+    return {'coordinates': coordinates, 'normals': [0, 0, 1]*4, 'indices': [0, 1, 2, 1, 3, 2], 'ids': [i, i]}
+
+def _write_layer(directory, features, **kwargs):
+    with LayerWriter(str(directory), 'surface', **kwargs) as writer:
+        for feature in features:
+            writer.append_feature(**feature)
+
+    return os.path.join(str(directory), 'surface.json')
+
+def _geometries(filepath):
+    return [feature['geometry'] for feature in load_utk(filepath)['data']]
+
+def test_delete_append_and_compact(tmp_path):
+    filepath = _write_layer(tmp_path, [_feature(i) for i in range(5)])
+
+    delete_from_layer(filepath, [1, 3])
+    append_to_layer(filepath, [{'geometry': _feature(10)}, {'geometry': _feature(11)}])
+
+    expected = [_feature(i) for i in [0, 2, 4, 10, 11]]
+
+    assert LayerView(filepath).feature_count == 5
+
+    compact_layer(filepath)
+
+    layer = LayerView(filepath)
+
+    assert 'tombstones' not in layer.header
+    assert layer.physical_count == 5
+
+    for geometry, feature in zip(_geometries(filepath), expected):
+        assert np.allclose(geometry['coordinates'], feature['coordinates'])
+        assert list(geometry['indices']) == feature['indices']
+        assert list(geometry['ids']) == feature['ids']
+
+@pytest.mark.parametrize('normals, tolerance', [('oct16', 1e-4), ('oct8', 2e-2)])
+@pytest.mark.parametrize('codec', [None]+compression.available_codecs())
+def test_encoded_channels_decode_within_tolerance(tmp_path, normals, tolerance, codec):
+    rng = np.random.default_rng(0)
+
+    features = []
+
+    for i in range(50):
+        feature = _feature(i)
+        feature['coordinates'] = (np.array(feature['coordinates'], dtype=np.float64) + [3.2e5, 4.1e6, 10]*4).tolist()
+
+        directions = rng.normal(size=(4, 3))
+        feature['normals'] = (directions / np.linalg.norm(directions, axis=1)[:, None]).flatten().tolist()
+
+        features.append(feature)
+
+    filepath = _write_layer(tmp_path, features, encodings={'coordinates': 'rtc', 'normals': normals}, compression=codec)
+
+    if(codec != None):
+        assert compression.is_compressed(os.path.join(str(tmp_path), 'surface_coordinates.data'))
+
+    for geometry, feature in zip(_geometries(filepath), features):
+        assert np.allclose(geometry['coordinates'], feature['coordinates'], rtol=0, atol=1e-3)
+        assert np.allclose(geometry['normals'], feature['normals'], rtol=0, atol=tolerance)
+        assert list(geometry['indices']) == feature['indices']
+
+def test_offsets_sidecar_and_pairs_load_identically(tmp_path):
+    features = [_feature(i) for i in range(8)]
+
+    pairs = _write_layer(tmp_path / 'pairs', features)
+    sidecar = _write_layer(tmp_path / 'sidecar', features, offsets_sidecar=True)
+
+    assert os.path.exists(os.path.join(str(tmp_path / 'sidecar'), 'surface_offsets.data'))
+    assert not os.path.exists(os.path.join(str(tmp_path / 'pairs'), 'surface_offsets.data'))
+
+    for first, second in zip(_geometries(pairs), _geometries(sidecar)):
+        assert first.keys() == second.keys()
+
+        for key in first:
+            assert np.array_equal(first[key], second[key])
+
+    pairs_view = LayerView(pairs)
+    sidecar_view = LayerView(sidecar)
+
+    for channel in ['coordinates', 'indices', 'ids']:
+        assert np.array_equal(pairs_view.offsets(channel), sidecar_view.offsets(channel))
+
+def _header(filepath):
+    with open(filepath) as f:
+        return json.load(f)
+
+def test_index_type_is_recorded_and_checked(tmp_path):
+    narrow = _write_layer(tmp_path / 'narrow', [_feature(i) for i in range(3)])
+    wide = _write_layer(tmp_path / 'wide', [_feature(i) for i in range(3)], narrow_indices=False)
+
+    assert _header(narrow)['indexType'] == 'uint16'
+    assert _header(wide)['indexType'] == 'uint32'
+
+    feature = _feature(3)
+    feature['indices'] = [0, 1, 70000]
+    append_to_layer(narrow, [{'geometry': feature}]) # widens the indices
+
+    assert _header(narrow)['indexType'] == 'uint32'
+    assert list(_geometries(narrow)[3]['indices']) == [0, 1, 70000]
+
+    header = _header(wide)
+    header['indexType'] = 'uint64'
+
+    with open(wide, 'w') as f:
+        f.write(json.dumps(header))
+
+    with pytest.raises(Exception, match='Unknown index type'):
+        load_utk(wide)
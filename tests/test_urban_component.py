@@ -0,0 +1,75 @@
+import os
+import pytest
+
+from utk.urban_component import UrbanComponent
+from utk.load_utk import load_utk
+
+def _component(layer):
+    return UrbanComponent(layers={'json': [layer], 'gdf': {'objects': [], 'coordinates': [], 'coordinates3d': []}}, camera={}, bpolygon=[])
+
+def _layer():
+    features = []
+
+    for x in [5, 0, 3, 1, 4, 2]:
+        features.append({'geometry': {'coordinates': [x, x, 0, x+1, x, 0, x, x+1, 0], 'normals': [0, 0, 1]*3, 'indices': [0, 1, 2]}})
+
+    return {'id': 'surface', 'type': 'TRIANGLES_3D_LAYER', 'renderStyle': ['FLAT_COLOR'], 'styleKey': 'surface', 'data': features}
+
+def _layer_bytes(directory):
+    files = {}
+
+    for name in sorted(os.listdir(directory)):
+        if(name.startswith('surface')):
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[name] = f.read()
+
+    return files
+
+def test_save_keeps_the_features_of_the_component(tmp_path):
+    layer = _layer()
+    component = _component(layer)
+
+    component.save(str(tmp_path), order='hilbert')
+
+    saved = component.layers['json'][0]
+
+    assert [feature['geometry']['coordinates'][0] for feature in saved['data']] == [5, 0, 3, 1, 4, 2]
+    assert saved['data'][0]['geometry']['indices'] == [0, 1, 2]
+    assert 'rtree' not in saved
+
+def test_save_twice_writes_the_same_files(tmp_path):
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+
+    component = _component(_layer())
+
+    component.save(str(first), order='hilbert')
+    component.save(str(second), order='hilbert')
+
+    assert _layer_bytes(str(first)) == _layer_bytes(str(second))
+
+    loaded = load_utk(str(second / 'surface.json'))
+
+    assert [feature['geometry']['coordinates'][0] for feature in loaded['data']] == [0, 1, 2, 3, 4, 5]
+
+def test_optimize_refuses_layers_with_per_vertex_data(tmp_path):
+    component = _component(_layer())
+
+    with open(os.path.join(str(tmp_path), 'shadow0_surface.json'), 'w') as f:
+        f.write('{"id": "shadow0_surface", "coordinates": [], "values": []}')
+
+    with pytest.raises(Exception, match='shadow0_surface.json'):
+        component.save(str(tmp_path), optimize=True)
+
+def test_optimize_keeps_the_ids_of_the_triangles(tmp_path):
+    layer = _layer()
+
+    for index, feature in enumerate(layer['data']):
+        feature['geometry']['ids'] = [index]
+
+    stats = _component(layer).save(str(tmp_path), optimize=True)
+
+    loaded = load_utk(str(tmp_path / 'surface.json'))
+
+    assert stats['surface']['triangles_after'] == 6
+    assert [feature['geometry']['ids'] for feature in loaded['data']] == [[index] for index in range(6)]